@@ -1,6 +1,6 @@
 # Print read length percentiles (Min, 5%, 10%, 15%, 20%, 25%, Max)
 
-import argparse, util
+import argparse, sys, util, fqindex
 import numpy as np
 
 parser = argparse.ArgumentParser()
@@ -17,6 +17,19 @@ if args.q != '':
     fn = args.q
     iter_seq = util.iter_fsq
 
+# Use the lengths of all reads from the record index of the file if there is an up to date one
+index = fqindex.load_index(fn)
+if index is not None and index.n_records > 0:
+    lengths, counts = index.lengths()
+    print '\nMin = %d' %(lengths[0])
+    print 'Max = %d\n' %(lengths[-1])
+    print '5%% = %d' %(index.length_percentile(5))
+    print '10%% = %d' %(index.length_percentile(10))
+    print '15%% = %d' %(index.length_percentile(15))
+    print '20%% = %d' %(index.length_percentile(20))
+    print '25%% = %d\n' %(index.length_percentile(25))
+    sys.exit()
+
 x = []
 for record in iter_seq(fn):
     sid, seq = record[:2]
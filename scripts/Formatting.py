@@ -8,6 +8,7 @@ Module to convert various file formats on the platform.
 
 import os, sys
 import util
+import readpack
 import numpy as np
 import biom
 from biom.util import biom_open
@@ -16,8 +17,14 @@ import pandas
 
 def fastq2fasta((fastqIn, fastaOut)):
     # Converts FASTQ to FASTA using fastx-toolkit.  Written to facilitate parallelization in Python with multiprocessing library, i.e. accepts a single tuple argument rather than two arguments.
+    # Read packs (see readpack.py) are converted directly; as with fastq_to_fasta, reads containing N are discarded.
+    if readpack.is_readpack(fastqIn):
+        with open(fastaOut, 'w') as fid:
+            for block in readpack.iter_blocks(fastqIn):
+                fid.write(''.join(['>' + record[0][1:] + '\n' + record[1] + '\n' for record in block if 'N' not in record[1]]))
+        return
     cmd_str = 'fastq_to_fasta -i ' + fastqIn + ' -o ' + fastaOut
-    os.system(cmd_str)
+    util.run_cmd(cmd_str)
 
 
 def fasta2table(fastaIn, tableOut):
@@ -86,7 +93,7 @@ def convert_OTU_to_classic_dense_format(otu_table_file, output_otu_table_file):
 def classic2biom(OTU_table_classic, OTU_table_biom):
     # Converts an OTU table in classic dense format (samples as rows, OTU IDs as columns)
     cmd = 'biom convert -i ' + OTU_table_classic + ' -o ' + OTU_table_biom + ' --table-type="OTU table"'
-    os.system(cmd)
+    util.run_cmd(cmd)
 
 
 def build_OTU_table_biom(OTU_table_classic, OTU_table_biom, dataset_ID):
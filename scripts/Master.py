@@ -6,6 +6,9 @@ Master Script that checks a given dataset directory for any processing requests.
 
 Currently only 16S processing supported.
 
+In scheduler mode (-s SCAN_DIR), every dataset directory in SCAN_DIR is checked and all processing requests are run
+concurrently under a shared CPU and memory budget (see scheduler.py).
+
 """
 
 import numpy as np
@@ -18,16 +21,34 @@ from SummaryParser import *
 from Features import *
 import UserInterface as UI
 import QualityControl as QC
+import scheduler
 
 # Read in arguments
-usage = "%prog -i DATASET_DIR"
+usage = "%prog -i DATASET_DIR | -s SCAN_DIR"
 parser = OptionParser(usage)
 parser.add_option("-i", "--datadir", type="string", dest="datadir")
+parser.add_option("-s", "--scan_dir", type="string", dest="scan_dir")
+parser.add_option("--cpus", dest="cpus", default='')
+parser.add_option("--mem_gb", dest="mem_gb", default='')
+parser.add_option("--cpus_per_job", dest="cpus_per_job", default='')
 (options, args) = parser.parse_args()
 
-if( not options.datadir ):
+if( not options.datadir and not options.scan_dir ):
     parser.error("No directory specified for the data.")
 
+# Scheduler mode - process all dataset directories in the scan directory, largest first, under one CPU and memory budget
+if options.scan_dir:
+    sys.stdout = open(os.path.join(options.scan_dir, 'stdout_scheduler.log'),'w')
+    sys.stderr = open(os.path.join(options.scan_dir, 'stderr_scheduler.log'),'w')
+    datadirs = sorted(os.path.join(options.scan_dir, d) for d in os.listdir(options.scan_dir) if os.path.isdir(os.path.join(options.scan_dir, d)))
+    jobs = scheduler.scan_datasets(datadirs)
+    print "[[ Scheduler ]] " + str(len(jobs)) + " processing requests found in " + str(len(datadirs)) + " dataset directories."
+    sched = scheduler.Scheduler(jobs, cpus=int(options.cpus or 0), mem_gb=float(options.mem_gb or 0), cpus_per_job=int(options.cpus_per_job or 0))
+    failed = sched.run()
+    for job in failed:
+        print "[[ Scheduler ]] ERROR: Failed to process " + job.name()
+    sys.exit(len(failed) > 0)
+
 
 # Pipe stdout and stderr to logfiles in the new directory
 working_directory = options.datadir
@@ -39,6 +60,9 @@ summary_filename = os.path.join(options.datadir, 'summary_file.txt')
 summary_obj = SummaryParser(summary_filename)
 summary_obj.ReadSummaryFile()
 
+# Check if both 16S and ITS are to be processed from the same raw file.  If so, both are trimmed in one pass over the raw data and then processed concurrently (see raw2otu.py --combined).
+combined = (scheduler.combined_raw_file(summary_obj) is not None)
+
 # Check if 16S processing is required, and if so, launch the processing pipeline.
 if(summary_obj.attribute_value_16S['PROCESSED'] == 'True'):
     print "[[ 16S processing ]] Processing already complete."
@@ -66,7 +90,11 @@ elif(summary_obj.attribute_value_16S['PROCESSED'] == 'False'):
         print "[[ 16S processing ]] No barcodes map.  Assuming sequences have been demultiplexed and relabeled with sample IDs."
     print "[[ 16S processing ]] Processing required.  Generating OTU tables."
     raw2otu_cmd = 'python ~/scripts/raw2otu.py -i ' + working_directory + flags 
-    os.system(raw2otu_cmd)
+    if combined:
+        print "[[ 16S processing ]] ITS data in the same raw file.  Processing 16S and ITS together."
+        raw2otu_cmd = raw2otu_cmd + ' -t 16S --combined True'
+    # In combined mode, raw2otu.py exits with an error if the ITS processing failed
+    raw2otu_status = os.system(raw2otu_cmd)
 
     # Check summary file again
     summary_obj.ReadSummaryFile()
@@ -81,6 +109,13 @@ elif(summary_obj.attribute_value_16S['PROCESSED'] == 'False'):
 # Check if ITS processing is required, and if so, launch the processing pipeline.
 if(summary_obj.attribute_value_ITS['PROCESSED'] == 'True'):
     print "[[ ITS processing ]] Processing already complete."
+elif(combined):
+    # Check summary file again
+    summary_obj.ReadSummaryFile()
+    if(raw2otu_status != 0 or summary_obj.attribute_value_ITS['PROCESSED'] == 'False'):
+        print "[[ ITS processing ]] ERROR: Failed to process ITS data (processed together with 16S data)"
+        raise NameError('ERROR: Failed to process ITS data.')
+    print "[[ ITS processing ]] Processed together with 16S data."
 elif(summary_obj.attribute_value_ITS['PROCESSED'] == 'False'):
 
     flags = ''
@@ -8,6 +8,8 @@ Python module for quality control of datasets prior to preprocessing.
 from __future__ import print_function
 import os
 import util
+import fqindex
+import readpack
 import numpy as np
 import matplotlib
 import sys
@@ -33,6 +35,17 @@ def check_length_stats(fastq_in):
 
 def read_length_histogram(raw_sequences_file, path, raw_sequences_filetype='FASTQ'):
     # Creates a histogram of read lengths
+    # Uses the lengths of all reads from the record index of the file if there is an up to date one, otherwise the first 100000 reads
+    index = fqindex.load_index(raw_sequences_file)
+    if index is not None and index.n_records > 0:
+        lengths, counts = index.lengths()
+        plt.figure()
+        plt.hist(lengths, 50, weights=counts)
+        plt.title('Distribution of amplicon read lengths')
+        plt.xlabel('Read length')
+        plt.ylabel('Freq')
+        plt.savefig(os.path.join(path, 'read_lengths_distribution.png'))
+        return
     if raw_sequences_filetype == "FASTQ":
         iter_seq = util.iter_fsq
     else:
@@ -68,14 +81,48 @@ def sample_read_counts(OTU_table, path):
 
 
 def file_len(fname):
+    # Number of lines in a file; taken from the record index of a FASTQ file if there is an up to date one
+    # For read packs (see readpack.py), the number of lines of the equivalent FASTQ/FASTA file
+    if readpack.is_readpack(fname):
+        fastq, n_records = readpack.read_footer(fname)[:2]
+        return (4 if fastq else 2)*n_records
+    index = fqindex.load_index(fname)
+    if index is not None and index.file_type == 'FASTQ':
+        return 4*index.n_records
     with open(fname) as f:
         for i, l in enumerate(f):
             pass
     return i + 1
 
 
-def reads_thrown_out_at_each_step(raw_split_filenames, output_file):
+def chunk_len(chunk):
+    # Number of lines in a raw data chunk (path, start, end) from chunking.plan_chunks
+    path, start, end = chunk
+    index = fqindex.load_index(path)
+    if index is not None and index.file_type == 'FASTQ':
+        n_records = index.count_records(start, end)
+        if n_records is not None:
+            return 4*n_records
+    return util.count_lines(path, start, end)
+
+
+def chunk_records(chunk, file_type):
+    # Number of reads in a raw data chunk (path, start, end): FASTQ records are 4 lines, FASTA records (which may be
+    # wrapped over several lines) are counted by their header lines
+    path, start, end = chunk
+    index = fqindex.load_index(path)
+    if index is not None and index.file_type == file_type:
+        n_records = index.count_records(start, end)
+        if n_records is not None:
+            return n_records
+    if file_type == 'FASTQ':
+        return chunk_len(chunk) // 4
+    return util.count_headers(path, start, end)
+
+
+def reads_thrown_out_at_each_step(raw_split_filenames, output_file, raw_chunks=None):
     # Creates a file with % of reads retained after each processing step
+    # raw_chunks, if given, are the raw data chunks that the per-chunk files in raw_split_filenames were produced from
     raw_counts = 0
     sb_counts = 0
     pt_counts = 0
@@ -83,8 +130,11 @@ def reads_thrown_out_at_each_step(raw_split_filenames, output_file):
     lt_counts = 0
     fasta_counts = 0
 
-    for filename in raw_split_filenames:
-        raw_counts += file_len(filename)
+    for i, filename in enumerate(raw_split_filenames):
+        if raw_chunks is not None:
+            raw_counts += chunk_len(raw_chunks[i])
+        else:
+            raw_counts += file_len(filename)
         try:
             sb_counts += file_len(filename + '.sb')
         except:
@@ -157,6 +207,31 @@ def reads_thrown_out_at_each_step(raw_split_filenames, output_file):
         except:
             pass
 
+def write_step_counts(step_counts, output_file):
+    # Writes the % of reads retained after each processing step from read counts [(label, count)], e.g. from readengine.sum_counts.
+    # The first count is the number of raw reads.
+    raw_counts = step_counts[0][1]
+    with open(output_file, 'a+') as fid:
+        for label, counts in step_counts:
+            line = 'Number of ' + label + ' = ' + str(counts)
+            fid.write(line + '\n')
+            line = 'Percent of reads left: ' + str(100 - 100*float(raw_counts-counts)/float(max(raw_counts, 1))) + '%'
+            fid.write(line + '\n')
+            fid.write('\n')
+
+def write_attrition_table(attrition, output_file, stages=None):
+    # Writes a sparse attrition table {(sample, stage, reason): reads} (see readengine.py), one tab-delimited line per
+    # sample, stage and reason with reads dropped, and one line per sample with the reads kept.  Stages are listed in
+    # the order of stages (e.g. the labels of the step counts), then any others in alphabetical order.
+    order = dict((stage, i) for i, stage in enumerate(stages or []))
+    def sort_key(key):
+        sample, stage, reason = key
+        return (sample, stage == 'kept', order.get(stage, len(order)), stage, reason)
+    with open(output_file, 'w') as fid:
+        fid.write('#sample\tstage\treason\treads\n')
+        for key in sorted(attrition, key=sort_key):
+            fid.write('\t'.join([str(x) for x in key] + [str(attrition[key])]) + '\n')
+
 def warning(*objs):
     print("WARNING: ", *objs, file=sys.stderr)
 
@@ -167,7 +242,10 @@ def remove_empty_files(filenames, step=''):
     # empty files were found. E.g. "barcodes trimming"
     keepfiles = []
     for f in filenames:
-        if os.stat(f).st_size != 0:
+        if readpack.is_readpack(f):
+            if readpack.count_records(f) != 0:
+                keepfiles.append(f)
+        elif os.stat(f).st_size != 0:
             keepfiles.append(f)
     if len(keepfiles) != len(filenames):
         warning("found {} empty files after {} step".format(len(filenames) - len(keepfiles), step))
@@ -102,7 +102,7 @@ class SummaryParser():
                     checksum += 1
                 if (line.split('\t')[0] == "RAW_FASTQ_FILE" or line.split('\t')[0] == "RAW_FASTA_FILE" or line.split('\t')[0] == "RAW_FASTQ_FILES" or line.split('\t')[0] == "RAW_FASTA_FILES") and len(line.split('\t')[1]) > 0:
                     checksum += 1
-            if checksum != 4:
+            if checksum < 4:
                 print "Failed to find DATASET_ID, BARCODES_MAP, PRIMERS_FILE and/or RAW_FASTQ_FILE/RAW_FASTA_FILE/RAW_FASTQ_FILES lines.  Check integrity of summary file."
                 raise NameError("Failed to find DATASET_ID, BARCODES_MAP, PRIMERS_FILE and/or RAW_FASTQ_FILE/RAW_FASTA_FILE/RAW_FASTQ_FILES lines.  Check integrity of summary file.")
         except:
@@ -134,7 +134,7 @@ class SummaryParser():
                         checksum += 1
                     if (line.split('\t')[0] == "RAW_FASTQ_FILE" or line.split('\t')[0] == "RAW_FASTA_FILE" or line.split('\t')[0] == "RAW_FASTQ_FILES" or line.split('\t')[0] == "RAW_FASTA_FILES") and len(line.split('\t')[1]) > 0:
                         checksum += 1
-                if checksum != 4:
+                if checksum < 4:
                     raise NameError("Failed to find DATASET_ID, BARCODES_MAP, PRIMERS_FILE and/or RAW_FASTQ_FILE/RAW_FASTA_FILE/RAW_FASTQ_FILES lines.  Check integrity of summary file.")
             except:
                 raise NameError("No 16S or ITS sections found.")
@@ -0,0 +1,171 @@
+"""
+
+OVERVIEW:
+
+Python module for reading BGZF files (blocked gzip, as written by bgzip).
+
+A BGZF file is a series of independent gzip members of at most 64 Kb of uncompressed data each, and the size of
+every member is stored in its header.  Blocks can therefore be located without decompressing anything and
+decompressed independently, which lets pool workers decode different parts of one file concurrently.
+
+Positions inside a BGZF file are virtual offsets, as in BAM/tabix: (compressed offset of the block << 16) | offset
+inside the uncompressed block.
+
+"""
+
+import os
+import struct
+import zlib
+from bisect import bisect_right
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+
+
+def is_bgzf(fn):
+    # Returns True if the file starts with a gzip header carrying the BGZF 'BC' extra subfield
+    with open(fn, 'rb') as fid:
+        header = fid.read(18)
+    return len(header) == 18 and header[:4] == BGZF_MAGIC and header[12:14] == 'BC'
+
+
+def make_voffset(coffset, uoffset):
+    # Virtual offset from a compressed block offset and an offset inside the uncompressed block
+    return (coffset << 16) | uoffset
+
+
+def split_voffset(voffset):
+    # (compressed block offset, offset inside the uncompressed block) of a virtual offset
+    return voffset >> 16, voffset & 0xFFFF
+
+
+def _block_size(header, fid):
+    # Reads the gzip extra field following a 12-byte header and returns (total block size, extra field)
+    if header[:4] != BGZF_MAGIC:
+        raise IOError('Not a BGZF block (bad gzip header)')
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fid.read(xlen)
+    i = 0
+    while i + 4 <= xlen:
+        si1, si2, slen = struct.unpack('<BBH', extra[i:i+4])
+        if si1 == 66 and si2 == 67:
+            return struct.unpack('<H', extra[i+4:i+6])[0] + 1, extra
+        i += 4 + slen
+    raise IOError('Not a BGZF block (missing BC subfield)')
+
+
+def read_block(fid):
+    # Reads the next compressed block from an open BGZF file.  Returns '' at end of file.
+    header = fid.read(12)
+    if len(header) < 12:
+        return ''
+    bsize, extra = _block_size(header, fid)
+    return header + extra + fid.read(bsize - 12 - len(extra))
+
+
+def inflate_block(block):
+    # Decompresses one BGZF block
+    xlen = struct.unpack('<H', block[10:12])[0]
+    return zlib.decompress(block[12 + xlen:-8], -15)
+
+
+def scan_blocks(fn):
+    # Returns the compressed offsets of all blocks in a BGZF file, reading only the block headers
+    offsets = []
+    filesize = os.path.getsize(fn)
+    with open(fn, 'rb') as fid:
+        coffset = 0
+        while coffset < filesize:
+            fid.seek(coffset)
+            header = fid.read(12)
+            if len(header) < 12:
+                break
+            bsize, extra = _block_size(header, fid)
+            offsets.append(coffset)
+            coffset += bsize
+    return offsets
+
+
+def block_table(fn):
+    # Returns (compressed offsets, uncompressed start positions) of all blocks, reading only headers and ISIZE fields
+    coffsets = []
+    ustarts = []
+    filesize = os.path.getsize(fn)
+    upos = 0
+    with open(fn, 'rb') as fid:
+        coffset = 0
+        while coffset < filesize:
+            fid.seek(coffset)
+            header = fid.read(12)
+            if len(header) < 12:
+                break
+            bsize, extra = _block_size(header, fid)
+            fid.seek(coffset + bsize - 4)
+            isize = struct.unpack('<I', fid.read(4))[0]
+            coffsets.append(coffset)
+            ustarts.append(upos)
+            coffset += bsize
+            upos += isize
+    return coffsets, ustarts
+
+
+def voffset_to_upos(table, voffset):
+    # Position in the uncompressed stream of a virtual offset (table from block_table)
+    coffsets, ustarts = table
+    coffset, uoffset = split_voffset(voffset)
+    return ustarts[bisect_right(coffsets, coffset) - 1] + uoffset
+
+
+def upos_to_voffset(table, upos):
+    # Virtual offset of a position in the uncompressed stream (table from block_table)
+    coffsets, ustarts = table
+    j = bisect_right(ustarts, upos) - 1
+    return make_voffset(coffsets[j], upos - ustarts[j])
+
+
+def iter_range(fn, start=0, end=None):
+    # Generator that yields the decompressed data between two virtual offsets, one block at a time
+    start_coffset, start_uoffset = split_voffset(start)
+    if end is not None:
+        end_coffset, end_uoffset = split_voffset(end)
+    with open(fn, 'rb') as fid:
+        fid.seek(start_coffset)
+        coffset = start_coffset
+        while True:
+            if end is not None and coffset > end_coffset:
+                break
+            block = read_block(fid)
+            if not block:
+                break
+            data = inflate_block(block)
+            if end is not None and coffset == end_coffset:
+                data = data[:end_uoffset]
+            if coffset == start_coffset:
+                data = data[start_uoffset:]
+            if data:
+                yield data
+            coffset += len(block)
+
+
+def record_aligned_ranges(fn, n_ranges, find_record_start):
+    # Splits a BGZF file into about n_ranges [start, end) virtual offset ranges whose boundaries fall on record starts.
+    # find_record_start(buf, pos) returns the offset of the first complete record start in buf at or after pos, or -1.
+    # Only the blocks at range boundaries are decompressed.
+    offsets = scan_blocks(fn)
+    boundaries = [0]
+    if len(offsets) > 1:
+        n_ranges = max(1, min(n_ranges, len(offsets)))
+        with open(fn, 'rb') as fid:
+            for k in [i*len(offsets) // n_ranges for i in range(1, n_ranges)]:
+                # Decompress the boundary block plus the next one, so that a record starting near the end of
+                # the boundary block can be recognised
+                fid.seek(offsets[k])
+                data = inflate_block(read_block(fid))
+                nxt = read_block(fid)
+                context = data + (inflate_block(nxt) if nxt else '')
+                pos = find_record_start(context, 1)
+                if pos < 0 or pos >= len(data):
+                    continue
+                voffset = make_voffset(offsets[k], pos)
+                if voffset > boundaries[-1]:
+                    boundaries.append(voffset)
+    return zip(boundaries, boundaries[1:] + [None])
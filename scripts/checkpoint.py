@@ -0,0 +1,134 @@
+"""
+
+OVERVIEW:
+
+Python module for checkpointing the stages of a raw2otu.py run, so that a rerun resumes from the first stage that did
+not complete or whose inputs or parameters changed.
+
+The run is a chain of named stages (trimming, derep, clustering, oligotypes, alignment, RDP, packaging), each of which
+reads the outputs of earlier stages.  When a stage completes, a manifest is recorded for it with the MD5 hashes of its
+input and output files and a hash of its parameters.  On a rerun a stage is skipped if its manifest matches the
+current input files and parameters and its outputs are still in place.  A stage whose inputs changed is run again,
+and so are the stages after it whenever its outputs change.  Manifests of all stages are kept in one JSON file in the
+working directory, together with the hashes of the files seen (keyed by size and modification time, so unchanged
+files are only hashed once).  Raw data files, which can be tens of GB and are only read, are not hashed at all: after
+stamp_files they are identified by their path, size and modification time.
+
+ckpt = checkpoint.Checkpoints(os.path.join(working_directory, 'checkpoints.json'))
+params = {'min_count': min_count}
+if not ckpt.is_done('derep', [fasta_trimmed], params):
+    OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', processing_summary_file, min_count)
+    ckpt.record('derep', [fasta_trimmed], params, [fasta_dereplicated, dereplication_map])
+
+"""
+
+import os
+import json
+import time
+import hashlib
+
+CHECKPOINT_VERSION = 1
+
+
+def file_md5(fn, block_size=1 << 20):
+    # MD5 hex digest of the contents of a file
+    h = hashlib.md5()
+    with open(fn, 'rb') as fid:
+        while True:
+            block = fid.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def params_md5(params):
+    # MD5 hex digest of a dict of parameters (values are compared as strings, e.g. 97 and '97' are the same)
+    x = json.dumps(sorted((str(k), str(v)) for k, v in params.items()))
+    return hashlib.md5(x).hexdigest()
+
+
+class Checkpoints():
+
+    def __init__(self, manifest_file, resume=True):
+        self.manifest_file = manifest_file
+        self.stages = {} # stage name -> manifest
+        self.hashes = {} # filename -> [size, mtime, md5]
+        self.stamped = set() # files identified by path, size and modification time (see stamp_files)
+        if resume and os.path.isfile(manifest_file):
+            self.load()
+
+    def load(self):
+        with open(self.manifest_file) as fid:
+            x = json.load(fid)
+        if x.get('version') != CHECKPOINT_VERSION:
+            return self
+        self.stages = x['stages']
+        self.hashes = x['hashes']
+        return self
+
+    def save(self):
+        # Written to a temporary file and renamed, so a run killed while saving leaves the previous manifests intact
+        x = {'version': CHECKPOINT_VERSION, 'stages': self.stages, 'hashes': self.hashes}
+        with open(self.manifest_file + '.tmp', 'w') as fid:
+            json.dump(x, fid, indent=1, sort_keys=True)
+        os.rename(self.manifest_file + '.tmp', self.manifest_file)
+
+    def file_hash(self, fn):
+        # MD5 of a file (reused while its size and modification time are unchanged), its path, size and modification time
+        # if it is stamped, '' for a directory and None if it does not exist
+        if os.path.isdir(fn):
+            return ''
+        try:
+            stat = os.stat(fn)
+        except OSError:
+            return None
+        if fn in self.stamped:
+            return 'stat:%s:%d:%r' % (os.path.abspath(fn), stat.st_size, stat.st_mtime)
+        cached = self.hashes.get(fn)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+        md5 = file_md5(fn)
+        self.hashes[fn] = [stat.st_size, stat.st_mtime, md5]
+        return md5
+
+    def stamp_files(self, filenames):
+        # Identifies filenames by their path, size and modification time instead of the MD5 of their contents
+        self.stamped.update(filenames)
+
+    def file_hashes(self, filenames):
+        return dict((fn, self.file_hash(fn)) for fn in filenames)
+
+    def is_done(self, stage, inputs, params):
+        # True if stage completed with the same input files and parameters and its output files are unchanged
+        manifest = self.stages.get(stage)
+        if manifest is None:
+            return False
+        if manifest['params_md5'] != params_md5(params):
+            print('Checkpoint: parameters of stage ' + stage + ' changed, running it again.')
+            return False
+        if manifest['inputs'] != self.file_hashes(inputs):
+            print('Checkpoint: inputs of stage ' + stage + ' changed, running it again.')
+            return False
+        if manifest['outputs'] != self.file_hashes(manifest['outputs'].keys()):
+            print('Checkpoint: outputs of stage ' + stage + ' are missing or changed, running it again.')
+            return False
+        print('Checkpoint: stage ' + stage + ' already completed at ' + manifest['completed'] + ', skipping it.')
+        return True
+
+    def record(self, stage, inputs, params, outputs, data=None):
+        # Records the completion of stage.  data holds any values (JSON) the rest of the run needs when the stage is skipped.
+        self.stages[stage] = {'inputs': self.file_hashes(inputs), 'params': dict((str(k), str(v)) for k, v in params.items()),
+                              'params_md5': params_md5(params), 'outputs': self.file_hashes(outputs), 'data': data,
+                              'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save()
+
+    def invalidate(self, stage):
+        # Forgets the completion of stage (e.g. after it failed), so that it is run again
+        if stage in self.stages:
+            del self.stages[stage]
+            self.save()
+
+    def data(self, stage):
+        # Values recorded with the completion of stage
+        return self.stages[stage]['data']
@@ -0,0 +1,215 @@
+"""
+
+OVERVIEW:
+
+Python module for splitting raw FASTQ/FASTA files into record-aligned chunks for parallel processing.
+
+A chunk is a tuple (path, start, end): the records of 'path' between offsets start (inclusive) and end (exclusive,
+None for end of file).  Offsets are byte offsets for plain files and virtual offsets for BGZF files.  Workers read
+their chunk directly from the raw file with util.iter_fsq(path, start, end), so no copy of the raw data is written.
+
+gzip and zstd files cannot be read from an arbitrary offset; they are decompressed once into chunk files.  Their
+estimated size (decompressed_bytes) is checked against the free space of the chunk directory (free_bytes) first, as
+scratch storage such as /dev/shm is often much smaller than the working directory.
+
+Raw data is split into about TASKS_PER_CPU tasks per cpu, so that the pool is kept busy until the end of a step even
+when some tasks run slower than others.  With many raw files (one per sample, of very different sizes), a file larger
+than the target task size is split into several chunks, so that one large sample is not a single task that holds up
+the whole step (plan_file_tasks).  Tasks are then started largest first (see pipeline.map_largest_first).
+
+"""
+
+import os
+import math
+import util
+import bgzf
+import fqindex
+import packaging
+
+# Chunks are kept below MAX_CHUNK_BYTES and above MIN_CHUNK_BYTES of raw data
+MAX_CHUNK_BYTES = 256*1024*1024
+MIN_CHUNK_BYTES = 1024*1024
+
+# Target number of tasks per cpu for a parallel step
+TASKS_PER_CPU = 6
+
+# Estimated size of compressed raw data after decompression, relative to the compressed size
+COMPRESSION_RATIO = 4
+
+
+def raw_size(fn):
+    # Estimated size of the raw data in a file
+    size = os.path.getsize(fn)
+    if util.detect_compression(fn) is not None:
+        size = COMPRESSION_RATIO*size
+    return size
+
+
+def default_chunk_count(fn, cpu_count):
+    # Number of chunks for a raw file: TASKS_PER_CPU per cpu, more if chunks would be larger than MAX_CHUNK_BYTES and
+    # fewer if they would be smaller than MIN_CHUNK_BYTES
+    size = raw_size(fn)
+    n_chunks = max(cpu_count*TASKS_PER_CPU, int(math.ceil(float(size) / MAX_CHUNK_BYTES)))
+    return int(max(1, min(n_chunks, size // MIN_CHUNK_BYTES)))
+
+
+def splittable(fn, file_type):
+    # True if chunks of fn can be read without decompressing it first (plain and BGZF files, or an up to date index)
+    if util.detect_compression(fn) in [None, 'bgzf']:
+        return True
+    index = fqindex.load_index(fn)
+    return index is not None and index.file_type == file_type and index.seekable()
+
+
+def decompressed_bytes(fn, file_type):
+    # Estimated size of the chunk files plan_chunks writes for fn: the raw data of a gzip/zstd file that has to be
+    # decompressed (see _split_stream), nothing for a file whose chunks are read in place
+    if splittable(fn, file_type):
+        return 0
+    return raw_size(fn)
+
+
+def free_bytes(directory):
+    # Free space (bytes) available to the user in the file system of directory
+    st = os.statvfs(directory)
+    return st.f_bavail*st.f_frsize
+
+
+def chunk_bytes(chunk):
+    # Estimated size of the raw data in a chunk (path, start, end) or file, used to start the largest tasks first
+    path, start, end = as_chunk(chunk)
+    if not os.path.isfile(path):
+        return 0
+    compression = util.detect_compression(path)
+    if compression == 'bgzf':
+        # virtual offsets hold the compressed offset of a block in their upper 48 bits
+        start = start >> 16
+        end = end >> 16 if end is not None else None
+    if end is None:
+        end = os.path.getsize(path)
+    size = max(0, end - start)
+    if compression is not None:
+        size = COMPRESSION_RATIO*size
+    return size
+
+
+def _record_start_after(fid, offset, filesize, fastq):
+    # Offset of the first record starting after byte 'offset' of a plain file, or filesize if there is none
+    window = 1 << 16
+    while True:
+        fid.seek(offset - 1)
+        buf = fid.read(window + 1)
+        pos = util.next_record_start(buf, 1, fastq)
+        if pos >= 0:
+            return offset - 1 + pos
+        if offset - 1 + len(buf) >= filesize:
+            return filesize
+        window = 2*window
+
+
+def _split_stream(fn, file_type, n_chunks, prefix):
+    # Decompresses a gzip/zstd file once into about n_chunks record-aligned chunk files named prefix0000, prefix0001, ...
+    # The record index of the file (read counts and length stats, see fqindex.py) is built in the same pass.
+    target = max(1, raw_size(fn) // n_chunks)
+    chunk_files = []
+    out = None
+    written = 0
+    indexer = fqindex.ChunkIndexer()
+    for batch in fqindex.iter_batches(fn, file_type, indexer=indexer):
+        if out is None or written >= target:
+            if out is not None:
+                out.close()
+            chunk_files.append(prefix + '%04d' % len(chunk_files))
+            out = open(chunk_files[-1], 'wb')
+            written = 0
+        data = batch.raw()
+        out.write(data)
+        written += len(data)
+    if out is not None:
+        out.close()
+    fqindex.merge_index(fn, file_type, [(fn, 0, None)], [indexer.result()])
+    return [(f, 0, None) for f in chunk_files]
+
+
+def plan_chunks(fn, file_type='FASTQ', n_chunks=None, cpu_count=1, prefix='rawchunk'):
+    # Splits a raw FASTQ/FASTA file into record-aligned chunks (path, start, end).
+    # Chunk boundaries are taken from the record index of the file if there is an up to date one (see fqindex.py),
+    # otherwise found by scanning for a record start near evenly spaced offsets; only a few Kb are read per boundary.
+    if n_chunks is None:
+        n_chunks = default_chunk_count(fn, cpu_count)
+    fastq = (file_type == 'FASTQ')
+    compression = util.detect_compression(fn)
+    index = fqindex.load_index(fn)
+    if index is not None and index.file_type == file_type and index.seekable():
+        boundaries = index.chunk_boundaries(n_chunks)
+        return [(fn, start, end) for start, end in zip(boundaries, boundaries[1:] + [None])]
+    if compression == 'bgzf':
+        return [(fn, start, end) for start, end in bgzf.record_aligned_ranges(fn, n_chunks, lambda buf, pos: util.next_record_start(buf, pos, fastq))]
+    elif compression is not None:
+        return _split_stream(fn, file_type, n_chunks, prefix)
+    filesize = os.path.getsize(fn)
+    boundaries = [0]
+    with open(fn, 'rb') as fid:
+        for i in range(1, n_chunks):
+            offset = _record_start_after(fid, i*filesize // n_chunks, filesize, fastq)
+            if offset > boundaries[-1] and offset < filesize:
+                boundaries.append(offset)
+    return [(fn, start, end) for start, end in zip(boundaries, boundaries[1:] + [None])]
+
+
+def plan_file_tasks(filenames, file_type='FASTQ', cpu_count=1, prefix='rawchunk'):
+    # Splits a set of raw files (e.g. one per sample) into about TASKS_PER_CPU tasks per cpu in all, of about the same
+    # size: a file larger than the target task size is split into several record-aligned chunks, smaller files are one
+    # task each.  gzip/zstd files are never split, because that would decompress them before any processing starts.
+    # Returns the list of chunks of every file.
+    sizes = [raw_size(fn) for fn in filenames]
+    target = float(sum(sizes)) / max(1, cpu_count*TASKS_PER_CPU)
+    target = min(MAX_CHUNK_BYTES, max(MIN_CHUNK_BYTES, target))
+    file_chunks = []
+    for i, (fn, size) in enumerate(zip(filenames, sizes)):
+        n_chunks = int(math.ceil(size / target))
+        if n_chunks > 1 and splittable(fn, file_type):
+            file_chunks.append(plan_chunks(fn, file_type, n_chunks=n_chunks, prefix=prefix + '%04d_' % i))
+        else:
+            file_chunks.append([(fn, 0, None)])
+    return file_chunks
+
+
+def as_chunk(x):
+    # A chunk (path, start, end) from a chunk or a filename (the whole file)
+    if isinstance(x, basestring):
+        return (x, 0, None)
+    return tuple(x)
+
+
+def cli_args(chunk):
+    # Command line arguments for reading a chunk with the numbered scripts, e.g. 'raw.fastq --start 0 --end 1000'
+    if isinstance(chunk, basestring):
+        return chunk
+    path, start, end = chunk
+    args = path
+    if start:
+        args += ' --start ' + str(start)
+    if end is not None:
+        args += ' --end ' + str(end)
+    return args
+
+
+def write_chunk((chunk, chunk_out)):
+    # Writes the (decompressed) contents of a chunk to a file.  For tools that can only read whole files, e.g. usearch.
+    # Takes a single tuple argument for use with multiprocessing.
+    path, start, end = chunk
+    with open(chunk_out, 'wb') as fid:
+        for data in util.iter_raw(path, start=start, end=end):
+            fid.write(data)
+
+
+def link_chunk((chunk, chunk_out)):
+    # Makes a chunk available to tools that can only read whole files under the name chunk_out: an uncompressed raw file
+    # that is a chunk of its own is symlinked (it is only read from here on), any other chunk is written out with write_chunk.
+    # Takes a single tuple argument for use with multiprocessing (and as a stage of pipeline.run_chunks).
+    path, start, end = as_chunk(chunk)
+    if not start and end is None and util.detect_compression(path) is None:
+        packaging.link_input(path, chunk_out)
+    else:
+        write_chunk(((path, start, end), chunk_out))
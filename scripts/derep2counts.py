@@ -0,0 +1,72 @@
+"""
+
+OVERVIEW:
+
+Python module for converting a dereplication mapping file (from dereplicate.py) into a counts matrix.  Library code
+of 4.derep2counts.py.
+
+"""
+
+import pandas as pd
+import numpy as np
+import util
+
+
+def derep2counts(map_fn, out_fn, min_count, min_samples, fst=''):
+    # Writes a samples x OTUs counts matrix from a derep mapping file, keeping OTUs with at least min_count reads
+    # in at least min_samples samples (and, if given, only the OTUs in the FASTA file fst)
+
+    # Load valid fst seqs
+    keep = {}
+    if fst:
+        for [otu, seq] in util.iter_fst(fst):
+            otu = otu[1:]
+            keep[otu] = 1
+
+    # Keep track of samples and otus
+    samples = {}
+    otus = {}
+
+    # For every line in the mapping file
+    for line in open(map_fn):
+        # Load otu name and table of sample counts
+        otu, table = line.rstrip().split('\t')
+        if len(keep) > 0 and otu not in keep:
+            continue
+        entries = table.split(' ')
+        count = sum([int(entry.split(':')[1]) >= min_count for entry in entries])
+        if count < min_samples:
+            continue
+        if otu not in otus:
+            otus[otu] = len(otus)
+        for entry in entries:
+            sample, count = entry.split(':')
+            if sample not in samples:
+                samples[sample] = len(samples)
+
+    x = np.zeros([len(samples), len(otus)])
+
+    for line in open(map_fn):
+        otu, table = line.rstrip().split('\t')
+        if len(keep) > 0 and otu not in keep:
+            continue
+        if otu in otus:
+            for entry in table.split(' '):
+                sample, count = entry.split(':')
+                i = samples[sample]
+                j = otus[otu]
+                x[i,j] += int(count)
+
+    x = pd.DataFrame(x)
+
+    sort_otus = sorted(otus.keys(), key=lambda a: otus[a])
+    sort_samp = sorted(samples.keys(), key=lambda a: samples[a])
+    keep = ((x > 0).sum(axis=0) > min_samples)
+    x = x.ix[:, keep]
+
+    out = open(out_fn, 'w')
+    out.write( 'sample\t' + '\t'.join(sort_otus) + '\n')
+    for sample in sort_samp:
+        i = samples[sample]
+        out.write( '%s\t%s' %(sample, '\t'.join(['%d' %(xi) for xi in x.ix[i,:]])) + '\n')
+    out.close()
@@ -0,0 +1,240 @@
+"""
+
+OVERVIEW:
+
+Python module for persistent record indexes (.fqi files) of raw FASTQ/FASTA files.
+
+An index is stored next to the raw file as '<raw file>.fqi' (JSON).  It holds the offset of every Nth record
+(byte offsets for plain files, virtual offsets for BGZF files), the total number of records and a histogram of read
+lengths.  With it the pipeline can count reads, get length statistics and seek to any record without rescanning the
+raw file, and re-chunk a dataset instantly on later runs.
+
+The index is built in the first pass that reads the raw data: every record-aligned chunk (see chunking.py) is indexed
+from the batches its worker reads for processing, and the chunk indexes are merged:
+
+indexer = fqindex.ChunkIndexer()
+for batch in fqindex.iter_batches('raw.fastq', 'FASTQ', start, end, indexer):
+    ...
+index = fqindex.merge_index('raw.fastq', 'FASTQ', chunks, [indexer.result() for each chunk])
+index.n_records
+
+"""
+
+import os
+import json
+import math
+import numpy as np
+from bisect import bisect_right
+import util
+import bgzf
+import tracing
+
+INDEX_VERSION = 1
+
+# Offset of every INDEX_EVERY-th record is stored
+INDEX_EVERY = 10000
+
+
+def index_path(fn):
+    # Filename of the index of a raw file
+    return fn + '.fqi'
+
+
+class RecordIndex():
+
+    def __init__(self, fn, file_type='FASTQ'):
+        self.fn = fn
+        self.file_type = file_type
+        self.compression = util.detect_compression(fn)
+        self.n_records = 0
+        self.checkpoints = [] # sorted [record number, offset] pairs
+        self.length_hist = {} # read length -> number of reads
+        stat = os.stat(fn)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+    def is_fresh(self):
+        # True if the raw file has not changed since the index was built
+        try:
+            stat = os.stat(self.fn)
+        except OSError:
+            return False
+        return stat.st_size == self.size and abs(stat.st_mtime - self.mtime) < 1e-3
+
+    def seekable(self):
+        # Offsets can only be used to seek in plain and BGZF files
+        return self.compression in [None, 'bgzf']
+
+    def write(self, fn=None):
+        if fn is None:
+            fn = index_path(self.fn)
+        x = {'version': INDEX_VERSION, 'file_type': self.file_type, 'compression': self.compression, 'size': self.size, 'mtime': self.mtime,
+             'n_records': self.n_records, 'checkpoints': self.checkpoints, 'length_hist': sorted(self.length_hist.items())}
+        # Written to a temporary file and renamed, so runs that index the same raw file at the same time do not mix their writes
+        tmp = fn + '.tmp.%d' % os.getpid()
+        with open(tmp, 'w') as fid:
+            json.dump(x, fid)
+        os.rename(tmp, fn)
+
+    def load(self, fn=None):
+        if fn is None:
+            fn = index_path(self.fn)
+        with open(fn) as fid:
+            x = json.load(fid)
+        if x['version'] != INDEX_VERSION:
+            raise ValueError('Unsupported index version in ' + fn)
+        self.file_type = str(x['file_type'])
+        self.compression = x['compression'] and str(x['compression'])
+        self.size = x['size']
+        self.mtime = x['mtime']
+        self.n_records = x['n_records']
+        self.checkpoints = [[int(r), int(o)] for r, o in x['checkpoints']]
+        self.length_hist = dict((int(l), int(c)) for l, c in x['length_hist'])
+        return self
+
+    def locate(self, i):
+        # (offset of the closest indexed record at or before record i, number of records to skip from there)
+        k = bisect_right([r for r, o in self.checkpoints], i) - 1
+        return self.checkpoints[k][1], i - self.checkpoints[k][0]
+
+    def iter_from(self, i):
+        # Generator of records starting at record i
+        offset, skip = self.locate(i)
+        if self.file_type == 'FASTQ':
+            records = util.iter_fsq(self.fn, start=offset)
+        else:
+            records = util.iter_fst(self.fn, start=offset)
+        for record in records:
+            if skip > 0:
+                skip -= 1
+                continue
+            yield record
+
+    def count_records(self, start=0, end=None):
+        # Number of records in [start, end) if both offsets are indexed (or the file ends), otherwise None
+        records = dict((o, r) for r, o in self.checkpoints)
+        records[None] = self.n_records
+        if start not in records or end not in records:
+            return None
+        return records[end] - records[start]
+
+    def chunk_boundaries(self, n_chunks):
+        # Offsets that split the file into n_chunks chunks with about the same number of records
+        boundaries = [0]
+        record_numbers = [r for r, o in self.checkpoints]
+        for i in range(1, n_chunks):
+            k = bisect_right(record_numbers, i*self.n_records // n_chunks) - 1
+            if self.checkpoints[k][1] > boundaries[-1]:
+                boundaries.append(self.checkpoints[k][1])
+        return boundaries
+
+    def lengths(self):
+        # (read lengths, number of reads with each length)
+        x = sorted(self.length_hist.items())
+        return np.array([l for l, c in x]), np.array([c for l, c in x])
+
+    def length_percentile(self, q):
+        # q-th percentile of read length over all reads (linear interpolation, as np.percentile)
+        lengths, counts = self.lengths()
+        cumulative = np.cumsum(counts)
+        rank = q/100.0*(cumulative[-1] - 1)
+        lo = lengths[np.searchsorted(cumulative, int(math.floor(rank)), side='right')]
+        hi = lengths[np.searchsorted(cumulative, int(math.ceil(rank)), side='right')]
+        return lo + (hi - lo)*(rank - math.floor(rank))
+
+
+class ChunkIndexer():
+    # Collects the index of one record-aligned chunk from its record batches (see util.py) as they are read, so that
+    # the pass that processes the chunk also indexes it
+    def __init__(self, every=INDEX_EVERY):
+        self.every = every
+        self.n = 0
+        self.checkpoints = [] # [record, stream position] pairs, relative to the start of the chunk
+        self.length_hist = {}
+
+    def add(self, batch):
+        m = len(batch)
+        # record numbers (within the chunk) of this batch that fall on an index checkpoint
+        first = (-self.n) % self.every
+        for j in range(first, m, self.every):
+            self.checkpoints.append([self.n + j, int(batch.offset + batch.sid_start[j])])
+        counts = np.bincount(batch.seq_lengths())
+        for l in np.flatnonzero(counts):
+            self.length_hist[int(l)] = self.length_hist.get(int(l), 0) + int(counts[l])
+        self.n += m
+
+    def result(self):
+        # (number of records, [[record, stream position], ...], length histogram), as index_chunk
+        return self.n, self.checkpoints, self.length_hist
+
+
+def iter_batches(fn, file_type, start=0, end=None, indexer=None, block_size=util.BLOCK_SIZE):
+    # Generator of the record batches of [start, end) of a raw file, added to indexer (a ChunkIndexer) if given
+    if file_type == 'FASTQ':
+        batches = util.iter_fsq_batches(fn, block_size, start=start, end=end)
+    else:
+        batches = util.iter_fst_batches(fn, block_size, start=start, end=end)
+    for batch in batches:
+        if indexer is not None:
+            indexer.add(batch)
+        yield batch
+
+
+def index_chunk((fn, start, end, file_type, every)):
+    # Indexes one record-aligned chunk of a raw file.  Returns (number of records, [[record, stream position], ...], length histogram),
+    # with stream positions relative to the start of the chunk.  Takes a single tuple argument for use with multiprocessing.
+    indexer = ChunkIndexer(every)
+    with tracing.span('index ' + os.path.basename(fn), 'chunk', {'start': start, 'end': end}):
+        for batch in iter_batches(fn, file_type, start, end, indexer):
+            pass
+    return indexer.result()
+
+
+def merge_index(fn, file_type, chunks, results, save=True):
+    # Builds the index of a raw file from the indexes of its record-aligned chunks (see chunking.plan_chunks), as
+    # returned by index_chunk or ChunkIndexer.result.  The index is written next to the raw file if possible.
+    index = RecordIndex(fn, file_type)
+    if index.compression == 'bgzf':
+        table = bgzf.block_table(fn)
+    for (path, start, end), (n, checkpoints, length_hist) in zip(chunks, results):
+        for r, pos in checkpoints:
+            # convert stream positions to file offsets
+            if index.compression == 'bgzf':
+                offset = bgzf.upos_to_voffset(table, bgzf.voffset_to_upos(table, start) + pos)
+            else:
+                offset = start + pos
+            index.checkpoints.append([index.n_records + r, offset])
+        for l in length_hist:
+            index.length_hist[l] = index.length_hist.get(l, 0) + length_hist[l]
+        index.n_records += n
+    if save:
+        try:
+            index.write()
+        except IOError:
+            util.message('Could not write index ' + index_path(fn))
+    return index
+
+
+def build_index(fn, file_type, chunks, pool=None, every=INDEX_EVERY, save=True):
+    # Builds the index of a raw file in a pass of its own over its record-aligned chunks, in parallel if a pool is given.
+    # Runs that read the raw data anyway index it in that pass instead (ChunkIndexer, merge_index).
+    args = [(path, start, end, file_type, every) for path, start, end in chunks]
+    if pool is not None:
+        results = pool.map(index_chunk, args)
+    else:
+        results = map(index_chunk, args)
+    return merge_index(fn, file_type, chunks, results, save)
+
+
+def load_index(fn):
+    # Returns the index of a raw file if it exists and is up to date, otherwise None
+    if not os.path.isfile(index_path(fn)):
+        return None
+    try:
+        index = RecordIndex(fn).load()
+    except (IOError, OSError, ValueError, KeyError):
+        # OSError if the raw file itself is missing
+        return None
+    if not index.is_fresh():
+        return None
+    return index
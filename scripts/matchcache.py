@@ -0,0 +1,87 @@
+"""
+
+OVERVIEW:
+
+Python module for memoising primer and barcode match results by read prefix.
+
+Amplicon reads are highly redundant at their 5' end, and a primer or barcode search only looks at the first
+w + (longest primer or barcode) - 1 bases of a read (the search width), so reads that share that prefix have the same
+match.  A MatchCache maps the prefix of a read (and whether the read is longer than the search width, which decides
+the match of reads shorter than it) to the match result, so the search is only run for prefixes that have not been
+seen recently.
+
+The cache is bounded: it keeps two generations of at most max_entries prefixes each.  New prefixes go into the recent
+generation; when it is full, it becomes the old generation and the previous old one is dropped.  A prefix found in
+the old generation is moved back into the recent one, so prefixes that keep occurring stay cached (an approximation
+of least-recently-used eviction with plain dict lookups).  Hits and misses are counted for the run statistics.
+
+cache = matchcache.MatchCache(remove_primers.search_width(primers, 35))
+[i,d,p] = remove_primers.find_best_match(seq, primers, 35, 1, cache=cache)
+print(cache.stats())
+
+"""
+
+# Prefixes per generation of a cache
+MAX_ENTRIES = 1 << 16
+
+
+class MatchCache():
+
+    def __init__(self, width, max_entries=MAX_ENTRIES):
+        self.width = width
+        self.max_entries = max_entries
+        self.recent = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, seq):
+        # Prefix of seq that decides its match
+        if len(seq) > self.width:
+            return seq[:self.width] + '+'
+        return seq
+
+    def get(self, key):
+        # Match of key, or None if it is not cached
+        x = self.recent.get(key)
+        if x is None:
+            x = self.old.get(key)
+            if x is None:
+                self.misses += 1
+                return None
+            self.put(key, x)
+        self.hits += 1
+        return x
+
+    def put(self, key, x):
+        # Caches the match of key
+        if len(self.recent) >= self.max_entries:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[key] = x
+
+    def stats(self):
+        # {'hits': lookups found in the cache, 'misses': lookups that were searched}
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def sum_stats(all_stats):
+    # Adds up the cache statistics of several chunks ({cache name: stats})
+    total = {}
+    for stats in all_stats:
+        for name, x in stats.items():
+            if name not in total:
+                total[name] = {'hits': 0, 'misses': 0}
+            total[name]['hits'] += x['hits']
+            total[name]['misses'] += x['misses']
+    return total
+
+
+def hit_rates(all_stats):
+    # {cache name: hits, misses and hit rate} of cache statistics ({cache name: stats}), for the run profile
+    x = {}
+    for name, stats in all_stats.items():
+        lookups = stats['hits'] + stats['misses']
+        x[name] = {'hits': stats['hits'], 'misses': stats['misses'],
+                   'hit_rate': round(float(stats['hits']) / lookups, 4) if lookups else None}
+    return x
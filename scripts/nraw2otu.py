@@ -17,6 +17,8 @@ from string import ascii_lowercase
 import multiprocessing as mp
 import ntpath
 import preprocessing_16S as OTU
+import chunking
+import pipeline
 import Formatting as frmt
 from CommLink import *
 from SummaryParser import *
@@ -32,8 +34,12 @@ parser.add_option("-o", "--output_dir", type="string", dest="output_dir")
 parser.add_option("-p", "--primers_removed", dest="primers_removed", default='False')
 parser.add_option("-b", "--split_by_barcodes", dest="split_by_barcodes", default='False')
 parser.add_option("-m", "--multiple_files", dest="multiple_raw_files", default='False')
+parser.add_option("--pack_intermediates", dest="pack_intermediates", default='True')
 (options, args) = parser.parse_args()
 
+# Per-chunk intermediate files (.sb, .pt, .qt, .lt) are written as compact binary read packs unless disabled (see readpack.py)
+OTU.PACK_INTERMEDIATES = (options.pack_intermediates == 'True')
+
 if( not options.input_dir ):
     parser.error("No data directory specified.")
 
@@ -136,29 +142,22 @@ else:
 
 os.chdir(working_directory)
 
+# One worker pool for all parallel steps of the run, created once (see pipeline.py)
+cpu_count = mp.cpu_count()
+pool = mp.Pool(cpu_count)
 
 # Checkpoint - single or multiple raw files?  If multiple, the assumption is they are demultiplexed, where each raw file corresponds to a single sample's reads.
 if options.multiple_raw_files == 'False':
 
-    # Step 1.1 - get raw data filesize, then split into ~10Mb pieces (100000 lines) if smaller than 100 Mb, or into ~100Mb pieces (1000000 lines) otherwise.  Can optimize this eventually
-    # to split according to the number of cpus.
-    rawfilesize = os.path.getsize(raw_data_file)
-
-    # Step 1.1 - split file into 1000000 line (~100Mb) chunks
-    if(rawfilesize < 2e8):
-        os.system('split -l 100000 ' + raw_data_file)
-    else:
-        os.system('split -l 1000000 ' + raw_data_file)
-
-    # Step 1.2 - get split filenames
-    split_filenames = []
-    for c1 in ascii_lowercase:
-        for c2 in ascii_lowercase:
-            filename = 'x'+c1+c2
-            if(os.path.isfile(filename)):
-                split_filenames.append(filename)
-    if len(split_filenames) == 0:
-        split_filenames = [raw_data_file]
+    # Step 1.1 - plan record-aligned chunks of the raw data (plain, gzip, BGZF or zstd).  The number of chunks is set by the file size and the number of cpus.
+    # Workers read their chunk directly from the raw file, so no copy of the raw data is written (except for gzip/zstd input, which is decompressed once).
+    raw_chunks = chunking.plan_chunks(raw_data_file, raw_file_type, cpu_count=cpu_count)
+
+    # Step 1.2 - read counts and length stats come from the record index of the raw data if there is an up to date one (built by
+    # raw2otu.py while trimming, or while decompressing gzip/zstd input above); it is not built in a pass of its own here.
+
+    # Step 1.3 - name the per-chunk output files
+    split_filenames = ['chunk%04d' % i for i in range(len(raw_chunks))]
     raw_filenames = split_filenames
 
 else:
@@ -188,6 +187,10 @@ else:
         cmd_str = 'cp ' + raw_filenames_orig[i] + ' ' + raw_filenames[i]
         os.system(cmd_str)
     split_filenames = raw_filenames
+    raw_chunks = [(f, 0, None) for f in raw_filenames]
+
+# Raw input chunk of each per-chunk filename, for the first step that reads the raw data
+raw_input = dict(zip(split_filenames, raw_chunks))
 
 
 # Do quality control steps (generate read length histograms etc.)
@@ -196,64 +199,40 @@ try:
     os.system('mkdir ' + QCpath)
 except:
     print("Unable to create quality control directory.  Already exists?")
-QC.read_length_histogram(split_filenames[0], QCpath, raw_file_type)
+QC.read_length_histogram(raw_chunks[0][0], QCpath, raw_file_type)
     
 
+# Step 2 - loop through these split files and launch parallel threads as a function of the number of CPUs
+# Every chunk runs through all of its steps in one worker task, so it does not wait for the other chunks between steps (see pipeline.py).
+stages = []
+inputs = [raw_input[f] for f in split_filenames]
+
 # Check whether samples need to be split by barcodes and primers need to be removed
 if (options.split_by_barcodes == 'True' and options.primers_removed == 'True' and options.multiple_raw_files == 'False'):
-    # Copy the raw file into processed folder and call it trimmed by primers
-    for split_filename in split_filenames:
-        cmd_str = 'cp ' + split_filename + ' ' + split_filename + '.sb.pt'
-        os.system(cmd_str)
-    
-# Step 2 - loop through these split files and launch parallel threads as a function of the number of CPUs
-cpu_count = mp.cpu_count()
+    # Write out (or link) the raw chunks for usearch, named as demultiplexed and trimmed by primers for the steps below
+    stages.append((chunking.link_chunk, '.sb.pt', (), 'write raw chunks'))
 
 # Step 2.1 - demultiplex, i.e. sort by barcode
 if (options.split_by_barcodes == 'False' and options.multiple_raw_files == 'False'):
     mode = summary_obj.attribute_value_16S['BARCODES_MODE']
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.sb' for f in filenames]
-    barcodes_map_vect = [barcodes_map]*len(filenames)
-    mode_vect = [mode]*len(filenames)
-    pool.map(OTU.split_by_barcodes, zip(filenames, newfilenames, barcodes_map_vect, mode_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.sb' for f in split_filenames] 
+    stages.append((OTU.split_by_barcodes, '.sb', (barcodes_map, mode), 'split by barcodes'))
 elif (options.multiple_raw_files == 'True'):
-    # If multiple raw files each corresponding to a sample are provided, rename sequence IDs according to the raw file summary sample IDs provided
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.sb' for f in filenames]
-    pool.map(OTU.replace_seqIDs_for_demultiplexed_files, zip(filenames, newfilenames, sampleID_map))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.sb' for f in split_filenames]
+    # If multiple raw files each corresponding to a sample are provided, rename sequence IDs according to the raw file summary sample IDs provided (added per file below)
+    inputs = split_filenames
 
 # Step 2.2 - remove primers
 if (options.primers_removed == 'False'):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.pt' for f in filenames]
-    primers_vect = [primers_file]*len(filenames)
-    pool.map(OTU.remove_primers, zip(filenames, newfilenames, primers_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.pt' for f in split_filenames] 
+    stages.append((OTU.remove_primers, '.pt', (primers_file, raw_file_type, False), 'remove primers'))
 
 
 # Step 2.3 - trim with quality filter
 if (raw_file_type == "FASTQ"):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.qt' for f in filenames]
-    ascii_vect = [ascii_encoding]*len(filenames)
-
-    pool.map(OTU.trim_quality, zip(filenames, newfilenames, ascii_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.qt' for f in split_filenames] 
+    try:
+        quality = summary_obj.attribute_value_16S['QUALITY_TRIM']
+    except:
+        quality = 25
+    if quality != 'None':
+        stages.append((OTU.trim_quality, '.qt', (ascii_encoding, quality), 'quality trim'))
 
 
 # Step 2.4 - trim to uniform length of 101
@@ -261,32 +240,20 @@ try:
     length = summary_obj.attribute_value_16S['TRIM_LENGTH']
 except:
     length = 101
-pool = mp.Pool(cpu_count)
-filenames = split_filenames
-newfilenames = [f + '.lt' for f in filenames]
-length_vect = [length]*len(filenames)
-ascii_vect = [ascii_encoding]*len(filenames)
-    
 if (raw_file_type == "FASTQ"):
-    pool.map(OTU.trim_length_fastq, zip(filenames, newfilenames, length_vect, ascii_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
+    stages.append((OTU.trim_length_fastq, '.lt', (length, ascii_encoding), 'length trim'))
 else:
-    pool.map(OTU.trim_length_fasta, zip(filenames, newfilenames, length_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
+    stages.append((OTU.trim_length_fasta, '.lt', (length,), 'length trim'))
 
 # Step 2.5 - convert to FASTA format
 if (raw_file_type == "FASTQ"):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.fasta' for f in filenames]
-    pool.map(frmt.fastq2fasta, zip(filenames, newfilenames))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.fasta' for f in split_filenames] 
+    stages.append((frmt.fastq2fasta, '.fasta', (), 'FASTA conversion'))
+
+chains = [list(stages) for f in split_filenames]
+if (options.multiple_raw_files == 'True'):
+    for chain, sampleID in zip(chains, sampleID_map):
+        chain.insert(0, (OTU.replace_seqIDs_for_demultiplexed_files, '.sb', (sampleID,), 'replacing seqIDs with sampleID'))
+split_filenames = pipeline.run_chunks(pool, split_filenames, inputs, chains)
 
 # Step 2.6 - renumber sequences IDs to be consistent across files
 try:
@@ -396,7 +363,7 @@ frmt.convert_to_relative_abundances(OTU_table_gg_classic, OTU_table_gg_classic_r
 QC.sample_read_counts(OTU_table_classic, QCpath)
 
 # Write out number of reads thrown out at each step
-QC.reads_thrown_out_at_each_step(raw_filenames, os.path.join(QCpath, 'processing_summary.txt'))
+QC.reads_thrown_out_at_each_step(raw_filenames, os.path.join(QCpath, 'processing_summary.txt'), raw_chunks)
 
 
 #################################################
@@ -452,6 +419,10 @@ summary_obj.WriteSummaryFile()
 processing_results_dir = '/home/ubuntu/processing_results'
 os.system('cp -r ' + os.path.join(working_directory, dataset_folder) + ' ' + processing_results_dir + '/.')
 
+# Shut down the worker pool of the run
+pool.close()
+pool.join()
+
 '''
 # Transfer to PiCRUST server and wait for results
 cl = CommLink('proc')
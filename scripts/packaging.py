@@ -0,0 +1,240 @@
+"""
+
+OVERVIEW:
+
+Python module for packaging the results of a raw2otu.py run into its results folder and transferring the folder to
+processing_results without copying the data.
+
+Every file is placed by the cheapest method the filesystems allow: a hardlink (same filesystem, no data written), a
+copy-on-write reflink (filesystems that support them, e.g. btrfs and XFS, where a hardlink is not possible), or a
+plain copy as the last resort.  A file that already exists at the destination is replaced, never written through, so a
+linked file in one folder is not changed by packaging another.  Files that are rewritten after packaging (the summary
+file) must be placed with copy=True, because writing to a hardlink changes the original too; files rewritten by
+renaming a new file over them (run_profile.json, trace.json) are simply placed again.  Outputs that a rerun writes in
+place are removed first (see stagecache.release), or given an inode of their own with unshare/unshare_tree, so the
+results packaged by an earlier run do not change.  Inputs that are only read (raw data chunks) can be symlinked with
+link_input.
+
+The manifest (manifest.json in the results folder, or manifest_<amplicon type>.json, see manifest_name) lists every
+file of the folder with its size and MD5 checksum (as checkpoint.py), so a transferred folder can be checked against
+it with verify_manifest.  The 16S and ITS runs of a dataset transfer their results into their own subfolders of the
+dataset's results folder (processing_results/<dataset>_results/<amplicon type>), each with its own manifest, and files
+are placed under a temporary name and renamed over their destination, so two runs placing the same file at once do
+not fail.
+
+methods = packaging.place_files([OTU_table_denovo, OTU_sequences_fasta], dataset_folder)
+packaging.write_manifest(dataset_folder, name=packaging.manifest_name('16S'))
+packaging.place_tree(dataset_folder, os.path.join(processing_results_dir, dataset_folder, '16S'))
+packaging.add_files([profile.profile_file], dataset_folder, 'quality_control', os.path.join(processing_results_dir, dataset_folder, '16S'), packaging.manifest_name('16S'))
+
+"""
+
+import os
+import time
+import json
+import errno
+import fcntl
+import shutil
+import checkpoint
+
+# ioctl that clones the data of one file into another on copy-on-write filesystems (Linux FICLONE)
+FICLONE = 0x40049409
+
+MANIFEST_FILE = 'manifest.json'
+
+# errno values of a hardlink or reflink the filesystem cannot make (different filesystems, not supported, not permitted)
+LINK_ERRORS = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EACCES]
+
+
+def reflink(src, dst):
+    # Copy-on-write clone of src to dst.  Raises IOError/OSError if the filesystem does not support it.
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            except (IOError, OSError):
+                fout.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+def remove_existing(dst):
+    # Removes a file or link at dst, so it is replaced rather than written through
+    if os.path.islink(dst) or os.path.isfile(dst):
+        os.remove(dst)
+
+
+def place_file(src, dst, copy=False):
+    # Places src at dst (a file path, or an existing directory to place it in) by hardlink, reflink or copy, and
+    # returns the method used.  With copy=True the file is always reflinked or copied (never shares its inode).
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return 'none'
+    # placed under a temporary name and renamed over dst, which replaces dst in one step
+    tmp = dst + '.tmp.%d' % os.getpid()
+    remove_existing(tmp)
+    method = 'copy'
+    try:
+        if not copy:
+            try:
+                os.link(src, tmp)
+                method = 'hardlink'
+            except OSError as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+        if method == 'copy':
+            try:
+                reflink(src, tmp)
+                method = 'reflink'
+            except (IOError, OSError) as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+                shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+        # rename leaves both names if dst already was a hardlink of src
+        remove_existing(tmp)
+    except:
+        remove_existing(tmp)
+        raise
+    return method
+
+
+def place_files(filenames, directory, copy=False):
+    # Places the files that exist among filenames in directory.  Returns the number of files placed by each method.
+    methods = {}
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for fn in filenames:
+        if fn is None or not os.path.isfile(fn):
+            continue
+        method = place_file(fn, directory, copy)
+        methods[method] = methods.get(method, 0) + 1
+    return methods
+
+
+def place_tree(src_dir, dst_dir, copy=False):
+    # Places every file under src_dir at the same relative path under dst_dir (as cp -r src_dir dst_dir).  Returns the
+    # number of files placed by each method.
+    methods = {}
+    for root, dirs, files in os.walk(src_dir):
+        out_dir = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        for method, n in place_files([os.path.join(root, fn) for fn in files], out_dir, copy).items():
+            methods[method] = methods.get(method, 0) + n
+    return methods
+
+
+def unshare(filenames):
+    # Gives every file among filenames that is hardlinked elsewhere (e.g. into the packaged results of an earlier run)
+    # an inode of its own, by a reflink or copy renamed over it, so it can be written in place.  Returns the number of
+    # files unshared.
+    n = 0
+    for fn in filenames:
+        if os.path.isfile(fn) and not os.path.islink(fn) and os.stat(fn).st_nlink > 1:
+            tmp = fn + '.unshared.%d' % os.getpid()
+            place_file(fn, tmp, copy=True)
+            os.rename(tmp, fn)
+            n += 1
+    return n
+
+
+def unshare_tree(directory):
+    # unshare for every file under directory
+    n = 0
+    for root, dirs, files in os.walk(directory):
+        n += unshare([os.path.join(root, fn) for fn in files])
+    return n
+
+
+def link_input(src, dst):
+    # Symlinks dst to the absolute path of an input file that is only read (instead of copying it)
+    remove_existing(dst)
+    os.symlink(os.path.abspath(src), dst)
+
+
+def manifest_name(amplicon_type=None):
+    # Filename of the manifest of the results of an amplicon type (or of the whole folder)
+    if amplicon_type is None:
+        return MANIFEST_FILE
+    return 'manifest_' + amplicon_type + '.json'
+
+
+def is_manifest(rel):
+    # Whether a path relative to a results folder is one of its manifests (or a manifest being written)
+    return os.path.dirname(rel) == '' and rel.startswith('manifest') and '.json' in rel
+
+
+def read_manifest(folder, name=MANIFEST_FILE):
+    # Manifest of folder, or None if it has none
+    try:
+        with open(os.path.join(folder, name)) as fid:
+            return json.load(fid)
+    except (IOError, ValueError):
+        return None
+
+
+def manifest_entries(folder, previous=None):
+    # Relative path, size, modification time and MD5 checksum of every file under folder (except the manifests).  Files
+    # that share an inode (hardlinks) are read once, and the checksums of files unchanged since the previous manifest are kept.
+    known = {}
+    for entry in (previous or {}).get('files', []):
+        known[entry['path']] = entry
+    entries = []
+    checksums = {}
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for fn in sorted(files):
+            path = os.path.join(root, fn)
+            rel = os.path.relpath(path, folder)
+            if is_manifest(rel):
+                continue
+            stat = os.stat(path)
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in checksums:
+                old = known.get(rel)
+                if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+                    checksums[inode] = old['md5']
+                else:
+                    checksums[inode] = checkpoint.file_md5(path)
+            entries.append({'path': rel, 'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': checksums[inode]})
+    return entries
+
+
+def write_manifest(folder, info=None, name=MANIFEST_FILE):
+    # Writes the manifest of the files under folder to folder/name and returns it.  Rewriting it after files were added
+    # or replaced only reads those files.
+    previous = read_manifest(folder, name)
+    x = dict(info or {})
+    if info is None and previous is not None:
+        x = dict((key, value) for key, value in previous.items() if key not in ['created', 'files', 'total_bytes'])
+    x['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    x['files'] = manifest_entries(folder, previous)
+    x['total_bytes'] = sum(entry['size'] for entry in x['files'])
+    manifest_file = os.path.join(folder, name)
+    remove_existing(manifest_file + '.tmp')
+    with open(manifest_file + '.tmp', 'w') as fid:
+        json.dump(x, fid, indent=1, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    return x
+
+
+def add_files(filenames, folder, subdir='', transferred_to=None, name=MANIFEST_FILE):
+    # Places files that were written after folder was packaged in folder/subdir and rewrites its manifest (name).  If
+    # the folder was transferred (place_tree) to transferred_to, the files and the new manifest are placed there too.
+    place_files(filenames, os.path.join(folder, subdir))
+    write_manifest(folder, name=name)
+    if transferred_to is not None:
+        place_files([os.path.join(folder, subdir, os.path.basename(fn)) for fn in filenames], os.path.join(transferred_to, subdir))
+        place_files([os.path.join(folder, name)], transferred_to)
+
+
+def verify_manifest(folder, name=MANIFEST_FILE):
+    # Files listed in the manifest (name) of folder that are missing or differ in size or checksum
+    x = read_manifest(folder, name)
+    bad = []
+    for entry in x['files']:
+        path = os.path.join(folder, entry['path'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size'] or checkpoint.file_md5(path) != entry['md5']:
+            bad.append(entry['path'])
+    return bad
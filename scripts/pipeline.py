@@ -0,0 +1,129 @@
+"""
+
+OVERVIEW:
+
+Python module for running the per-chunk processing steps of raw2otu.py on a single worker pool.
+
+The steps of a chunk (demultiplexing, primer removal, quality and length trimming, FASTQ -> FASTA conversion) are
+given as a chain of stages, and every chunk is run through its whole chain by one worker task.  A chunk moves on to
+its next stage as soon as its current stage finishes, instead of waiting for the slowest chunk of every step, and
+the same pool (created once per run) is used for every parallel step of the pipeline.
+
+A stage is a tuple (function, suffix, args, step), where function is one of the pool functions of the pipeline
+(e.g. preprocessing_16S.trim_quality), which is called as function((input, output) + args).  The output filename is
+the input filename plus suffix, and step names the stage in warnings.  A chunk whose output is empty after a stage is
+dropped from the rest of its chain (as QualityControl.remove_empty_files).
+
+With delete_intermediates, the output of a stage is deleted as soon as the next stage of its chain has read it (the
+input of the first stage, e.g. a raw file, is never deleted), so that at most two files per chunk exist at any time.
+The reads of every output are counted before it is deleted, for the read counts of the processing summary.
+
+Chunks are started largest first (map_largest_first), so that the largest chunks do not start last and hold up the
+end of the step; results are still returned in the order of the chunks.
+
+stages = [(OTU.remove_primers, '.pt', (primers_file, 'FASTQ', False), 'remove primers'),
+          (OTU.trim_length_fastq, '.lt', (length, ascii_encoding), 'length trim'),
+          (frmt.fastq2fasta, '.fasta', (), 'FASTA conversion')]
+inputs = [raw_input[f] for f in split_filenames]
+fasta_filenames = pipeline.run_chunks(pool, split_filenames, inputs, [stages]*len(split_filenames))
+
+"""
+
+from __future__ import print_function
+import os, sys
+import time
+import util
+import chunking
+import readpack
+import tracing
+
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+
+def is_empty(fn):
+    # True if fn holds no reads (an empty text file, or a read pack without records)
+    if readpack.is_readpack(fn):
+        return readpack.count_records(fn) == 0
+    return os.stat(fn).st_size == 0
+
+
+def count_records(fn):
+    # Number of reads in fn (a read pack, or a FASTQ/FASTA text file)
+    if readpack.is_readpack(fn):
+        return readpack.count_records(fn)
+    with open(fn) as fid:
+        first = fid.read(1)
+    if first == '>':
+        return sum(len(batch) for batch in util.iter_fst_batches(fn))
+    return util.count_lines(fn) // 4
+
+
+def run_stages((name, data_in, stages, delete_intermediates)):
+    # Runs one chunk through a chain of stages, writing name + suffix after every stage.  data_in is the input of the
+    # first stage (a filename or a raw data chunk (path, start, end)).
+    # Returns (last output filename, None, seconds per step, reads per step), or (None, step, ...) if the chunk was empty
+    # after that step.  Reads are only counted with delete_intermediates.  Takes a single tuple argument for use with multiprocessing.
+    seconds = []
+    records = []
+    first = True
+    with tracing.span(name, 'chunk'):
+        for function, suffix, args, step in stages:
+            name = name + suffix
+            t0 = time.time()
+            with tracing.span(step, 'step', {'output': name}):
+                function((data_in, name) + tuple(args))
+            seconds.append((step, time.time() - t0))
+            empty = is_empty(name)
+            if delete_intermediates:
+                records.append((step, 0 if empty else count_records(name)))
+                if not first and data_in != name:
+                    os.remove(data_in)
+                if empty:
+                    os.remove(name)
+            if empty:
+                return (None, step, seconds, records)
+            data_in = name
+            first = False
+    return (name, None, seconds, records)
+
+
+def run_indexed((function, i, task)):
+    # Runs function(task) and returns (i, result).  Takes a single tuple argument for use with multiprocessing.
+    return (i, function(task))
+
+
+def map_largest_first(pool, function, tasks, sizes):
+    # As pool.map(function, tasks), but the tasks are handed to the workers in order of decreasing size and run as
+    # soon as a worker is free.  Returns the results in the order of tasks.
+    order = sorted(range(len(tasks)), key=lambda i: -sizes[i])
+    results = [None]*len(tasks)
+    for i, result in pool.imap_unordered(run_indexed, [(function, i, tasks[i]) for i in order], chunksize=1):
+        results[i] = result
+    return results
+
+
+def run_chunks(pool, names, inputs, chains, step_seconds=None, delete_intermediates=False, step_records=None):
+    # Runs every chunk through its chain of stages on pool and returns the output filenames of the chunks that are
+    # not empty at the end, in the order of names.  chains holds one list of stages per chunk (their args can differ,
+    # e.g. the sample ID of each raw file), with the same steps for all chunks.
+    # step_seconds (a dict) is given the worker seconds spent in every step, summed over chunks (see profiler.py), and
+    # step_records the reads left after every step (with delete_intermediates).
+    tasks = zip(names, inputs, chains, [delete_intermediates]*len(names))
+    results = map_largest_first(pool, run_stages, tasks, [chunking.chunk_bytes(x) for x in inputs])
+    empty = {}
+    for fn, step, seconds, records in results:
+        if step is not None:
+            empty[step] = empty.get(step, 0) + 1
+        if step_seconds is not None:
+            for s, t in seconds:
+                step_seconds[s] = step_seconds.get(s, 0) + t
+        if step_records is not None:
+            for s, n in records:
+                step_records[s] = step_records.get(s, 0) + n
+    if chains:
+        for function, suffix, args, step in chains[0]:
+            if step in empty:
+                warning("found {} empty files after {} step".format(empty[step], step))
+    return [fn for fn, step, seconds, records in results if fn is not None]
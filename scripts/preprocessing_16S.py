@@ -11,11 +11,26 @@ import numpy as np
 import sys
 import os, sys
 import util
+import chunking
+import readpack
+import remove_primers as RP
+import split_by_barcodes as SB
+import dereplicate as DR
 import Formatting
 from bidict import *
 import pandas as pd
 from collections import defaultdict
 
+# Write the per-chunk intermediate files as read packs (see readpack.py) instead of text FASTQ/FASTA.
+# Stages whose input is a read pack always write a read pack.
+PACK_INTERMEDIATES = False
+
+
+def pack_output(fastx_in):
+    # True if the output of a step reading fastx_in (a filename or a chunk) should be a read pack
+    return PACK_INTERMEDIATES or (isinstance(fastx_in, basestring) and readpack.is_readpack(fastx_in))
+
+
 def length_stats_fastq(fastq_in):
     # Returns full sequence length, and  5th percentile of read length for a 100000 sample from a FASTQ file.
     iter_seq = util.iter_fsq
@@ -32,14 +47,18 @@ def length_stats_fastq(fastq_in):
 
 def trim_quality((fastq_in, fastq_out, ascii_encoding, quality_trim)):
     # Trims to desired quality level
-    str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(quality_trim) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-    os.system(str1)
-    # Check for how many reads were thrown out
-    statinfoIN = os.stat(fastq_in)
-    input_filesize = float(statinfoIN.st_size)
-    statinfoOUT = os.stat(fastq_out)
-    output_filesize = float(statinfoOUT.st_size)
-    percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
+    if readpack.is_readpack(fastq_in):
+        n_in, n_out = readpack.filter_pack(fastq_in, fastq_out, lambda block: readpack.truncate_quality(block, float(quality_trim), int(ascii_encoding)))
+        percent_thrown_out = 100*(1.0 - float(n_out) / max(n_in, 1))
+    else:
+        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(quality_trim) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
+        util.run_cmd(str1)
+        # Check for how many reads were thrown out
+        statinfoIN = os.stat(fastq_in)
+        input_filesize = float(statinfoIN.st_size)
+        statinfoOUT = os.stat(fastq_out)
+        output_filesize = float(statinfoOUT.st_size)
+        percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
     print "[[ Quality trimming ]] Input file: " + fastq_in
     print "[[ Quality trimming ]] Using ASCII base " + str(ascii_encoding) + ", truncated sequences at quality less than " + str(quality_trim)
     print "[[ Quality trimming ]] Threw out " + str(percent_thrown_out) + " % of reads."
@@ -48,14 +67,18 @@ def trim_quality((fastq_in, fastq_out, ascii_encoding, quality_trim)):
 
 def trim_quality_by_expected_errors((fastq_in, fastq_out, ascii_encoding, maxee)):
     # Discards reads with more than maxee expected errors.
-    str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_maxee ' + str(maxee) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-    os.system(str1)
-    # Check for how many reads were thrown out
-    statinfoIN = os.stat(fastq_in)
-    input_filesize = float(statinfoIN.st_size)
-    statinfoOUT = os.stat(fastq_out)
-    output_filesize = float(statinfoOUT.st_size)
-    percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
+    if readpack.is_readpack(fastq_in):
+        n_in, n_out = readpack.filter_pack(fastq_in, fastq_out, lambda block: readpack.filter_expected_errors(block, float(maxee), int(ascii_encoding)))
+        percent_thrown_out = 100*(1.0 - float(n_out) / max(n_in, 1))
+    else:
+        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_maxee ' + str(maxee) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
+        util.run_cmd(str1)
+        # Check for how many reads were thrown out
+        statinfoIN = os.stat(fastq_in)
+        input_filesize = float(statinfoIN.st_size)
+        statinfoOUT = os.stat(fastq_out)
+        output_filesize = float(statinfoOUT.st_size)
+        percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
     print "[[ Quality trimming ]] Input file: " + fastq_in
     print "[[ Quality trimming ]] Using ASCII base " + str(ascii_encoding) + ", discarded reads with more than " + str(maxee) + " expected errors"
     print "[[ Quality trimming ]] Threw out " + str(percent_thrown_out) + " % of reads."
@@ -72,7 +95,7 @@ def trim_quality_deprecated((fastq_in, fastq_out, ascii_encoding)):
         # Trim to Q
         print "[[ Quality trimming ]] Quality trimming with Q=" + str(Q)        
         str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(Q) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
+        util.run_cmd(str1)
         # Check length distribution
         try:
             [full_length, fifthPercentile] = length_stats_fastq(fastq_out)
@@ -87,7 +110,7 @@ def trim_quality_deprecated((fastq_in, fastq_out, ascii_encoding)):
     if (bestQ == 0):
         print "[[ Quality trimming ]] ERROR!!  Could not obtain 95% of reads over 200 base pairs with quality score cut-off of at least 5.  Check sequencing quality of the data.  Proceeding with Q=5..."
         str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(5) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
+        util.run_cmd(str1)
         [new_full_length, fifthPercentile] = length_stats_fastq(fastq_out)
         print "[[ Quality trimming ]] Input file: " + fastq_in
         print "[[ Quality trimming ]] ASCII encoding used: " + str(ascii_encoding)
@@ -99,7 +122,7 @@ def trim_quality_deprecated((fastq_in, fastq_out, ascii_encoding)):
            
     else:
         str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_truncqual ' + str(bestQ) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-        os.system(str1)
+        util.run_cmd(str1)
         print "[[ Quality trimming ]] Input file: " + fastq_in
         print "[[ Quality trimming ]] ASCII encoding used: " + str(ascii_encoding)
         print "[[ Quality trimming ]] Trimmed sequences with quality cut-off of Q = " + str(bestQ) + "."  
@@ -110,83 +133,116 @@ def trim_quality_deprecated((fastq_in, fastq_out, ascii_encoding)):
 
 def trim_length_fasta((fasta_in, fasta_out, length)):
     # Trims FASTA files to uniform length
+    if readpack.is_readpack(fasta_in):
+        readpack.filter_pack(fasta_in, fasta_out, lambda block: readpack.truncate_length(block, int(length), discard_short=False))
+        return
     str1 = '/home/ubuntu/bin/usearch8 -fastx_truncate ' + fasta_in + ' -trunclen ' + str(length) + ' -fastaout ' + fasta_out
-    os.system(str1)
+    util.run_cmd(str1)
 
 def trim_length_fastq((fastq_in, fastq_out, length, ascii_encoding)):
     # Trims FASTQ files to usearch -fastq_chars obio.raw.fsq uniform length and filters by maximum expected error
     # Takes as input the ascii encoding (33 or 64 currently supported)
-    str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_trunclen ' + str(length) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
-    os.system(str1)
-    # Check for how many reads were thrown out
-    statinfoIN = os.stat(fastq_in)
-    input_filesize = float(statinfoIN.st_size)
-    statinfoOUT = os.stat(fastq_out)
-    output_filesize = float(statinfoOUT.st_size)
-    percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
+    if readpack.is_readpack(fastq_in):
+        n_in, n_out = readpack.filter_pack(fastq_in, fastq_out, lambda block: readpack.truncate_length(block, int(length)))
+        percent_thrown_out = 100*(1.0 - float(n_out) / max(n_in, 1))
+    else:
+        str1 = '/home/ubuntu/bin/usearch8 -fastq_filter ' + fastq_in + ' -fastq_trunclen ' + str(length) + ' -fastq_ascii ' + str(ascii_encoding) + ' -fastqout ' + fastq_out
+        util.run_cmd(str1)
+        # Check for how many reads were thrown out
+        statinfoIN = os.stat(fastq_in)
+        input_filesize = float(statinfoIN.st_size)
+        statinfoOUT = os.stat(fastq_out)
+        output_filesize = float(statinfoOUT.st_size)
+        percent_thrown_out = 100*(1.0 - output_filesize / input_filesize)
     print "[[ Length trimming ]] Input file: " + fastq_in
     print "[[ Length trimming ]] Trimmed sequences with length less than " + str(length)
     print "[[ Length trimming ]] Threw out " + str(percent_thrown_out) + " % of reads."
     print "[[ Length trimming ]] Complete."
     return None
  
-def remove_primers((fastq_in, fastq_out, primers_file)):
-    # Remove primers from FASTQ file
+def remove_primers((fastq_in, fastq_out, primers_file, file_type, indels)):
+    # Remove primers from a FASTQ or FASTA file (fastq_in is a filename or a chunk from chunking.plan_chunks)
+    # With indels, primers are matched allowing insertions and deletions (see remove_primers.find_best_match_indels)
     print "[[ Primer trimming ]] ..."
-    os.system('python ~/scripts/1.remove_primers.py -q ' + fastq_in + ' -l ' + primers_file + ' -d 1 -o ' + fastq_out)
+    path, start, end = chunking.as_chunk(fastq_in)
+    [n_keep, n_seqs] = RP.remove_primers(path, fastq_out, RP.read_primers(primers_file), file_type=file_type, max_diff=1, start=start, end=end, pack=pack_output(fastq_in), indels=indels)
+    print "[[ Primer trimming ]] Removed primers " + ("(allowing indels) " if indels else "") + "from " + str(n_keep) + " of " + str(n_seqs) + " sequences."
     print "[[ Primer trimming ]] Complete."
     return None
 
 
 def split_by_barcodes((fastq_in, fastq_out, barcodes_map, mode)):
-    # Split by barcodes
+    # Split by barcodes (fastq_in is a filename or a chunk from chunking.plan_chunks)
     print "[[ Splitting by barcodes ]] ..."
-    os.system('python ~/scripts/2.split_by_barcodes.py -q ' + fastq_in + ' -b ' + barcodes_map + ' -B tab -d 1 --mode ' + mode + ' -o ' + fastq_out)
+    path, start, end = chunking.as_chunk(fastq_in)
+    SB.split_by_barcodes(path, fastq_out, barcodes_map, mode, file_type='FASTQ', barcodes_format='tab', max_diff=1, start=start, end=end, pack=pack_output(fastq_in))
     return None
 
-def split_by_barcodes_FASTQ((fastq_in, fastq_out, barcodes_map, mode)):
-    # Split by barcodes
+def split_by_barcodes_FASTQ((fastq_in, fastq_out, barcodes_map, mode, golay)):
+    # Split by barcodes (fastq_in is a filename or a chunk from chunking.plan_chunks)
+    # With golay, Golay-12 barcodes are error-corrected (see split_by_barcodes.GolayIndex)
     print "[[ Splitting by barcodes ]] ..."
-    os.system('python ~/scripts/2.split_by_barcodes.py -q ' + fastq_in + ' -b ' + barcodes_map + ' -B tab -d 1 --mode ' + mode + ' -o ' + fastq_out)
+    path, start, end = chunking.as_chunk(fastq_in)
+    SB.split_by_barcodes(path, fastq_out, barcodes_map, mode, file_type='FASTQ', barcodes_format='tab', max_diff=1, start=start, end=end, pack=pack_output(fastq_in), golay=golay)
     return None
 
-def split_by_barcodes_FASTA((fasta_in, fasta_out, barcodes_map, mode)):
-    # Split by barcodes
+def split_by_barcodes_FASTA((fasta_in, fasta_out, barcodes_map, mode, golay)):
+    # Split by barcodes (fasta_in is a filename or a chunk from chunking.plan_chunks)
+    # With golay, Golay-12 barcodes are error-corrected (see split_by_barcodes.GolayIndex)
     print "[[ Splitting by barcodes ]] ..."
-    os.system('python ~/scripts/2.split_by_barcodes.py -f ' + fasta_in + ' -b ' + barcodes_map + ' -B tab -d 1 --mode ' + mode + ' -o ' + fasta_out)
+    path, start, end = chunking.as_chunk(fasta_in)
+    SB.split_by_barcodes(path, fasta_out, barcodes_map, mode, file_type='FASTA', barcodes_format='tab', max_diff=1, start=start, end=end, pack=pack_output(fasta_in), golay=golay)
     return None
 
 def replace_seqIDs_for_demultiplexed_files((fastq_in, fastq_out, sampleID)):
     # Relabels all seqIDs with the provided sample ID.  For use when a single raw file has reads only for one sample and this is known.
-    outfile = open(fastq_out, 'w')
+    # fastq_in is a filename or a chunk from chunking.plan_chunks.
+    if PACK_INTERMEDIATES:
+        outfile = readpack.PackWriter(fastq_out, fastq=True)
+        write = outfile.write_record
+    else:
+        outfile = open(fastq_out, 'w')
+        write = lambda record: outfile.write('\n'.join(record) + '\n')
     iter_fsq = util.iter_fsq
+    path, start, end = chunking.as_chunk(fastq_in)
     seq_counter = 0
-    for record in iter_fsq(fastq_in):
+    for record in iter_fsq(path, start=start, end=end):
         sid = record[0][1:] # id
         seq = record[1] # sequence
         record[0] = '@' + sampleID + '_' + str(seq_counter)
-        outfile.write('\n'.join(record) + '\n')
+        write(record)
         seq_counter += 1
     outfile.close()
 
 def replace_seqIDs_for_demultiplexed_files_fasta((fasta_in, fasta_out, sampleID)):
     # Relabels all seqIDs with the provided sample ID.  For use when a single raw file has reads only for one sample and this is known.
-    outfile = open(fasta_out, 'w')
+    # fasta_in is a filename or a chunk from chunking.plan_chunks.
+    if PACK_INTERMEDIATES:
+        outfile = readpack.PackWriter(fasta_out, fastq=False)
+        write = outfile.write_record
+    else:
+        outfile = open(fasta_out, 'w')
+        write = lambda record: outfile.write('\n'.join(record) + '\n')
     iter_fst = util.iter_fst
+    path, start, end = chunking.as_chunk(fasta_in)
     seq_counter = 0
-    for record in iter_fst(fasta_in):
+    for record in iter_fst(path, start=start, end=end):
         sid = record[0][1:] # id
         seq = record[1] # sequence
         record[0] = '>' + sampleID + '_' + str(seq_counter)
-        outfile.write('\n'.join(record) + '\n')
+        write(record)
         seq_counter += 1
     outfile.close()
 
 
-def dereplicate_and_sort(fasta_in, fasta_out, OTU_database, separator, processing_summary_file, min_count):
-    # Dereplicate and sort sequences by size
+def dereplicate_and_sort(fasta_in, fasta_out, OTU_database, separator, processing_summary_file, min_count, counts=None):
+    # Dereplicate and sort sequences by size.  counts (x[seq][sampleID], e.g. from streaming.run_streaming) saves re-reading fasta_in.
     print "[[ Dereplicating and sorting ]] Discarding sequences with fewer than " + str(min_count) + " reads"
-    os.system('python ~/scripts/3.dereplicate.py -f ' + fasta_in + " -s '" + separator + "' -o " + OTU_database + ' -d ' + fasta_out + ' -P ' + processing_summary_file + ' -M ' + str(min_count))
+    if counts is not None:
+        x = counts
+    else:
+        x = DR.dereplicate(fst=fasta_in, sep=separator)
+    DR.write_output(x, map_fn=OTU_database, db_fn=fasta_out, min_size=int(min_count), processing_summary_file=processing_summary_file)
     print "[[ Dereplicating and sorting ]] Complete."
     return None
 
@@ -196,9 +252,9 @@ def remove_chimeras_and_cluster_OTUs(fasta_in, OTU_sequences_fasta, clustering_r
     print "[[ Removing chimeras and clustering OTUs ]] ..."
     max_cluster_diff = 100.0 - float(cluster_percentage)
     if relabel == True:
-        os.system('/home/ubuntu/bin/usearch8 -cluster_otus ' + fasta_in + ' -otus ' + OTU_sequences_fasta + ' -otu_radius_pct ' + str(max_cluster_diff) + ' -sizein -uparseout ' + clustering_results + ' -relabel denovo')
+        util.run_cmd('/home/ubuntu/bin/usearch8 -cluster_otus ' + fasta_in + ' -otus ' + OTU_sequences_fasta + ' -otu_radius_pct ' + str(max_cluster_diff) + ' -sizein -uparseout ' + clustering_results + ' -relabel denovo')
     else:
-        os.system('/home/ubuntu/bin/usearch8 -cluster_otus ' + fasta_in + ' -otus ' + OTU_sequences_fasta + ' -otu_radius_pct ' + str(max_cluster_diff) + ' -sizein -uparseout ' + clustering_results)
+        util.run_cmd('/home/ubuntu/bin/usearch8 -cluster_otus ' + fasta_in + ' -otus ' + OTU_sequences_fasta + ' -otu_radius_pct ' + str(max_cluster_diff) + ' -sizein -uparseout ' + clustering_results)
 
     print "[[ Removing chimeras and clustering OTUs ]] Complete."
     return None
@@ -547,7 +603,7 @@ def RDP_classify(OTU_sequences_fasta, RDP_classifications_file, amplicon_type='1
         cmd_str = 'python ~/scripts/rdp_classify.py ' + OTU_sequences_fasta + ' ' + RDP_classifications_file + ' --gene 16srrna'
     elif amplicon_type == 'ITS':
         cmd_str = 'python ~/scripts/rdp_classify.py ' + OTU_sequences_fasta + ' ' + RDP_classifications_file + ' --gene fungalits_unite'
-    os.system(cmd_str)
+    util.run_cmd(cmd_str, name="RDP classifier")
     return None
 
 
@@ -0,0 +1,128 @@
+"""
+
+OVERVIEW:
+
+Python module for profiling the stages of a raw2otu.py run into a machine-readable run_profile.json.
+
+For every stage the profile records its wall time, the CPU time used by the run (the main process, the workers of
+the run's pool, and the external tools and processes it waited for), the peak resident memory of the main process and
+the pool workers during the stage (and of waited-for children if it grew during the stage), and the records that went
+in and out of the stage when known.  The profile is rewritten after every stage, so it also shows how far a run that
+failed got.  Memory and per-worker CPU time are read from /proc and are left out where it is not available.
+
+profile = profiler.RunProfile(os.path.join(QCpath, 'run_profile.json'), pool=pool, info={'dataset': dataset_ID})
+profile.start('derep')
+OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', processing_summary_file, min_count)
+profile.end('derep', records_in=n_reads, records_out=profiler.count_fasta_records(fasta_dereplicated))
+
+"""
+
+import os
+import json
+import time
+import resource
+import util
+import tracing
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def proc_cpu_seconds(pid):
+    # User + system CPU seconds of a process from /proc, or None
+    try:
+        with open('/proc/%d/stat' % pid) as fid:
+            x = fid.read()
+    except IOError:
+        return None
+    # fields after the command name (which can hold spaces), starting with the state (field 3)
+    x = x[x.rindex(')') + 2:].split()
+    return (int(x[11]) + int(x[12])) / float(CLOCK_TICKS)
+
+
+def proc_peak_rss_mb(pid):
+    # Peak resident memory (VmHWM) of a process in MB from /proc, or None
+    try:
+        with open('/proc/%d/status' % pid) as fid:
+            for line in fid:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_rss(pid):
+    # Resets the peak resident memory of a process to its current value (Linux 4.0 and later)
+    try:
+        with open('/proc/%d/clear_refs' % pid, 'w') as fid:
+            fid.write('5')
+    except IOError:
+        pass
+
+
+def count_fasta_records(fn):
+    # Number of records in a FASTA file, or None if it does not exist
+    if not os.path.isfile(fn):
+        return None
+    return sum(len(batch) for batch in util.iter_fst_batches(fn))
+
+
+class RunProfile():
+
+    def __init__(self, profile_file, pool=None, info=None):
+        self.profile_file = profile_file
+        # pids of the pool workers (the pool does not replace its workers during a run)
+        self.worker_pids = [p.pid for p in pool._pool] if pool is not None else []
+        self.info = dict(info or {})
+        self.start_time = time.time()
+        self.stages = []
+        self.running = {}
+
+    def usage(self):
+        # (CPU seconds of the main process, of waited-for children, of the pool workers, peak RSS in MB of children)
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        workers = [proc_cpu_seconds(pid) for pid in self.worker_pids]
+        return (own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime,
+                sum(t for t in workers if t is not None), children.ru_maxrss / 1024.0)
+
+    def start(self, stage):
+        # Starts timing stage
+        for pid in [os.getpid()] + self.worker_pids:
+            reset_peak_rss(pid)
+        self.running[stage] = (time.time(), self.usage())
+        tracing.begin(stage, 'stage')
+
+    def end(self, stage, records_in=None, records_out=None, **extra):
+        # Records stage (started with start) in the profile and rewrites the profile file.  extra holds any other
+        # values (JSON) to record with it.
+        tracing.end(stage, 'stage')
+        t0, (own0, children0, workers0, children_rss0) = self.running.pop(stage)
+        own, children, workers, children_rss = self.usage()
+        x = {'stage': stage, 'wall_s': round(time.time() - t0, 3),
+             'cpu_s': round((own - own0) + (children - children0) + (workers - workers0), 3),
+             'cpu_main_s': round(own - own0, 3), 'cpu_children_s': round(children - children0, 3), 'cpu_workers_s': round(workers - workers0, 3)}
+        rss = [proc_peak_rss_mb(pid) for pid in [os.getpid()] + self.worker_pids]
+        if children_rss > children_rss0:
+            rss.append(children_rss)
+        rss = [r for r in rss if r is not None]
+        if rss:
+            x['peak_rss_mb'] = round(max(rss), 1)
+        if records_in is not None:
+            x['records_in'] = records_in
+        if records_out is not None:
+            x['records_out'] = records_out
+        x.update(extra)
+        self.stages.append(x)
+        self.save()
+        return x
+
+    def save(self):
+        # Written to a temporary file and renamed, so the profile is never left half written
+        x = dict(self.info)
+        x['started'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time))
+        x['wall_s'] = round(time.time() - self.start_time, 3)
+        x['stages'] = self.stages
+        with open(self.profile_file + '.tmp', 'w') as fid:
+            json.dump(x, fid, indent=1, sort_keys=True)
+        os.rename(self.profile_file + '.tmp', self.profile_file)
@@ -11,17 +11,32 @@ from __future__ import print_function
 from optparse import OptionParser
 import numpy as np
 import os, sys
+import subprocess
 import os.path
 import math
 from string import ascii_lowercase
 import multiprocessing as mp
 import ntpath
 import preprocessing_16S as OTU
+import chunking
+import fqindex
+import readengine
+import matchcache
+import streaming
+import trimsettings
+import pipeline
+import checkpoint
+import stagecache
+import profiler
+import packaging
+import tracing
+import util
 import Formatting as frmt
 from CommLink import *
 from SummaryParser import *
 from Features import *
 import pickle
+import json
 import QualityControl as QC
 
 # Read in arguments for the script
@@ -32,8 +47,23 @@ parser.add_option("-o", "--output_dir", type="string", dest="output_dir")
 parser.add_option("-p", "--primers_removed", dest="primers_removed", default='False')
 parser.add_option("-b", "--split_by_barcodes", dest="split_by_barcodes", default='False')
 parser.add_option("-m", "--multiple_files", dest="multiple_raw_files", default='False')
+parser.add_option("--pack_intermediates", dest="pack_intermediates", default='True')
+parser.add_option("--single_pass", dest="single_pass", default='True')
+parser.add_option("--resume", dest="resume", default='True')
+parser.add_option("--cache_dir", dest="cache_dir", default='/home/ubuntu/stage_cache')
+parser.add_option("--cache_size_gb", dest="cache_size_gb", default='100')
+parser.add_option("-t", "--amplicon_type", dest="amplicon_type", default='')
+parser.add_option("--cpus", dest="cpus", default='')
+parser.add_option("--combined", dest="combined", default='False')
+parser.add_option("--streaming", dest="streaming", default='False')
+parser.add_option("--trace", dest="trace", default='False')
+parser.add_option("--scratch_dir", dest="scratch_dir", default='None')
+parser.add_option("--keep_intermediates", dest="keep_intermediates", default='False')
 (options, args) = parser.parse_args()
 
+# Per-chunk intermediate files (.sb, .pt, .qt, .lt) are written as compact binary read packs unless disabled (see readpack.py)
+OTU.PACK_INTERMEDIATES = (options.pack_intermediates == 'True')
+
 if( not options.input_dir ):
     parser.error("No data directory specified.")
 
@@ -44,8 +74,10 @@ summary_obj = SummaryParser(summary_file)
 summary_obj.ReadSummaryFile()
 dataset_ID = summary_obj.datasetID
 
-# Define amplicon type
-if summary_obj.attribute_value_16S['PROCESSED'] == 'False':
+# Define amplicon type - given by the scheduler (see scheduler.py), otherwise the first one that is not processed yet
+if options.amplicon_type in ['16S', 'ITS']:
+    amplicon_type = options.amplicon_type
+elif summary_obj.attribute_value_16S['PROCESSED'] == 'False':
     amplicon_type = '16S'
 elif summary_obj.attribute_value_ITS['PROCESSED'] == 'False':
     amplicon_type = 'ITS'
@@ -97,58 +129,37 @@ try:
 except:
     min_count = int(10)
 
-# Extract file locations
-if amplicon_type == '16S':
-    primers_file = options.input_dir + '/' + summary_obj.attribute_value_16S['PRIMERS_FILE']
-    barcodes_map = options.input_dir + '/' + summary_obj.attribute_value_16S['BARCODES_MAP']
-    try:
-        raw_data_file = options.input_dir + '/' + summary_obj.attribute_value_16S['RAW_FASTQ_FILE']
-        raw_file_type = 'FASTQ'
-    except:
-        print("No single raw FASTQ file found.  Checking for raw FASTA.")
-        try:
-            raw_data_file = options.input_dir + '/' + summary_obj.attribute_value_16S['RAW_FASTA_FILE']
-            raw_file_type = 'FASTA'
-        except:
-            print("No single raw FASTA file found either.  Checking for multiple files.")
-            try:
-                raw_data_summary_file = os.path.join(options.input_dir, summary_obj.attribute_value_16S['RAW_FASTQ_FILES'])
-                raw_file_type = 'FASTQ'
-            except:
-                print("No filename of multiple raw FASTQs map provided.  Check contents of your raw data and summary file.")
-                try:
-                    raw_data_summary_file = os.path.join(options.input_dir, summary_obj.attribute_value_16S['RAW_FASTA_FILES'])
-                    raw_file_type = 'FASTA'
-                except:
-                    print("No filename of multiple raw FASTAs map provided.  Check contents of your raw data and summary file.")
-                    raise NameError("Unable to retrieve raw sequencing files.")
+# Extract file locations, quality encoding and trimming settings (see trimsettings.py)
+ts = trimsettings.amplicon_settings(summary_obj, amplicon_type, options.input_dir, options.split_by_barcodes, options.primers_removed, options.multiple_raw_files, options.single_pass)
+primers_file = ts['primers_file']
+barcodes_map = ts['barcodes_map']
+raw_data_file = ts['raw_data_file']
+raw_data_summary_file = ts['raw_data_summary_file']
+raw_file_type = ts['raw_file_type']
+
+# Combined mode (set by Master.py when both 16S and ITS are to be processed from the same raw file): the reads of the
+# other amplicon type are trimmed in the same pass over the raw data, then processed by a second raw2otu.py run
+# that starts as soon as they are ready and runs alongside this one
+other_ts = None
+if options.combined == 'True':
+    other_type = {'16S': 'ITS', 'ITS': '16S'}[amplicon_type]
+    other_flags = trimsettings.run_flags(summary_obj, other_type)
+    other_ts = trimsettings.amplicon_settings(summary_obj, other_type, options.input_dir, single_pass=options.single_pass, **other_flags)
+    if options.single_pass != 'True' or options.multiple_raw_files == 'True' or other_ts['raw_data_file'] != raw_data_file:
+        warning("Combined processing needs one raw file shared by 16S and ITS and single-pass processing.  Processing " + amplicon_type + " only.")
+        other_ts = None
+    else:
+        other_working_directory = os.path.join(os.path.dirname(os.path.normpath(working_directory)), dataset_ID + '_proc_' + other_type)
+        os.system('mkdir -p ' + other_working_directory)
+        other_fasta_trimmed = other_working_directory + '/' + dataset_ID + '.raw_trimmed.fasta'
+
+# Streaming mode - trim a single raw file with a reader, workers and a writer connected by bounded queues, and count
+# the reads for dereplication as they are written (see streaming.py)
+streaming_mode = (options.streaming == 'True')
+if streaming_mode and (options.single_pass != 'True' or options.multiple_raw_files == 'True' or other_ts is not None):
+    warning("Streaming mode needs a single raw file, single-pass processing and no combined processing.  Processing chunks instead.")
+    streaming_mode = False
 
-elif amplicon_type == 'ITS':
-    primers_file = options.input_dir + '/' + summary_obj.attribute_value_ITS['PRIMERS_FILE']
-    barcodes_map = options.input_dir + '/' + summary_obj.attribute_value_ITS['BARCODES_MAP']
-    try:
-        raw_data_file = options.input_dir + '/' + summary_obj.attribute_value_ITS['RAW_FASTQ_FILE']
-        raw_file_type = 'FASTQ'
-    except:
-        print("No single raw FASTQ file found.  Checking for raw FASTA.")
-        try:
-            raw_data_file = options.input_dir + '/' + summary_obj.attribute_value_ITS['RAW_FASTA_FILE']
-            raw_file_type = 'FASTA'
-        except:
-            print("No single raw FASTA file found either.  Checking for multiple files.")
-            try:
-                raw_data_summary_file = os.path.join(options.input_dir, summary_obj.attribute_value_ITS['RAW_FASTQ_FILES'])
-                raw_file_type = 'FASTQ'
-            except:
-                print("No filename of multiple raw FASTQs map provided.  Check contents of your raw data and summary file.")
-                raise NameError("Unable to retrieve raw sequencing files.")
-                try:
-                    raw_data_summary_file = os.path.join(options.input_dir, summary_obj.attribute_value_ITS['RAW_FASTA_FILES'])
-                    raw_file_type = 'FASTA'
-                except:
-                    print("No filename of multiple raw FASTAs map provided.  Check contents of your raw data and summary file.")
-                    raise NameError("Unable to retrieve raw sequencing files.")
-    
 
 # Construct output filenames from dataset ID
 fastq_trimmed_qual = working_directory + '/' + dataset_ID + '.raw_trimmed_qual.fastq'
@@ -165,29 +176,8 @@ oligotype_table_filename = working_directory + '/' + dataset_ID + '.otu_table.'
 
 OTU_sequences_fasta = working_directory + '/' + dataset_ID + '.otu_seqs.' + str(int(similarity)) + '.fasta'
 
-# Get ASCII encoding of FASTQ files
-if amplicon_type == '16S':
-    try:
-        encoding = summary_obj.attribute_value_16S['ASCII_ENCODING']
-    except:
-        encoding = ''
-elif amplicon_type == 'ITS':
-    try:
-        encoding = summary_obj.attribute_value_ITS['ASCII_ENCODING']
-    except:
-        encoding = ''
-
-if(encoding == "ASCII_BASE_33"):
-    print("ASCII 33 encoding for quality scores specified.")
-    ascii_encoding = 33
-elif(encoding == "ASCII_BASE_64"):
-    print ("ASCII 64 encoding for quality scores specified.")
-    ascii_encoding = 64
-else:
-    print ("No ASCII encoding specified in the summary file for the quality scores in the FASTQ file.  Using ASCII 33 as default.")
-    warning("No ASCII encoding specified in the summary file for the quality scores in the FASTQ file.  Using ASCII 33 as default.")
-    ascii_encoding = 33
-
+# ASCII encoding of FASTQ files
+ascii_encoding = ts['ascii_encoding']
 
 # Parallel steps:
 #       1. split fastq into chunks
@@ -196,32 +186,57 @@ else:
 
 os.chdir(working_directory)
 
-# Checkpoint - single or multiple raw files?  If multiple, the assumption is they are demultiplexed, where each raw file corresponds to a single sample's reads.
-if options.multiple_raw_files == 'False':
+# Tracing mode - every process of the run records the begin and end of its stages, chunk tasks and external tool calls,
+# exported as a Chrome trace at the end of the run (see tracing.py).  Enabled before the pool is created, so its workers record too.
+trace_directory = os.path.join(working_directory, 'trace')
+if options.trace == 'True':
+    os.system('rm -rf ' + trace_directory)
+    tracing.enable(trace_directory)
+    tracing.process_name('raw2otu.py ' + amplicon_type)
+
+# One worker pool for all parallel steps of the run, created once (see pipeline.py).  Its size is limited by --cpus when
+# several runs share the machine (see scheduler.py).
+cpu_count = mp.cpu_count()
+if options.cpus != '':
+    cpu_count = max(1, min(cpu_count, int(options.cpus)))
+pool = mp.Pool(cpu_count)
 
-    # Step 1.1 - get raw data filesize, then split into ~10Mb pieces (100000 lines) if smaller than 100 Mb, or into ~100Mb pieces (1000000 lines) otherwise.  Can optimize this eventually
-    # to split according to the number of cpus.
-    rawfilesize = os.path.getsize(raw_data_file)
+# Completion manifests of the stages of the run.  A rerun skips the stages that completed with the same inputs and parameters (see checkpoint.py).
+# The chunking stage is checkpointed by the record index of the raw data (see fqindex.py).
+ckpt = checkpoint.Checkpoints(os.path.join(working_directory, 'checkpoints.json'), resume=(options.resume == 'True'))
 
-    # Step 1.1 - split file into 1000000 line (~100Mb) chunks
-    if(rawfilesize < 2e8):
-        os.system('split -l 100000 ' + raw_data_file)
-    else:
-        os.system('split -l 1000000 ' + raw_data_file)
-
-    # Step 1.2 - get split filenames
-    split_filenames = []
-    for c1 in ascii_lowercase:
-        for c2 in ascii_lowercase:
-            filename = 'x'+c1+c2
-            if(os.path.isfile(filename)):
-                split_filenames.append(filename)
-    if len(split_filenames) == 0:
-        split_filenames = [raw_data_file]
-    raw_filenames = split_filenames
+# Cache of stage outputs shared by all runs, keyed by the contents of the stage inputs and its parameters (see stagecache.py).  --cache_dir None disables it.
+cache = stagecache.StageCache(options.cache_dir, max_gb=options.cache_size_gb)
+
+# Quality control folder
+QCpath = os.path.join(working_directory, 'quality_control')
+processing_summary_file = os.path.join(QCpath, 'processing_summary.txt')
+try:
+    os.system('mkdir ' + QCpath)
+except:
+    print("Unable to create quality control directory.  Already exists?")
+# The quality control files of an earlier run are linked into its packaged results, and some are rewritten in place below
+packaging.unshare_tree(QCpath)
+
+# Wall time, CPU time, peak memory and records in and out of every stage, written to the QC folder (see profiler.py)
+profile = profiler.RunProfile(os.path.join(QCpath, 'run_profile.json'), pool=pool,
+                              info={'dataset': dataset_ID, 'amplicon_type': amplicon_type, 'cpus': cpu_count, 'raw_file_type': raw_file_type})
+
+# Per-chunk intermediate files are written to their own directory, on fast scratch storage (e.g. /dev/shm or a local
+# NVMe disk) if --scratch_dir is given, which is removed once the trimmed reads are recombined.  Unless they are to be
+# kept, intermediates are deleted as soon as the next step has read them (see pipeline.py), so only the trimmed reads
+# and later results are written to the working directory.
+delete_intermediates = (options.keep_intermediates != 'True')
+if options.scratch_dir != 'None':
+    chunk_directory = os.path.join(options.scratch_dir, '%s_%s_chunks_%d' % (dataset_ID, amplicon_type, os.getpid()))
+    os.system('mkdir -p ' + chunk_directory)
+else:
+    chunk_directory = working_directory
 
+# Checkpoint - single or multiple raw files?  If multiple, the assumption is they are demultiplexed, where each raw file corresponds to a single sample's reads.
+if options.multiple_raw_files == 'False':
+    raw_data_files = [raw_data_file]
 else:
-    
     # If multiple raw sequence files are provided in a separate summary file, check integrity of the summary file and then extract raw file names.
     print('Reading fastqs from ' + raw_data_summary_file)
     with open(raw_data_summary_file, 'r') as fid:
@@ -242,199 +257,341 @@ else:
 
     raw_filenames_orig = [os.path.join(options.input_dir, line.split('\t')[0]) for line in all_lines if len(line.rstrip('\n')) > 0]
     sampleID_map = [line.split('\t')[1].rstrip('\n') for line in all_lines if len(line.strip('\n')) > 0]
-    raw_filenames = [os.path.join(working_directory,line.split('\t')[0].split('/')[-1]) for line in all_lines if len(line.rstrip('\n')) > 0]
-    for i in range(len(raw_filenames_orig)):
-        cmd_str = 'cp ' + raw_filenames_orig[i] + ' ' + raw_filenames[i]
-        os.system(cmd_str)
-    split_filenames = raw_filenames
+    raw_data_files = raw_filenames_orig
 
+# Barcodes mode, quality filter (truncate at a quality score, or discard reads by max expected errors after length trimming) and trim length
+mode = ts['mode']
+trim_type = ts['trim_type']
+quality = ts['quality']
+maxee = ts['maxee']
+length = ts['length']
+separator = ts['separator']
 
-# Do quality control steps (generate read length histograms etc.)
-QCpath = os.path.join(working_directory, 'quality_control')
-processing_summary_file = os.path.join(QCpath, 'processing_summary.txt')
-try:
-    os.system('mkdir ' + QCpath)
-except:
-    print("Unable to create quality control directory.  Already exists?")
-QC.read_length_histogram(split_filenames[0], QCpath, raw_file_type)
-    
-
-# Check whether samples need to be split by barcodes and primers need to be removed
-if (options.split_by_barcodes == 'True' and options.primers_removed == 'True' and options.multiple_raw_files == 'False'):
-    # Copy the raw file into processed folder and call it trimmed by primers
-    for split_filename in split_filenames:
-        cmd_str = 'cp ' + split_filename + ' ' + split_filename + '.sb.pt'
-        os.system(cmd_str)
-    
-# Step 2 - loop through these split files and launch parallel threads as a function of the number of CPUs
-cpu_count = mp.cpu_count()
+# Stage 'trimming' - steps 2 and 3, from the raw data to fasta_trimmed
+if options.multiple_raw_files == 'False':
+    [trimming_inputs, trimming_params] = trimsettings.trimming_checkpoint(ts)
+else:
+    [trimming_inputs, trimming_params] = trimsettings.trimming_checkpoint(ts, raw_filenames_orig, sampleID_map)
+# The raw data files are identified by their path, size and modification time rather than hashed (see checkpoint.py)
+ckpt.stamp_files(raw_data_files)
+step_counts = None
+attrition = None
+derep_counts = None
+match_stats = None # hits and misses of the primer and barcode match caches (single-pass and streaming processing only, see matchcache.py)
+step_seconds = {}
+step_counts_file = os.path.join(working_directory, dataset_ID + '.step_counts.json')
+# Reads of every sample dropped at every step, and kept, counted while trimming (single-pass and streaming processing only)
+attrition_file = os.path.join(QCpath, 'read_attrition.txt')
+attrition_outputs = [attrition_file] if options.single_pass == 'True' else []
+trimming_outputs = [fasta_trimmed] + attrition_outputs
+trimming_cached = [fasta_trimmed, step_counts_file] + attrition_outputs
+trimming_key = cache.key('trimming', [ckpt.file_hash(f) for f in trimming_inputs], trimming_params)
+# A completed (or cached) trimming stage is found before the raw data is chunked, so a rerun does not read it again
+trimming_done = True
+if ckpt.is_done('trimming', trimming_inputs, trimming_params):
+    step_counts = ckpt.data('trimming')
+elif cache.fetch(trimming_key, trimming_cached):
+    with open(step_counts_file) as fid:
+        step_counts = json.load(fid)
+    ckpt.record('trimming', trimming_inputs, trimming_params, trimming_outputs, data=step_counts)
+else:
+    trimming_done = False
+
+# The raw data is only chunked (and gzip/zstd input decompressed) if trimming is to run
+raw_chunks = []
+raw_filenames = []
+raw_index = None
+index_raw = False # build the record index of the raw file while trimming
+if not trimming_done:
+    profile.start('chunking')
+    if options.multiple_raw_files == 'False':
+
+        # Step 1.1 - plan record-aligned chunks of the raw data (plain, gzip, BGZF or zstd).  The number of chunks is set by the file size and the number of cpus.
+        # Workers read their chunk directly from the raw file, so no copy of the raw data is written (except for gzip/zstd input, which is decompressed once).
+        # gzip/zstd input is decompressed into the working directory instead of the scratch directory if it would not fit there
+        raw_chunk_directory = chunk_directory
+        if chunk_directory != working_directory and chunking.decompressed_bytes(raw_data_file, raw_file_type) > chunking.free_bytes(chunk_directory):
+            print("Not enough free space in " + options.scratch_dir + " to decompress the raw data; writing its chunks to " + working_directory + " instead.")
+            raw_chunk_directory = working_directory
+        raw_chunks = chunking.plan_chunks(raw_data_file, raw_file_type, cpu_count=cpu_count, prefix=os.path.join(raw_chunk_directory, 'rawchunk'))
+
+        # Step 1.2 - the record index of the raw data (offsets, read count, length histogram), if an up to date one exists.  Otherwise
+        # it is built in the trimming pass over the raw chunks below (or was built while decompressing gzip/zstd input).
+        # Later runs on the same raw file (e.g. with new trimming parameters) get their chunks, read counts and length stats from it.
+        raw_index = fqindex.load_index(raw_data_file)
+        index_raw = (raw_index is None and all(f == raw_data_file for f, start, end in raw_chunks))
+
+        # Step 1.3 - name the per-chunk output files
+        split_filenames = [os.path.join(chunk_directory, 'chunk%04d' % i) for i in range(len(raw_chunks))]
+        raw_filenames = split_filenames
 
-# Step 2.1 - demultiplex, i.e. sort by barcode
-if (options.split_by_barcodes == 'False' and options.multiple_raw_files == 'False'):
-    if amplicon_type == '16S':
-        mode = summary_obj.attribute_value_16S['BARCODES_MODE']
-    elif amplicon_type == 'ITS':
-        mode = summary_obj.attribute_value_ITS['BARCODES_MODE']
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.sb' for f in filenames]
-    barcodes_map_vect = [barcodes_map]*len(filenames)
-    mode_vect = [mode]*len(filenames)
-    if raw_file_type == 'FASTQ':
-        pool.map(OTU.split_by_barcodes_FASTQ, zip(filenames, newfilenames, barcodes_map_vect, mode_vect))
-    elif raw_file_type == 'FASTA':
-        pool.map(OTU.split_by_barcodes_FASTA, zip(filenames, newfilenames, barcodes_map_vect, mode_vect))
     else:
-        raise NameError("Can't determine whether the raw file is FASTQ or FASTA.  Check summary file contents.")
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.sb' for f in split_filenames] 
-    split_filenames = QC.remove_empty_files(split_filenames, step='split by barcodes')
-elif (options.multiple_raw_files == 'True'):
-    # If multiple raw files each corresponding to a sample are provided, rename sequence IDs according to the raw file summary sample IDs provided
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.sb' for f in filenames]
-    if raw_file_type == "FASTQ":
-        pool.map(OTU.replace_seqIDs_for_demultiplexed_files, zip(filenames, newfilenames, sampleID_map))
-    elif raw_file_type == "FASTA":
-        pool.map(OTU.replace_seqIDs_for_demultiplexed_files_fasta, zip(filenames, newfilenames, sampleID_map))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.sb' for f in split_filenames]
-    split_filenames = QC.remove_empty_files(split_filenames, step='split by barcodes for multiplex files (replacing seqIDs with sampleID)')
-
-# Step 2.2 - remove primers
-if (options.primers_removed == 'False'):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.pt' for f in filenames]
-    primers_vect = [primers_file]*len(filenames)
-    pool.map(OTU.remove_primers, zip(filenames, newfilenames, primers_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.pt' for f in split_filenames] 
-    split_filenames = QC.remove_empty_files(split_filenames, step='remove primers')
-
-# Step 2.3 - trim with quality filter
-if (raw_file_type == "FASTQ"):
-    trim_type = 'truncqual'
-    if amplicon_type == '16S':
-        try:
-            quality = summary_obj.attribute_value_16S['QUALITY_TRIM']
-        except:
-            try:
-                maxee = summary_obj.attribute_value_16S['MAX_ERRORS']
-                trim_type = 'maxee'
-            except:
-                quality = 25
-    elif amplicon_type == 'ITS':
-        try:
-            quality = summary_obj.attribute_value_ITS['QUALITY_TRIM']
-        except:
-            try:
-                # Note: if max errors is specified, quality filtering is performed
-                # after length trimming
-                maxee = summary_obj.attribute_value_ITS['MAX_ERRORS']
-                trim_type = 'maxee'
-            except:
-                quality = 25
-
-    if trim_type != 'maxee' and quality != 'None':
-        pool = mp.Pool(cpu_count)
-        filenames = split_filenames
-        newfilenames = [f + '.qt' for f in filenames]
-        ascii_vect = [ascii_encoding]*len(filenames)
-        quality_vect = [quality]*len(filenames)
-        pool.map(OTU.trim_quality, zip(filenames, newfilenames, ascii_vect, quality_vect))
-        pool.close()
-        pool.join()
-        split_filenames = [f + '.qt' for f in split_filenames] 
-        split_filenames = QC.remove_empty_files(split_filenames, step='quality trim by truncation')
 
-# Step 2.4 - trim to uniform length
-if amplicon_type == '16S':
-    try:
-        length = summary_obj.attribute_value_16S['TRIM_LENGTH']
-    except:
-        length = 101
-elif amplicon_type == 'ITS':
-    try:
-        length = summary_obj.attribute_value_ITS['TRIM_LENGTH']
-    except:
-        length = 101
+        # The raw files are read where they are.  Raw files larger than the target task size are split into several chunks,
+        # so that one large sample does not hold up the step (see chunking.plan_file_tasks); the outputs of the chunks of a
+        # sample are recombined in order and renumbered together like the chunks of a single raw file.  Per-chunk outputs are
+        # named after their raw file in the chunk directory.
+        file_chunks = chunking.plan_file_tasks(raw_filenames_orig, raw_file_type, cpu_count=cpu_count, prefix=os.path.join(chunk_directory, 'rawchunk'))
+        raw_filenames = []
+        raw_chunks = []
+        chunk_sampleIDs = []
+        for raw_filename, sampleID, chunks in zip(raw_filenames_orig, sampleID_map, file_chunks):
+            for i, chunk in enumerate(chunks):
+                if len(chunks) == 1:
+                    raw_filenames.append(os.path.join(chunk_directory, os.path.basename(raw_filename)))
+                else:
+                    raw_filenames.append(os.path.join(chunk_directory, os.path.basename(raw_filename) + '.part%04d' % i))
+                raw_chunks.append(chunk)
+                chunk_sampleIDs.append(sampleID)
+        split_filenames = raw_filenames
+
+    # Raw input chunk of each per-chunk filename, for the first step that reads the raw data
+    raw_input = dict(zip(split_filenames, raw_chunks))
+    if options.multiple_raw_files == 'False' and raw_index is not None:
+        profile.end('chunking', records_in=raw_index.n_records, records_out=len(raw_chunks))
+    else:
+        profile.end('chunking', records_out=len(raw_chunks))
+
+profile.start('trimming')
+if not trimming_done:
+    if streaming_mode:
+        # Steps 2 and 3 - read, trim and write the reads at the same time, straight into fasta_trimmed
+        [step_counts, attrition, derep_counts, match_stats] = streaming.run_streaming(raw_chunks, trimsettings.engine_settings(ts), fasta_trimmed, separator, n_workers=max(1, cpu_count - 1),
+                                                                                    index_file=raw_data_file if index_raw else None)
+        if index_raw:
+            raw_index = fqindex.load_index(raw_data_file)
+
+    elif options.single_pass == 'True':
+        # Step 2 - demultiplex, remove primers, quality and length trim and convert to FASTA in a single pass over each chunk (see readengine.py)
+        settings_vect = [trimsettings.engine_settings(ts) for f in split_filenames]
+        if (options.multiple_raw_files == 'True'):
+            settings_vect = [trimsettings.engine_settings(ts, sampleID) for sampleID in chunk_sampleIDs]
+        filenames = [raw_input[f] for f in split_filenames]
+        newfilenames = [f + '.fasta' for f in split_filenames]
+        # the largest chunks are started first (see pipeline.py)
+        chunk_sizes = [chunking.chunk_bytes(chunk) for chunk in filenames]
+        if other_ts is not None:
+            # Both amplicon types in the same read pass over each chunk
+            other_newfilenames = [f + '.' + other_type + '.fasta' for f in split_filenames]
+            other_settings_vect = [trimsettings.engine_settings(other_ts) for f in split_filenames]
+            branch_results = pipeline.map_largest_first(pool, readengine.process_chunk_branches, zip(filenames, zip(newfilenames, other_newfilenames), zip(settings_vect, other_settings_vect)), chunk_sizes)
+            chunk_results = [branches[0] + [chunk_index] for branches, chunk_index in branch_results]
+            other_step_counts = readengine.sum_counts([branches[1][0] for branches, chunk_index in branch_results])
+            other_attrition = readengine.sum_attrition([branches[1][1] for branches, chunk_index in branch_results])
+            other_split_filenames = QC.remove_empty_files(other_newfilenames, step='single-pass processing (' + other_type + ')')
+        else:
+            chunk_results = pipeline.map_largest_first(pool, readengine.process_chunk, zip(filenames, newfilenames, settings_vect), chunk_sizes)
+        step_counts = readengine.sum_counts([counts for counts, chunk_attrition, chunk_stats, chunk_index in chunk_results])
+        attrition = readengine.sum_attrition([chunk_attrition for counts, chunk_attrition, chunk_stats, chunk_index in chunk_results])
+        match_stats = matchcache.sum_stats([chunk_stats for counts, chunk_attrition, chunk_stats, chunk_index in chunk_results])
+        if index_raw:
+            # the raw data was indexed in the same pass (see fqindex.py)
+            raw_index = fqindex.merge_index(raw_data_file, raw_file_type, raw_chunks, [chunk_index for counts, chunk_attrition, chunk_stats, chunk_index in chunk_results])
+        split_filenames = QC.remove_empty_files(newfilenames, step='single-pass processing')
+        chunk_outputs = newfilenames
 
-pool = mp.Pool(cpu_count)
-filenames = split_filenames
-filenames = QC.remove_empty_files(filenames)
-newfilenames = [f + '.lt' for f in filenames]
-length_vect = [length]*len(filenames)
-ascii_vect = [ascii_encoding]*len(filenames)
-
-if (raw_file_type == "FASTQ"):
-    pool.map(OTU.trim_length_fastq, zip(filenames, newfilenames, length_vect, ascii_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
-    split_filenames = QC.remove_empty_files(split_filenames, step='length trim')
-
-    # If quality filtering by max expected errors was specified, do the quality
-    # filtering *after* length trimming
-    if trim_type == 'maxee' and maxee != 'None':
-        pool = mp.Pool(cpu_count)
-        filenames = split_filenames
-        newfilenames = [f + '.qt' for f in filenames]
-        ascii_vect = [ascii_encoding]*len(filenames)
-        maxee_vect = [maxee]*len(filenames)
-        pool.map(OTU.trim_quality_by_expected_errors, zip(filenames, newfilenames, ascii_vect, maxee_vect))
+    else:
+        # Steps 2.1 - 2.5 as separate tools, each writing a file per chunk.  Every chunk runs through all of its steps in
+        # one worker task, so it does not wait for the other chunks between steps (see pipeline.py).
+        stages = []
+        inputs = [raw_input[f] for f in split_filenames]
+        # Check whether samples need to be split by barcodes and primers need to be removed
+        if (options.split_by_barcodes == 'True' and options.primers_removed == 'True' and options.multiple_raw_files == 'False'):
+            # Write out (or link) the raw chunks for usearch, named as demultiplexed and trimmed by primers for the steps below
+            stages.append((chunking.link_chunk, '.sb.pt', (), 'write raw chunks'))
+        # Step 2.1 - demultiplex, i.e. sort by barcode
+        if (options.split_by_barcodes == 'False' and options.multiple_raw_files == 'False'):
+            if raw_file_type == 'FASTQ':
+                stages.append((OTU.split_by_barcodes_FASTQ, '.sb', (barcodes_map, mode, ts['barcodes_golay'] == 'True'), 'split by barcodes'))
+            elif raw_file_type == 'FASTA':
+                stages.append((OTU.split_by_barcodes_FASTA, '.sb', (barcodes_map, mode, ts['barcodes_golay'] == 'True'), 'split by barcodes'))
+            else:
+                raise NameError("Can't determine whether the raw file is FASTQ or FASTA.  Check summary file contents.")
+        # If multiple raw files each corresponding to a sample are provided, sequence IDs are renamed according to the raw file summary sample IDs provided (added per chunk below)
+
+        # Step 2.2 - remove primers
+        if (options.primers_removed == 'False'):
+            stages.append((OTU.remove_primers, '.pt', (primers_file, raw_file_type, ts['primer_indels'] == 'True'), 'remove primers'))
+
+        # Step 2.3 - trim with quality filter
+        if (raw_file_type == "FASTQ"):
+            if trim_type != 'maxee' and quality != 'None':
+                stages.append((OTU.trim_quality, '.qt', (ascii_encoding, quality), 'quality trim by truncation'))
+
+        # Step 2.4 - trim to uniform length
+        if (raw_file_type == "FASTQ"):
+            stages.append((OTU.trim_length_fastq, '.lt', (length, ascii_encoding), 'length trim'))
+            # If quality filtering by max expected errors was specified, do the quality
+            # filtering *after* length trimming
+            if trim_type == 'maxee' and maxee != 'None':
+                stages.append((OTU.trim_quality_by_expected_errors, '.qt', (ascii_encoding, maxee), 'quality filtering by expected errors'))
+        else:
+            stages.append((OTU.trim_length_fasta, '.lt', (length,), 'length trim'))
+
+        # Step 2.5 - convert to FASTA format
+        if (raw_file_type == "FASTQ"):
+            stages.append((frmt.fastq2fasta, '.fasta', (), 'FASTA conversion'))
+
+        chains = [list(stages) for f in split_filenames]
+        if (options.multiple_raw_files == 'True'):
+            if raw_file_type == "FASTQ":
+                relabel = OTU.replace_seqIDs_for_demultiplexed_files
+            elif raw_file_type == "FASTA":
+                relabel = OTU.replace_seqIDs_for_demultiplexed_files_fasta
+            for chain, sampleID in zip(chains, chunk_sampleIDs):
+                chain.insert(0, (relabel, '.sb', (sampleID,), 'split by barcodes for multiplex files (replacing seqIDs with sampleID)'))
+        chunk_outputs = []
+        step_records = {}
+        split_filenames = pipeline.run_chunks(pool, split_filenames, inputs, chains, step_seconds=step_seconds, delete_intermediates=delete_intermediates, step_records=step_records)
+        if delete_intermediates:
+            # Reads left after every step, counted before the intermediates were deleted (with the labels of the single-pass read counts)
+            step_labels = {'split by barcodes': 'demultiplexed reads', 'remove primers': 'primer-trimmed reads', 'quality trim by truncation': 'quality-trimmed reads',
+                           'length trim': 'length-trimmed reads', 'quality filtering by expected errors': 'quality-filtered reads', 'FASTA conversion': 'FASTA reads left',
+                           'split by barcodes for multiplex files (replacing seqIDs with sampleID)': 'demultiplexed reads'}
+            if index_raw:
+                # the separate tools read the raw chunks themselves, so the raw reads are counted by indexing the chunks
+                raw_index = fqindex.build_index(raw_data_file, raw_file_type, raw_chunks, pool)
+            if options.multiple_raw_files == 'False' and raw_index is not None:
+                n_raw = raw_index.n_records
+            else:
+                n_raw = sum(QC.chunk_records(chunk, raw_file_type) for chunk in raw_chunks)
+            step_counts = [('raw reads', n_raw)] + [(step_labels.get(step, step), step_records.get(step, 0)) for function, suffix, args, step in chains[0] if step != 'write raw chunks']
+
+    if not streaming_mode:
+        # Step 2.6 - renumber sequences IDs to be consistent across files
+        OTU.renumber_sequences(split_filenames, separator)
+
+
+        # Step 3 - Recombine into a single fasta file
+        if len(split_filenames)>1:
+            cat_str = ['cat']
+            for filename in split_filenames:
+                cat_str.append(filename)
+            cat_str = ' '.join(cat_str)
+            cat_str = cat_str + ' > ' + fasta_trimmed    
+            # Recombine
+            os.system(cat_str)
+        else:
+            packaging.place_file(split_filenames[0], fasta_trimmed)
+        if delete_intermediates:
+            # including the chunks that came out empty
+            for filename in set(split_filenames + chunk_outputs):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    # Do quality control steps (generate read length histograms etc.), from the record index built while trimming if there is one
+    QC.read_length_histogram(raw_data_file if raw_index is not None else raw_chunks[0][0], QCpath, raw_file_type)
+
+    with open(step_counts_file, 'w') as fid:
+        json.dump(step_counts, fid)
+    if attrition is not None:
+        QC.write_attrition_table(attrition, attrition_file, [label for label, n in step_counts])
+    cache.store(trimming_key, trimming_cached)
+    ckpt.record('trimming', trimming_inputs, trimming_params, trimming_outputs, data=step_counts)
+
+    if other_ts is not None and options.single_pass == 'True':
+        # Recombine the reads of the other amplicon type and record them as the completed trimming stage of its run
+        OTU.renumber_sequences(other_split_filenames, other_ts['separator'])
+        other_step_counts_file = os.path.join(other_working_directory, dataset_ID + '.step_counts.json')
+        other_attrition_file = os.path.join(other_working_directory, 'quality_control', 'read_attrition.txt')
+        # written anew rather than through links to the cache entry of an earlier run
+        cache.release([other_fasta_trimmed, other_step_counts_file, other_attrition_file])
+        if len(other_split_filenames) > 0:
+            os.system('cat ' + ' '.join(other_split_filenames) + ' > ' + other_fasta_trimmed)
+        else:
+            open(other_fasta_trimmed, 'w').close()
+        if delete_intermediates:
+            for filename in other_newfilenames:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        [other_inputs, other_params] = trimsettings.trimming_checkpoint(other_ts)
+        other_ckpt = checkpoint.Checkpoints(os.path.join(other_working_directory, 'checkpoints.json'))
+        other_ckpt.stamp_files(raw_data_files)
+        with open(other_step_counts_file, 'w') as fid:
+            json.dump(other_step_counts, fid)
+        os.system('mkdir -p ' + os.path.join(other_working_directory, 'quality_control'))
+        QC.write_attrition_table(other_attrition, other_attrition_file, [label for label, n in other_step_counts])
+        # the read length histogram is of the same raw data, and the other run does not read it
+        packaging.place_files([os.path.join(QCpath, 'read_lengths_distribution.png')], os.path.join(other_working_directory, 'quality_control'))
+        cache.store(cache.key('trimming', [other_ckpt.file_hash(f) for f in other_inputs], other_params), [other_fasta_trimmed, other_step_counts_file, other_attrition_file])
+        other_ckpt.record('trimming', other_inputs, other_params, [other_fasta_trimmed, other_attrition_file], data=other_step_counts)
+
+# Remove what is left of the per-chunk files: the decompressed raw chunks and the scratch directory
+if delete_intermediates:
+    for filename in set(f for f, start, end in raw_chunks if f not in raw_data_files):
+        if os.path.exists(filename):
+            os.remove(filename)
+    if options.scratch_dir != 'None':
+        os.system('rm -rf ' + chunk_directory)
+
+# Reads in and out of trimming (not counted by separate-tool processing with --keep_intermediates True)
+n_reads_raw = step_counts[0][1] if step_counts else None
+n_reads_trimmed = step_counts[-1][1] if step_counts else None
+match_cache = {}
+if match_stats:
+    match_cache = matchcache.hit_rates(match_stats)
+    for name, x in sorted(match_cache.items()):
+        print("Match cache (" + name + "): " + str(x['hits']) + " hits, " + str(x['misses']) + " misses, hit rate " + str(x['hit_rate']))
+profile.end('trimming', records_in=n_reads_raw, records_out=n_reads_trimmed, worker_step_s=dict((k, round(v, 3)) for k, v in step_seconds.items()),
+            match_cache=match_cache)
+
+# Combined mode - process the other amplicon type (from its trimmed reads on) alongside this one
+other_process = None
+if other_ts is not None:
+    # The cpus of the run are split between the two runs: the other run gets half of them and this run's pool (idle from
+    # here on) is shrunk to the rest, so together they use the cpus the run was given
+    other_cpus = max(1, cpu_count // 2)
+    if cpu_count > 1:
         pool.close()
         pool.join()
-        split_filenames = [f + '.qt' for f in split_filenames] 
-        split_filenames = QC.remove_empty_files(split_filenames, step='quality filtering by expected errors')
-
-else:
-    pool.map(OTU.trim_length_fasta, zip(filenames, newfilenames, length_vect))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.lt' for f in split_filenames] 
-    split_filenames = QC.remove_empty_files(split_filenames, step='length trim')
-
-# Step 2.5 - convert to FASTA format
-if (raw_file_type == "FASTQ"):
-    pool = mp.Pool(cpu_count)
-    filenames = split_filenames
-    newfilenames = [f + '.fasta' for f in filenames]
-    pool.map(frmt.fastq2fasta, zip(filenames, newfilenames))
-    pool.close()
-    pool.join()
-    split_filenames = [f + '.fasta' for f in split_filenames] 
-
-# Step 2.6 - renumber sequences IDs to be consistent across files
-try:
-    separator = summary_obj.attribute_value_16S['BARCODES_SEPARATOR']
-except:
-    separator = '_'
-OTU.renumber_sequences(split_filenames, separator)
-
-
-# Step 3 - Recombine into a single fasta file
-if len(split_filenames)>1:
-    cat_str = ['cat']
-    for filename in split_filenames:
-        cat_str.append(filename)
-    cat_str = ' '.join(cat_str)
-    cat_str = cat_str + ' > ' + fasta_trimmed    
-    # Recombine
-    os.system(cat_str)
-else:
-    os.system('cp ' + split_filenames[0] + ' ' + fasta_trimmed)
-
-
-# Dereplicate sequences into a list of uniques for clustering
-OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', processing_summary_file, min_count)
-
-# Remove chimeras and cluster OTUs
-OTU.remove_chimeras_and_cluster_OTUs(fasta_dereplicated, OTU_sequences_fasta, OTU_clustering_results, relabel=True, cluster_percentage=similarity)
+        cpu_count = cpu_count - other_cpus
+        pool = mp.Pool(cpu_count)
+        profile.worker_pids = [p.pid for p in pool._pool]
+    other_cmd = [sys.executable, os.path.abspath(__file__), '-i', options.input_dir, '-o', other_working_directory, '-t', other_type,
+                 '-m', other_flags['multiple_raw_files'], '-p', other_flags['primers_removed'], '-b', other_flags['split_by_barcodes'],
+                 '--single_pass', options.single_pass, '--pack_intermediates', options.pack_intermediates, '--resume', options.resume,
+                 '--cache_dir', options.cache_dir, '--cache_size_gb', options.cache_size_gb, '--cpus', str(other_cpus)]
+    print("Combined processing - starting " + other_type + " processing: " + ' '.join(other_cmd))
+    other_process = subprocess.Popen(other_cmd)
+
+
+# Stage 'derep' - dereplicate sequences into a list of uniques for clustering
+profile.start('derep')
+derep_params = {'min_count': min_count}
+# The reads thrown out during dereplication, which start the processing summary, are kept with the checkpoint and the
+# cached outputs of the stage, so that the processing summary is complete when the stage is skipped
+derep_summary_file = os.path.join(working_directory, dataset_ID + '.derep_summary.txt')
+derep_summary = None
+if ckpt.is_done('derep', [fasta_trimmed], derep_params):
+    derep_summary = ckpt.data('derep')
+if derep_summary is None:
+    derep_key = cache.key('derep', [ckpt.file_hash(fasta_trimmed)], derep_params)
+    if not cache.fetch(derep_key, [fasta_dereplicated, dereplication_map, derep_summary_file]):
+        # Streaming mode counted the reads of every sequence while writing fasta_trimmed
+        OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', derep_summary_file, min_count, counts=derep_counts)
+        derep_counts = None
+        cache.store(derep_key, [fasta_dereplicated, dereplication_map, derep_summary_file])
+    with open(derep_summary_file) as fid:
+        derep_summary = fid.read()
+    ckpt.record('derep', [fasta_trimmed], derep_params, [fasta_dereplicated, dereplication_map], data=derep_summary)
+# written anew rather than in place, as it may be linked into the packaged results of an earlier run (see packaging.py)
+cache.release([processing_summary_file])
+with open(processing_summary_file, 'w') as fid:
+    fid.write(derep_summary)
+n_uniques = profiler.count_fasta_records(fasta_dereplicated)
+profile.end('derep', records_in=n_reads_trimmed, records_out=n_uniques)
+
+# Stage 'clustering' - remove chimeras and cluster OTUs
+profile.start('clustering')
+clustering_params = {'similarity': similarity}
+if not ckpt.is_done('clustering', [fasta_dereplicated], clustering_params):
+    clustering_key = cache.key('clustering', [ckpt.file_hash(fasta_dereplicated)], clustering_params)
+    if not cache.fetch(clustering_key, [OTU_sequences_fasta, OTU_clustering_results]):
+        OTU.remove_chimeras_and_cluster_OTUs(fasta_dereplicated, OTU_sequences_fasta, OTU_clustering_results, relabel=True, cluster_percentage=similarity)
+        cache.store(clustering_key, [OTU_sequences_fasta, OTU_clustering_results])
+    ckpt.record('clustering', [fasta_dereplicated], clustering_params, [OTU_sequences_fasta, OTU_clustering_results])
+n_OTUs = profiler.count_fasta_records(OTU_sequences_fasta)
+profile.end('clustering', records_in=n_uniques, records_out=n_OTUs)
 
 
 ############################
@@ -443,17 +600,22 @@ OTU.remove_chimeras_and_cluster_OTUs(fasta_dereplicated, OTU_sequences_fasta, OT
 #
 ############################
 
-# Build de novo oligotype table - annotate sequences as 'OTU_ID.oligotype_ID' and compute counts for each oligotype
-OTU.compute_oligotype_table(fasta_trimmed, fasta_dereplicated, OTU_clustering_results, '_', oligotype_table_filename)
+# Stage 'oligotypes' - build de novo oligotype table - annotate sequences as 'OTU_ID.oligotype_ID' and compute counts for each oligotype,
+# and the completely de novo OTU table
+profile.start('oligotypes')
+oligotypes_inputs = [fasta_trimmed, fasta_dereplicated, OTU_clustering_results]
+if not ckpt.is_done('oligotypes', oligotypes_inputs, {}):
+    # written anew rather than in place, as they may be linked into the packaged results of an earlier run
+    cache.release([oligotype_table_filename, OTU_table_denovo])
+    OTU.compute_oligotype_table(fasta_trimmed, fasta_dereplicated, OTU_clustering_results, '_', oligotype_table_filename)
+    OTU.collapse_oligotypes(oligotype_table_filename, OTU_table_denovo)
+    ckpt.record('oligotypes', oligotypes_inputs, {}, [oligotype_table_filename, OTU_table_denovo])
+profile.end('oligotypes', records_in=n_reads_trimmed)
 
 open_reference_OTU_tables = []
 closed_reference_OTU_tables = []
 
 
-# Completely de novo OTU table
-OTU.collapse_oligotypes(oligotype_table_filename, OTU_table_denovo)
-
-
 # Check if GreenGenes alignment is desired.  Default is yes.
 try:
     if amplicon_type == '16S':
@@ -465,7 +627,13 @@ except:
         DB_align = 'True'
     elif amplicon_type == 'ITS':
         DB_align = 'True'
-if DB_align == 'True':
+# Stage 'alignment' - GreenGenes (16S) or UNITE (ITS) reference tables
+profile.start('alignment')
+alignment_inputs = [fasta_trimmed, fasta_dereplicated, dereplication_map]
+alignment_params = {'amplicon_type': amplicon_type, 'similarity': similarity}
+if DB_align == 'True' and ckpt.is_done('alignment', alignment_inputs, alignment_params):
+    [open_reference_OTU_tables, closed_reference_OTU_tables] = ckpt.data('alignment')
+elif DB_align == 'True':
     try:
 
         #########################################
@@ -481,7 +649,10 @@ if DB_align == 'True':
             if not os.path.isfile(GG_database_to_use):
                 raise NameError('Percent similarity ID (' + str(similarity) + '%) does not have a matching GG database.  This will break downstream steps.')
             cmd_str = '/home/ubuntu/bin/usearch8 -usearch_global ' + fasta_dereplicated + ' -db ' + GG_database_to_use + ' -strand both -id ' + str(similarity_float) + ' -alnout ' + alignment_results + ' -uc ' + uc_results + ' -maxaccepts 10'
-            os.system(cmd_str)
+            uc_key = cache.key('usearch_global', [ckpt.file_hash(fasta_dereplicated)], {'db': GG_database_to_use, 'id': similarity_float})
+            if not cache.fetch(uc_key, [alignment_results, uc_results]):
+                util.run_cmd(cmd_str)
+                cache.store(uc_key, [alignment_results, uc_results])
 
             # Extract alignment dictionary for up to 10 top alignments
             OTU_GG_dict = OTU.parse_multihit_alignment(uc_results)
@@ -518,12 +689,14 @@ if DB_align == 'True':
                 new_dict = OTU.collapse_alignment_dict(OTU_GG_dict, i)
                 OTU_table = os.path.join(working_directory, summary_obj.datasetID + '.otu_table.' +  str(int(similarity)) + '.gg.consensus' + str(i) + '.tmp')
                 OTU_table_classic = OTU_table.rstrip('.tmp')
+                cache.release([OTU_table, OTU_table_classic])
                 OTU.build_OTU_table_from_alignments(dereplication_map, new_dict, OTU_table)
                 frmt.convert_OTU_to_classic_dense_format(OTU_table, OTU_table_classic)
                 closed_reference_OTU_tables.append(OTU_table_classic)
                 # Concatenate GG tables and denovo table
                 if os.path.isfile(denovo_reads_fasta) and extra_reads == True:
                     open_reference_OTU_table = OTU_table_classic + '.open_ref'
+                    cache.release([open_reference_OTU_table])
                     OTU.concatenate_OTU_tables(OTU_table_classic, denovo_only_otu_table, open_reference_OTU_table)
                     open_reference_OTU_tables.append(open_reference_OTU_table)
             
@@ -536,7 +709,10 @@ if DB_align == 'True':
             if not os.path.isfile(UNITE_database):
                 raise NameError('Cannot find UNITE database at location ' + UNITE_database)
             cmd_str = '/home/ubuntu/bin/usearch8 -usearch_global ' + fasta_dereplicated + ' -db ' + UNITE_database + ' -strand both -id ' + str(similarity_float) + ' -alnout ' + alignment_results + ' -uc ' + uc_results + ' -maxaccepts 10'
-            os.system(cmd_str)
+            uc_key = cache.key('usearch_global', [ckpt.file_hash(fasta_dereplicated)], {'db': UNITE_database, 'id': similarity_float})
+            if not cache.fetch(uc_key, [alignment_results, uc_results]):
+                util.run_cmd(cmd_str)
+                cache.store(uc_key, [alignment_results, uc_results])
 
             # Extract alignment dictionary for up to 10 top alignments
             OTU_UNITE_dict = OTU.parse_multihit_alignment(uc_results)
@@ -566,46 +742,69 @@ if DB_align == 'True':
                 new_dict = OTU.collapse_alignment_dict(OTU_UNITE_dict, i, db='UNITE')
                 OTU_table = os.path.join(working_directory, summary_obj.datasetID + '.otu_table.' +  str(int(similarity)) + '.UNITE.consensus' + str(i) + '.tmp')
                 OTU_table_classic = OTU_table.rstrip('.tmp')
+                cache.release([OTU_table, OTU_table_classic])
                 OTU.build_OTU_table_from_alignments(dereplication_map, new_dict, OTU_table)
                 frmt.convert_OTU_to_classic_dense_format(OTU_table, OTU_table_classic)
                 closed_reference_OTU_tables.append(OTU_table_classic)
                 # Concatenate UNITE tables and denovo table
                 if os.path.isfile(denovo_reads_fasta) and extra_reads == True:
                     open_reference_OTU_table = OTU_table_classic + '.open_ref'
+                    cache.release([open_reference_OTU_table])
                     OTU.concatenate_OTU_tables(OTU_table_classic, denovo_only_otu_table, open_reference_OTU_table)
                     open_reference_OTU_tables.append(open_reference_OTU_table)
-            
-    except:
+
+        ckpt.record('alignment', alignment_inputs, alignment_params, open_reference_OTU_tables + closed_reference_OTU_tables,
+                    data=[open_reference_OTU_tables, closed_reference_OTU_tables])
+
+    except Exception as e:
         print("Failed to create closed-reference table with GreenGenes.  Perhaps the OTU similarity cut-off has no corresponding GreenGenes database?")
+        warning("alignment stage failed: " + str(e))
+        ckpt.invalidate('alignment')
+profile.end('alignment', records_in=n_uniques, tables=len(open_reference_OTU_tables) + len(closed_reference_OTU_tables))
 
-try:
+################################################
+# Ribosomal Database Project (RDP) assignments #
+################################################
 
-    ################################################
-    # Ribosomal Database Project (RDP) assignments #
-    ################################################
-
-    # Get RDP cutoff from summary file
-    if amplicon_type == "16S":
-        try:
-            RDP_cutoff = summary_obj.attribute_value_16S['RDP_CUTOFF']
-        except:
-            RDP_cutoff = 0.5
-    elif amplicon_type == "ITS":
-        try:
-            RDP_cutoff = summary_obj.attribute_value_ITS['RDP_CUTOFF']
-        except:
-            RDP_cutoff = 0.5
-
-    # Obtain RDP classifications on the denovo OTU sequences
-    RDP_classifications = os.path.join(working_directory, 'RDP_classifications.txt')
-    OTU.RDP_classify(OTU_sequences_fasta, RDP_classifications, amplicon_type=amplicon_type)
-    
-    RDP_assignments = OTU.parse_RDP_classifications(RDP_classifications, RDP_cutoff)
-    OTU.relabel_denovo_OTUs_with_RDP(OTU_table_denovo, RDP_assignments)
+# Get RDP cutoff from summary file
+if amplicon_type == "16S":
+    try:
+        RDP_cutoff = summary_obj.attribute_value_16S['RDP_CUTOFF']
+    except:
+        RDP_cutoff = 0.5
+elif amplicon_type == "ITS":
+    try:
+        RDP_cutoff = summary_obj.attribute_value_ITS['RDP_CUTOFF']
+    except:
+        RDP_cutoff = 0.5
+
+# Stage 'RDP' - RDP classifications of the denovo OTU sequences, and the denovo OTU table relabeled with them
+profile.start('RDP')
+RDP_classifications = os.path.join(working_directory, 'RDP_classifications.txt')
+RDP_inputs = [OTU_sequences_fasta, OTU_table_denovo]
+RDP_params = {'amplicon_type': amplicon_type, 'RDP_cutoff': RDP_cutoff}
+if ckpt.is_done('RDP', RDP_inputs, RDP_params):
     OTU_table_denovo_RDP = OTU_table_denovo + '.rdp_assigned'
     closed_reference_OTU_tables.append(OTU_table_denovo_RDP)
-except:
-    print("Failed to create closed-reference table from RDP.")
+else:
+    try:
+        # Classifications do not depend on the cutoff, so a new RDP_CUTOFF only reruns the assignments
+        RDP_key = cache.key('RDP_classify', [ckpt.file_hash(OTU_sequences_fasta)], {'amplicon_type': amplicon_type})
+        if not cache.fetch(RDP_key, [RDP_classifications]):
+            OTU.RDP_classify(OTU_sequences_fasta, RDP_classifications, amplicon_type=amplicon_type)
+            cache.store(RDP_key, [RDP_classifications])
+
+        RDP_assignments = OTU.parse_RDP_classifications(RDP_classifications, RDP_cutoff)
+        cache.release([OTU_table_denovo + '.rdp_assigned'])
+        OTU.relabel_denovo_OTUs_with_RDP(OTU_table_denovo, RDP_assignments)
+        OTU_table_denovo_RDP = OTU_table_denovo + '.rdp_assigned'
+        closed_reference_OTU_tables.append(OTU_table_denovo_RDP)
+        ckpt.record('RDP', RDP_inputs, RDP_params, [RDP_classifications, OTU_table_denovo_RDP])
+    except Exception as e:
+        print("Failed to create closed-reference table from RDP.")
+        warning("RDP stage failed: " + str(e))
+        ckpt.invalidate('RDP')
+profile.end('RDP', records_in=n_OTUs)
 
 
 ##################
@@ -618,7 +817,10 @@ except:
 QC.sample_read_counts(OTU_table_denovo, QCpath)
 
 # Write out number of reads thrown out at each step
-QC.reads_thrown_out_at_each_step(raw_filenames, processing_summary_file)
+if step_counts is not None:
+    QC.write_step_counts(step_counts, processing_summary_file)
+elif raw_chunks:
+    QC.reads_thrown_out_at_each_step(raw_filenames, processing_summary_file, raw_chunks)
 
 
 #################################################
@@ -627,7 +829,12 @@ QC.reads_thrown_out_at_each_step(raw_filenames, processing_summary_file)
 #
 #################################################
 
+profile.start('packaging')
 dataset_folder = dataset_ID + '_results'
+# The 16S and ITS results of a dataset are transferred into their own subfolders of its results folder, as both runs
+# write files of the same names (summary file, quality control, OTU tables)
+processing_results_dir = '/home/ubuntu/processing_results'
+results_directory = os.path.join(processing_results_dir, dataset_folder, amplicon_type)
 try:
     os.system('mkdir ' + dataset_folder)
     if amplicon_type == '16S':
@@ -639,45 +846,46 @@ try:
 except:
     print('Results directory already exists.  Overwriting its contents.')
 
-os.system('cp -r ' + QCpath + ' ' + dataset_folder + '/.')
+# Results are hardlinked into the results folder (reflinked or copied where that is not possible), see packaging.py
+packaged = {}
+def package(filenames, directory=dataset_folder, copy=False):
+    for method, n in packaging.place_files(filenames, directory, copy).items():
+        packaged[method] = packaged.get(method, 0) + n
+
+for method, n in packaging.place_tree(QCpath, os.path.join(dataset_folder, 'quality_control')).items():
+    packaged[method] = packaged.get(method, 0) + n
 
 # Denovo
-os.system('cp ' + OTU_table_denovo + ' ' + dataset_folder + '/.')
+package([OTU_table_denovo])
 
 # Oligotypes
-os.system('cp ' + oligotype_table_filename + ' ' + dataset_folder + '/.')
+package([oligotype_table_filename])
 
 # Open ref
-try:
-    for open_ref_table in open_reference_OTU_tables:
-        if 'gg' in open_ref_table.split('.'):
-            os.system('cp ' + open_ref_table + ' ' + dataset_folder + '/GG')
-        elif 'UNITE' in open_ref_table.split('.'):
-            os.system('cp ' + open_ref_table + ' ' + dataset_folder + '/UNITE')
-except:
-    pass
+for open_ref_table in open_reference_OTU_tables:
+    if 'gg' in open_ref_table.split('.'):
+        package([open_ref_table], dataset_folder + '/GG')
+    elif 'UNITE' in open_ref_table.split('.'):
+        package([open_ref_table], dataset_folder + '/UNITE')
 
 # Closed ref
-try:
-    for closed_ref_table in closed_reference_OTU_tables:
-        if 'gg' in closed_ref_table.split('.'):
-            os.system('cp ' + closed_ref_table + ' '  + dataset_folder + '/GG')
-        elif 'UNITE' in closed_ref_table.split('.'):
-            os.system('cp ' + closed_ref_table + ' '  + dataset_folder + '/UNITE')
-        elif 'rdp_assigned' in closed_ref_table.split('.'):
-            os.system('cp ' + closed_ref_table + ' ' + dataset_folder + '/RDP')
-except:
-    pass
+for closed_ref_table in closed_reference_OTU_tables:
+    if 'gg' in closed_ref_table.split('.'):
+        package([closed_ref_table], dataset_folder + '/GG')
+    elif 'UNITE' in closed_ref_table.split('.'):
+        package([closed_ref_table], dataset_folder + '/UNITE')
+    elif 'rdp_assigned' in closed_ref_table.split('.'):
+        package([closed_ref_table], dataset_folder + '/RDP')
 
 # OTU sequences
-os.system('cp ' + OTU_sequences_fasta + ' ' + dataset_folder + '/.')
-os.system('cp ' + fasta_dereplicated + ' ' + dataset_folder + '/.')
+package([OTU_sequences_fasta, fasta_dereplicated])
 
 if metadata_file is not None:
-    os.system('cp ' + options.input_dir + '/' + metadata_file + ' ' + dataset_folder + '/.')
+    package([options.input_dir + '/' + metadata_file])
 
 # Put the summary file in the folder and change the summary file path to its new location
-os.system('cp ' + summary_file + ' ' + dataset_folder + '/.')
+# (copied, not linked, because it is rewritten below and the original must not change)
+package([summary_file], copy=True)
 summary_obj.summary_file = dataset_folder + '/summary_file.txt'
 if amplicon_type == '16S':
     summary_obj.attribute_value_16S['OTU_TABLE_DENOVO'] = ntpath.basename(OTU_table_denovo)
@@ -702,9 +910,41 @@ summary_obj.attribute_value_ITS['PROCESSED'] = 'True'
 summary_obj.WriteSummaryFile()
 
 
-# Transfer results 
-processing_results_dir = '/home/ubuntu/processing_results'
-os.system('cp -r ' + os.path.join(working_directory, dataset_folder) + ' ' + processing_results_dir + '/.')
+# Manifest of the results (size and checksum of every file), then transfer results by linking them into processing_results
+manifest_file = packaging.manifest_name(amplicon_type)
+packaging.write_manifest(dataset_folder, {'dataset': dataset_ID, 'amplicon_type': amplicon_type}, manifest_file)
+for method, n in packaging.place_tree(dataset_folder, results_directory).items():
+    packaged[method] = packaged.get(method, 0) + n
+print("Packaged results (files placed by " + ', '.join(method + ': ' + str(n) for method, n in sorted(packaged.items())) + ").")
+
+# Stage 'packaging' only links files, so it is always redone; its manifest records the results that were packaged
+ckpt.record('packaging', [OTU_table_denovo, oligotype_table_filename, OTU_sequences_fasta, fasta_dereplicated] + open_reference_OTU_tables + closed_reference_OTU_tables,
+            {'dataset_folder': dataset_folder}, [results_directory])
+profile.end('packaging', packaged_files=packaged)
+# The QC folder was packaged before the profile was complete
+packaging.add_files([profile.profile_file], dataset_folder, 'quality_control', results_directory, manifest_file)
+
+# Shut down the worker pool of the run
+pool.close()
+pool.join()
+
+# Combined mode - wait for the processing of the other amplicon type
+other_failed = False
+if other_process is not None:
+    if other_process.wait() != 0:
+        print("Failed to process " + other_type + " data.")
+        warning("Failed to process " + other_type + " data (exit code " + str(other_process.returncode) + ").")
+        other_failed = True
+
+# Export the trace of the run (including the processing of the other amplicon type in combined mode)
+if options.trace == 'True':
+    n_events = tracing.merge(trace_directory, os.path.join(QCpath, 'trace.json'))
+    print("Wrote " + str(n_events) + " trace events to " + os.path.join(QCpath, 'trace.json'))
+    packaging.add_files([os.path.join(QCpath, 'trace.json')], dataset_folder, 'quality_control', results_directory, manifest_file)
+
+# A failed run of the other amplicon type fails the combined run
+if other_failed:
+    sys.exit(1)
 
 '''
 # Transfer to PiCRUST server and wait for results
@@ -0,0 +1,398 @@
+"""
+
+OVERVIEW:
+
+Python module for processing raw data chunks in a single pass.
+
+Instead of running demultiplexing, primer removal, quality trimming, length trimming and FASTQ -> FASTA conversion as
+separate steps that each write and re-read a file per chunk, a ReadEngine reads a chunk once and passes every record
+through a chain of steps.  Each step returns the (modified) record, or None to drop it, and counts the records it
+passes on.  One FASTA file is written per chunk.
+
+Records are passed through the steps in batches (BATCH_READS records, in order), each step running on the whole batch
+before the next one, so that steps can process a batch at once (RemovePrimers matches the primers of all reads of a
+batch together, see remove_primers.find_best_matches).  The output is the same as passing records one at a time.
+
+The engine also counts the reads of every sample that each step drops, and the reads of every sample that are kept,
+as a sparse attrition table {(sample, step label, drop reason): reads} (see QualityControl.write_attrition_table).
+Reads dropped by demultiplexing have no sample and are counted as 'unassigned'.
+
+Demultiplex and RemovePrimers memoise their matches by read prefix (see matchcache.py); the hits and misses of their
+caches are returned with the read counts of a chunk (cache_stats) and recorded in the run profile.
+
+The steps reproduce the separate pipeline steps:
+
+    Demultiplex        split_by_barcodes.py
+    RelabelSample      preprocessing_16S.replace_seqIDs_for_demultiplexed_files
+    RemovePrimers      remove_primers.py
+    TruncateQuality    usearch8 -fastq_truncqual
+    TruncateLength     usearch8 -fastq_trunclen (FASTQ) / -fastx_truncate (FASTA)
+    MaxExpectedErrors  usearch8 -fastq_maxee
+    ToFasta            fastq_to_fasta (reads containing N are discarded)
+
+Chunks are processed in parallel with process_chunk, from settings built in raw2otu.py:
+
+pool.map(readengine.process_chunk, zip(raw_chunks, fasta_filenames, settings_vect))
+
+Several branches (e.g. 16S and ITS, each with their own primers, barcodes and trimming settings) can be processed in
+the same read pass with process_chunk_branches; every record is passed through the steps of each branch and written
+to the FASTA file of each branch it comes out of.
+
+"""
+
+import util
+import readpack
+import fqindex
+import tracing
+import split_by_barcodes
+import remove_primers
+import matchcache
+
+
+# Sample of reads dropped before they were assigned one, and the stage of the reads kept in the attrition table
+UNASSIGNED = 'unassigned'
+KEPT = 'kept'
+
+# Records passed through the steps at once
+BATCH_READS = 4096
+
+
+class Step():
+    # Base class of the per-record steps.  label is used for the read counts in the processing summary, and reason for
+    # the reads it drops in the attrition table.  assigns_sample is True for steps that label reads with their sample.
+    label = ''
+    reason = ''
+    assigns_sample = False
+    cache = None # MatchCache of steps that memoise matches, reported under cache_name
+    cache_name = ''
+    def __init__(self):
+        self.n_out = 0
+    def __call__(self, record):
+        record = self.apply(record)
+        if record is not None:
+            self.n_out += 1
+        return record
+    def apply(self, record):
+        return record
+    def batch(self, records):
+        # the (modified) record, or None, for every record of a batch
+        return [self(record) for record in records]
+
+
+class Demultiplex(Step):
+    # Finds the sample of every read from its barcode and relabels it '<sample>_<count>' (as split_by_barcodes.py)
+    label = 'demultiplexed reads'
+    reason = 'no matching barcode'
+    assigns_sample = True
+    cache_name = 'barcodes'
+    def __init__(self, barcodes_map, mode, max_diff=1, window=5, rc=False, index_file='', index_format='', golay=False):
+        Step.__init__(self)
+        self.b2s = split_by_barcodes.parse_barcodes_file(barcodes_map, format='tab', rc=rc)
+        self.s2b = split_by_barcodes.parse_index_file(index_file, format=index_format)
+        self.mode = int(mode)
+        self.max_diff = max_diff
+        self.window = window
+        self.s2c = {}
+        self.cache = matchcache.MatchCache(split_by_barcodes.search_width(self.b2s, window))
+        split_by_barcodes.check_mode(self.b2s, self.mode)
+        self.index = split_by_barcodes.barcode_index(self.b2s, max_diff, golay)
+    def apply(self, record):
+        if self.mode == 1:
+            barcode = split_by_barcodes.extract_barcode_from_id(record[0])
+            [i,d,b,s] = split_by_barcodes.find_best_match(barcode, self.b2s, self.window, self.max_diff, self.cache, self.index)
+        elif self.mode == 2:
+            seq = record[1]
+            [i,d,b,s] = split_by_barcodes.find_best_match(seq, self.b2s, self.window, self.max_diff, self.cache, self.index)
+            if i != '':
+                record[1] = seq[i+len(b):]
+                if len(record) > 2:
+                    record[3] = record[3][i+len(b):]
+        elif self.mode == 3:
+            b = self.s2b[record[0][1:]]
+            [i,d,b,s] = split_by_barcodes.find_best_match(b, self.b2s, self.window, self.max_diff, self.cache, self.index)
+        if not s:
+            return None
+        self.s2c[s] = self.s2c.get(s, 0) + 1
+        record[0] = '%s%s_%d' %(record[0][0], s, self.s2c[s])
+        return record
+
+
+class RelabelSample(Step):
+    # Relabels all reads of a single-sample raw file '<sampleID>_<count>', counting from 0
+    label = 'demultiplexed reads'
+    assigns_sample = True
+    def __init__(self, sampleID):
+        Step.__init__(self)
+        self.sampleID = sampleID
+    def apply(self, record):
+        record[0] = '%s%s_%d' %(record[0][0], self.sampleID, self.n_out)
+        return record
+
+
+class RemovePrimers(Step):
+    # Removes the best matching primer (and anything before it) from the beginning of every read (as remove_primers.py)
+    label = 'primer-trimmed reads'
+    reason = 'no matching primer'
+    cache_name = 'primers'
+    def __init__(self, primers_file, max_diff=1, window=35, indels=False):
+        Step.__init__(self)
+        self.primers = remove_primers.read_primers(primers_file)
+        self.max_diff = max_diff
+        self.window = window
+        self.indels = indels
+        self.primer_masks = remove_primers.encode_primers(self.primers)
+        self.peqs = [remove_primers.primer_peq(p) for p in self.primers]
+        self.cache = matchcache.MatchCache(remove_primers.search_width(self.primers, window, max_diff, indels))
+    def apply(self, record):
+        if self.indels:
+            [i,d,p] = remove_primers.find_best_match_indels(record[1], self.primers, self.window, self.max_diff, self.peqs, self.cache)
+        else:
+            [i,d,p] = remove_primers.find_best_match(record[1], self.primers, self.window, self.max_diff, self.cache)
+        return self.trim(record, i, p)
+    def batch(self, records):
+        if self.indels:
+            return [self(record) for record in records]
+        matches = remove_primers.find_best_matches([record[1] for record in records], self.primers, self.window, self.max_diff, self.primer_masks, self.cache)
+        out = [self.trim(record, i, p) for record, [i,d,p] in zip(records, matches)]
+        self.n_out += sum(1 for record in out if record is not None)
+        return out
+    def trim(self, record, i, p):
+        if i == '':
+            return None
+        record[1] = record[1][i+len(p):]
+        if len(record) > 2:
+            record[3] = record[3][i+len(p):]
+        return record
+
+
+class TruncateQuality(Step):
+    # Truncates every read at its first base with quality score <= quality; empty reads are discarded
+    label = 'quality-trimmed reads'
+    reason = 'no bases above quality'
+    def __init__(self, quality, ascii_encoding=33):
+        Step.__init__(self)
+        # quality characters at which reads are truncated
+        self.bad = set(chr(c) for c in range(256) if c - ascii_encoding <= quality)
+    def apply(self, record):
+        qual = record[3]
+        for i, c in enumerate(qual):
+            if c in self.bad:
+                if i == 0:
+                    return None
+                record[1] = record[1][:i]
+                record[3] = qual[:i]
+                return record
+        if not qual:
+            return None
+        return record
+
+
+class TruncateLength(Step):
+    # Truncates reads to length; shorter reads are discarded (FASTQ) or kept unchanged (FASTA)
+    label = 'length-trimmed reads'
+    reason = 'shorter than trim length'
+    def __init__(self, length, discard_short=True):
+        Step.__init__(self)
+        self.length = length
+        self.discard_short = discard_short
+    def apply(self, record):
+        if len(record[1]) < self.length:
+            if self.discard_short:
+                return None
+            return record
+        record[1] = record[1][:self.length]
+        if len(record) > 2:
+            record[3] = record[3][:self.length]
+        return record
+
+
+class MaxExpectedErrors(Step):
+    # Discards reads with more than maxee expected errors
+    label = 'quality-filtered reads'
+    reason = 'too many expected errors'
+    def __init__(self, maxee, ascii_encoding=33):
+        Step.__init__(self)
+        self.maxee = maxee
+        # error probability of every quality character
+        self.p = dict((chr(c), 10.0 ** (-(c - ascii_encoding) / 10.0)) for c in range(256))
+    def apply(self, record):
+        p = self.p
+        if sum([p[c] for c in record[3]]) > self.maxee:
+            return None
+        return record
+
+
+class ToFasta(Step):
+    # Converts reads to FASTA records; reads containing N are discarded (as fastq_to_fasta)
+    label = 'FASTA reads left'
+    reason = 'contains N'
+    def apply(self, record):
+        if 'N' in record[1]:
+            return None
+        return ['>' + record[0][1:], record[1]]
+
+
+class ReadEngine():
+    # Passes the records of a chunk through a chain of steps and writes the records that come out as FASTA.
+    # separator separates the sample from the sequence number in the IDs of raw reads that are already demultiplexed;
+    # steps that assign the sample label reads '<sample>_<count>'.
+    def __init__(self, steps, separator='_'):
+        self.steps = steps
+        self.separator = '_' if any(step.assigns_sample for step in steps) else separator
+        self.n_in = 0
+        self.attrition = {} # (sample, step label, reason) -> reads dropped, (sample, KEPT, '') -> reads kept
+
+    def process_record(self, record):
+        # The record after all steps, or None if a step drops it
+        self.n_in += 1
+        attrition = self.attrition
+        for step in self.steps:
+            x = step(record)
+            if x is None:
+                # steps only change the ID of a record when they assign its sample
+                key = (UNASSIGNED if step.assigns_sample else record_sample(record, self.separator), step.label, step.reason)
+                attrition[key] = attrition.get(key, 0) + 1
+                return None
+            record = x
+        key = (record_sample(record, self.separator), KEPT, '')
+        attrition[key] = attrition.get(key, 0) + 1
+        return record
+
+    def process_batch(self, records):
+        # The records of a batch that pass all steps, in order.  Every step runs on the whole batch before the next one.
+        self.n_in += len(records)
+        attrition = self.attrition
+        for step in self.steps:
+            kept = []
+            for record, x in zip(records, step.batch(records)):
+                if x is None:
+                    key = (UNASSIGNED if step.assigns_sample else record_sample(record, self.separator), step.label, step.reason)
+                    attrition[key] = attrition.get(key, 0) + 1
+                else:
+                    kept.append(x)
+            records = kept
+        for record in records:
+            key = (record_sample(record, self.separator), KEPT, '')
+            attrition[key] = attrition.get(key, 0) + 1
+        return records
+
+    def process(self, records):
+        # generator of the records that pass all steps (processed in batches of BATCH_READS)
+        for batch in util.iter_lists(records, BATCH_READS):
+            for record in self.process_batch(batch):
+                yield record
+
+    def run(self, chunk, file_type, fasta_out, indexer=None):
+        # Processes a chunk (path, start, end) of a raw FASTQ/FASTA file into fasta_out (indexing it with indexer if given)
+        with open(fasta_out, 'w') as out:
+            for record in self.process(iter_chunk(chunk, file_type, indexer)):
+                out.write('>' + record[0][1:] + '\n' + record[1] + '\n')
+        return self.counts()
+
+    def counts(self):
+        # [(label, number of reads)] for the raw reads and after every step
+        return [('raw reads', self.n_in)] + [(step.label, step.n_out) for step in self.steps]
+
+    def cache_stats(self):
+        # {cache name: hits and misses} of the match caches of the steps
+        return dict((step.cache_name, step.cache.stats()) for step in self.steps if step.cache is not None)
+
+
+def record_sample(record, separator='_'):
+    # Sample of a record labelled '<sample><separator><count>'
+    return record[0][1:].rsplit(separator, 1)[0]
+
+
+def iter_chunk(chunk, file_type, indexer=None):
+    # Generator of the records of a chunk (path, start, end) of a raw FASTQ/FASTA file
+    # With an indexer (see fqindex.py), the chunk is indexed from the batches read for processing
+    path, start, end = chunk
+    if indexer is not None and not readpack.is_readpack(path):
+        return (record for batch in fqindex.iter_batches(path, file_type, start, end, indexer) for record in batch)
+    if file_type == 'FASTQ':
+        return util.iter_fsq(path, start=start, end=end)
+    return util.iter_fst(path, start=start, end=end)
+
+
+def build_steps(settings):
+    # Chain of steps for a chunk from the processing settings (a dict, see raw2otu.py):
+    #   file_type        'FASTQ' or 'FASTA'
+    #   barcodes_map     barcodes file (tab format) if reads need to be demultiplexed, with barcodes_mode and
+    #                    barcodes_golay to error-correct Golay-12 barcodes
+    #   sample_id        sample of all reads, for raw files that hold a single sample
+    #   primers_file     primers to remove, if any, and primer_indels to match them allowing insertions and deletions
+    #   trim_type        'truncqual' or 'maxee', with quality or maxee ('None' to skip)
+    #   length           trim length
+    #   ascii_encoding   quality score encoding
+    #   separator        sample ID separator of reads that are already demultiplexed (see build_engine)
+    fastq = (settings['file_type'] == 'FASTQ')
+    ascii_encoding = int(settings.get('ascii_encoding', 33))
+    steps = []
+    if settings.get('barcodes_map'):
+        steps.append(Demultiplex(settings['barcodes_map'], settings['barcodes_mode'], golay=bool(settings.get('barcodes_golay'))))
+    elif settings.get('sample_id'):
+        steps.append(RelabelSample(settings['sample_id']))
+    if settings.get('primers_file'):
+        steps.append(RemovePrimers(settings['primers_file'], indels=bool(settings.get('primer_indels'))))
+    if fastq and settings.get('trim_type') == 'truncqual' and str(settings.get('quality')) != 'None':
+        steps.append(TruncateQuality(float(settings['quality']), ascii_encoding))
+    steps.append(TruncateLength(int(settings['length']), discard_short=fastq))
+    if fastq and settings.get('trim_type') == 'maxee' and str(settings.get('maxee')) != 'None':
+        steps.append(MaxExpectedErrors(float(settings['maxee']), ascii_encoding))
+    if fastq:
+        steps.append(ToFasta())
+    return steps
+
+
+def build_engine(settings):
+    # ReadEngine for the processing settings (see build_steps)
+    return ReadEngine(build_steps(settings), settings.get('separator', '_'))
+
+
+def process_chunk((chunk, fasta_out, settings)):
+    # Processes one raw data chunk into a FASTA file and returns [read counts after every step, attrition table,
+    # match cache statistics, index of the chunk (see fqindex.index_chunk)].  Takes a single tuple argument for use with multiprocessing.
+    engine = build_engine(settings)
+    indexer = fqindex.ChunkIndexer()
+    with tracing.span(fasta_out, 'chunk', {'chunk': list(chunk)}):
+        counts = engine.run(chunk, settings['file_type'], fasta_out, indexer)
+    return [counts, engine.attrition, engine.cache_stats(), indexer.result()]
+
+
+def process_chunk_branches((chunk, fasta_outs, settings_list)):
+    # Processes one raw data chunk for several branches in a single read pass: every record goes through the steps of
+    # each branch (settings_list, with the same file type) into its FASTA file (fasta_outs).
+    # Returns [[read counts, attrition table, match cache statistics] of each branch, index of the chunk].  Takes a single
+    # tuple argument for use with multiprocessing.
+    engines = [build_engine(settings) for settings in settings_list]
+    outs = [open(fn, 'w') for fn in fasta_outs]
+    indexer = fqindex.ChunkIndexer()
+    with tracing.span(fasta_outs[0], 'chunk', {'chunk': list(chunk), 'branches': len(fasta_outs)}):
+        for records in util.iter_lists(iter_chunk(chunk, settings_list[0]['file_type'], indexer), BATCH_READS):
+            for engine, out in zip(engines, outs):
+                # steps modify records in place, so every branch gets its own copy
+                for x in engine.process_batch([list(record) for record in records]):
+                    out.write('>' + x[0][1:] + '\n' + x[1] + '\n')
+    for out in outs:
+        out.close()
+    return [[[engine.counts(), engine.attrition, engine.cache_stats()] for engine in engines], indexer.result()]
+
+
+def sum_counts(chunk_counts):
+    # Adds up the read counts of several chunks (lists of (label, count) with the same labels)
+    total = []
+    for counts in chunk_counts:
+        if not total:
+            total = [[label, 0] for label, n in counts]
+        for x, (label, n) in zip(total, counts):
+            x[1] += n
+    return [tuple(x) for x in total]
+
+
+def sum_attrition(chunk_attrition):
+    # Adds up the attrition tables of several chunks
+    total = {}
+    for attrition in chunk_attrition:
+        for key, n in attrition.items():
+            total[key] = total.get(key, 0) + n
+    return total
@@ -0,0 +1,361 @@
+"""
+
+OVERVIEW:
+
+Python module for the compact binary format of intermediate read files ('read packs').
+
+The per-chunk stages of raw2otu.py (demultiplex, primer removal, quality and length trimming) can pass reads to each
+other as read packs instead of text FASTQ/FASTA files.  A read pack stores blocks of records as:
+
+    lengths     int32 per record; the record offset table is their cumulative sum
+    samples     int32 sample index per record (-1 if the id is stored as text)
+    numbers     int32 read number per record; the id is '<sample>_<number>', as written by 2.split_by_barcodes.py
+    ids         newline-separated ids of the records without a sample index
+    bases       2-bit packed bases (A=0, C=1, G=2, T=3), 4 per byte
+    exceptions  uint32 positions of the bases other than A, C, G and T in the block, and those bases (as ASCII bytes)
+    plus lines  newline-separated '+' lines of the records, only if one of them is not just '+' (FASTQ only)
+    qualities   raw quality bytes (FASTQ only)
+
+followed by a footer with the sample names and the offsets of all blocks.  Packing is lossless: lower-case, N and
+IUPAC bases are kept as exceptions, so a read pack reads back as exactly the records written to it.  Stages read whole
+blocks as numpy arrays (PackBlock), so no text is parsed between stages.
+
+util.iter_fst / util.iter_fsq read read packs transparently, so any stage can read them:
+
+out = readpack.PackWriter('chunk0000.sb', fastq=True)
+out.write('sample1_1', 'ACGT', 'IIII')
+out.close()
+for record in util.iter_fsq('chunk0000.sb'):
+    print record
+
+"""
+
+import os
+import struct
+import numpy as np
+
+PACK_MAGIC = 'RPAK'
+BLOCK_MAGIC = 'RPKB'
+END_MAGIC = 'RPKE'
+PACK_VERSION = 2
+
+# Records per block
+BLOCK_RECORDS = 4096
+
+# Sample names are only registered up to this number; ids beyond it are stored as text
+MAX_SAMPLES = 1 << 16
+
+_header = struct.Struct('<4sBBH') # magic, version, flags, reserved
+_block_header = struct.Struct('<4sI9I') # magic, number of records, sizes of the 9 sections
+_trailer = struct.Struct('<QQII4s') # footer offset, number of records, number of blocks, size of sample names, magic
+
+FLAG_QUAL = 1
+
+# Base codes: A=0, C=1, G=2, T=3; 4 marks any other base (stored as an exception)
+_code = np.empty(256, dtype=np.uint8)
+_code[:] = 4
+for _i, _b in enumerate('ACGT'):
+    _code[ord(_b)] = _i
+# Packed byte -> its 4 bases as ASCII (little-endian uint32)
+_unpack = np.zeros(256, dtype=np.uint32)
+for _x in range(256):
+    for _j in range(4):
+        _unpack[_x] |= ord('ACGT'[(_x >> (2*_j)) & 3]) << (8*_j)
+
+
+def is_readpack(fn):
+    # Returns True if the file is a read pack
+    try:
+        with open(fn, 'rb') as fid:
+            return fid.read(4) == PACK_MAGIC
+    except IOError:
+        return False
+
+
+def pack_bases(bases):
+    # 2-bit packs a uint8 array of ASCII bases; returns (packed bytes, positions of the other bases, those bases)
+    n = len(bases)
+    codes = np.zeros(n + (-n) % 4, dtype=np.uint8)
+    np.take(_code, bases, out=codes[:n])
+    x_pos = np.flatnonzero(codes > 3).astype(np.uint32)
+    codes[x_pos] = 0
+    # 4 codes, one per byte of a uint32, are shifted into the low byte
+    v = codes.view('<u4')
+    packed = (v | (v >> 6) | (v >> 12) | (v >> 18)).astype(np.uint8)
+    return packed.tostring(), x_pos.tostring(), np.asarray(bases)[x_pos].tostring()
+
+
+def unpack_bases(packed, x_pos, x_bases, n_bases):
+    # Inverse of pack_bases; returns a uint8 array of ASCII bases
+    bases = _unpack[np.frombuffer(packed, dtype=np.uint8)].view(np.uint8)[:n_bases]
+    bases[np.frombuffer(x_pos, dtype=np.uint32)] = np.frombuffer(x_bases, dtype=np.uint8)
+    return bases
+
+
+class PackBlock():
+    # A block of records held as numpy arrays.  bases and quals are the concatenated sequences and qualities
+    # (uint8 ASCII); record i spans [starts[i], starts[i] + lengths[i]).  pluses holds the '+' lines of the records,
+    # or None if they are all just '+'.
+    def __init__(self, sample_names, samples, numbers, ids, lengths, bases, quals=None, pluses=None):
+        self.sample_names = sample_names
+        self.samples = samples
+        self.numbers = numbers
+        self.ids = ids # text ids, None for records with a sample index
+        self.lengths = lengths
+        self.starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64) if len(lengths) else np.zeros(0, dtype=np.int64)
+        self.bases = bases
+        self.quals = quals
+        self.pluses = pluses
+    def __len__(self):
+        return len(self.lengths)
+    def is_fastq(self):
+        return self.quals is not None
+    def sid(self, i):
+        if self.ids[i] is not None:
+            return self.ids[i]
+        return '%s_%d' %(self.sample_names[self.samples[i]], self.numbers[i])
+    def seq(self, i):
+        return self.bases[self.starts[i]:self.starts[i] + self.lengths[i]].tostring()
+    def qual(self, i):
+        return self.quals[self.starts[i]:self.starts[i] + self.lengths[i]].tostring()
+    def __iter__(self):
+        # iterate through records as lists, as util.iter_fsq / util.iter_fst
+        bases = self.bases.tostring()
+        quals = self.quals.tostring() if self.quals is not None else None
+        names = self.sample_names
+        pluses = self.pluses
+        for i, (s, num, sid, a, l) in enumerate(zip(self.samples.tolist(), self.numbers.tolist(), self.ids, self.starts.tolist(), self.lengths.tolist())):
+            if sid is None:
+                sid = '%s_%d' %(names[s], num)
+            if quals is None:
+                yield ['>' + sid, bases[a:a+l]]
+            else:
+                yield ['@' + sid, bases[a:a+l], '+' if pluses is None else pluses[i], quals[a:a+l]]
+    def subset(self, keep, lengths=None):
+        # New block with the records where keep is True, truncated to lengths (default: unchanged)
+        if lengths is None:
+            lengths = self.lengths
+        keep = np.flatnonzero(keep)
+        if len(keep) == len(self) and (lengths is self.lengths or np.array_equal(lengths, self.lengths)):
+            return self
+        # mask of the kept bases: +1 at the start and -1 at the (new) end of every kept, non-empty record
+        nonempty = keep[lengths[keep] > 0]
+        delta = np.zeros(len(self.bases) + 1, dtype=np.int8)
+        delta[self.starts[nonempty]] = 1
+        delta[self.starts[nonempty] + lengths[nonempty]] -= 1
+        mask = np.cumsum(delta[:-1], dtype=np.int8).view(bool)
+        ids = [self.ids[i] for i in keep.tolist()]
+        quals = self.quals[mask] if self.quals is not None else None
+        pluses = [self.pluses[i] for i in keep.tolist()] if self.pluses is not None else None
+        return PackBlock(self.sample_names, self.samples[keep], self.numbers[keep], ids, lengths[keep], self.bases[mask], quals, pluses)
+
+
+class PackWriter():
+    # Writes records to a read pack, one block of BLOCK_RECORDS records at a time
+    def __init__(self, fn, fastq=True, block_records=BLOCK_RECORDS):
+        self.fn = fn
+        self.fastq = fastq
+        self.block_records = block_records
+        self.fid = open(fn, 'wb')
+        self.fid.write(_header.pack(PACK_MAGIC, PACK_VERSION, FLAG_QUAL if fastq else 0, 0))
+        self.sample_index = {}
+        self.sample_names = []
+        self.block_offsets = []
+        self.n_records = 0
+        self._clear()
+
+    def _clear(self):
+        self.samples = []
+        self.numbers = []
+        self.ids = []
+        self.seqs = []
+        self.quals = []
+        self.pluses = []
+
+    def _sample(self, name):
+        # Index of a sample name, registering it if needed; -1 if the table is full
+        i = self.sample_index.get(name)
+        if i is None:
+            if len(self.sample_names) >= MAX_SAMPLES:
+                return -1
+            i = len(self.sample_names)
+            self.sample_index[name] = i
+            self.sample_names.append(name)
+        return i
+
+    def write(self, sid, seq, qual=None, plus='+'):
+        # Adds a record; sid is the id without the leading '@' or '>'
+        # ids of the form '<sample>_<number>' are stored as a sample index and a number
+        name, _, num = sid.rpartition('_')
+        s = -1
+        if name and num.isdigit() and str(int(num)) == num and int(num) < 2**31:
+            s = self._sample(name)
+        if s >= 0:
+            self.samples.append(s)
+            self.numbers.append(int(num))
+        else:
+            self.samples.append(-1)
+            self.numbers.append(0)
+            self.ids.append(sid)
+        self.seqs.append(seq)
+        if self.fastq:
+            self.quals.append(qual)
+            self.pluses.append(plus)
+        if len(self.seqs) >= self.block_records:
+            self.flush()
+
+    def write_record(self, record):
+        # Adds a record as returned by util.iter_fsq / util.iter_fst
+        if len(record) > 2:
+            self.write(record[0][1:], record[1], record[3], record[2])
+        else:
+            self.write(record[0][1:], record[1])
+
+    def write_block(self, block):
+        # Adds all records of a PackBlock
+        if len(block) == 0:
+            return
+        self.flush()
+        remap = np.array([self._sample(name) for name in block.sample_names] + [-1], dtype=np.int32)
+        samples = remap[block.samples]
+        ids = list(block.ids)
+        for i in np.flatnonzero((samples < 0) & (block.samples >= 0)).tolist():
+            ids[i] = block.sid(i)
+        self._write_block(samples, block.numbers, [sid for sid in ids if sid is not None], block.lengths, block.bases, block.quals, block.pluses)
+
+    def flush(self):
+        # Writes the pending records as a block
+        if not self.seqs:
+            return
+        bases = ''.join(self.seqs)
+        quals = np.frombuffer(''.join(self.quals), dtype=np.uint8) if self.fastq else None
+        self._write_block(np.array(self.samples, dtype=np.int32), np.array(self.numbers, dtype=np.int32), self.ids,
+                          np.array([len(seq) for seq in self.seqs], dtype=np.int32), np.frombuffer(bases, dtype=np.uint8), quals, self.pluses)
+        self._clear()
+
+    def _write_block(self, samples, numbers, ids, lengths, bases, quals, pluses=None):
+        packed, x_pos, x_bases = pack_bases(bases)
+        # '+' lines are only stored if one of them is more than '+' (e.g. repeats the id)
+        if pluses is not None and any(plus != '+' for plus in pluses):
+            pluses = '\n'.join(pluses)
+        else:
+            pluses = ''
+        sections = [lengths.astype(np.int32).tostring(), samples.astype(np.int32).tostring(), numbers.astype(np.int32).tostring(),
+                    '\n'.join(ids), packed, x_pos, x_bases, pluses, quals.tostring() if self.fastq else '']
+        self.block_offsets.append(self.fid.tell())
+        self.fid.write(_block_header.pack(BLOCK_MAGIC, len(lengths), *[len(x) for x in sections]))
+        for x in sections:
+            self.fid.write(x)
+        self.n_records += len(lengths)
+
+    def close(self):
+        self.flush()
+        footer_offset = self.fid.tell()
+        names = '\n'.join(self.sample_names)
+        self.fid.write(names)
+        self.fid.write(np.array(self.block_offsets, dtype=np.uint64).tostring())
+        self.fid.write(_trailer.pack(footer_offset, self.n_records, len(self.block_offsets), len(names), END_MAGIC))
+        self.fid.close()
+
+
+def read_footer(fn):
+    # Returns (fastq, number of records, sample names, block offsets) of a read pack
+    with open(fn, 'rb') as fid:
+        magic, version, flags, reserved = _header.unpack(fid.read(_header.size))
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise IOError('Not a read pack (or unsupported version): ' + fn)
+        fid.seek(-_trailer.size, os.SEEK_END)
+        footer_offset, n_records, n_blocks, names_size, magic = _trailer.unpack(fid.read(_trailer.size))
+        if magic != END_MAGIC:
+            raise IOError('Truncated read pack: ' + fn)
+        fid.seek(footer_offset)
+        names = fid.read(names_size)
+        block_offsets = np.frombuffer(fid.read(8*n_blocks), dtype=np.uint64).tolist()
+    sample_names = names.split('\n') if names else []
+    return bool(flags & FLAG_QUAL), n_records, sample_names, block_offsets
+
+
+def count_records(fn):
+    # Number of records in a read pack (read from the footer)
+    return read_footer(fn)[1]
+
+
+def iter_blocks(fn):
+    # generator that yields the PackBlocks of a read pack
+    fastq, n_records, sample_names, block_offsets = read_footer(fn)
+    with open(fn, 'rb') as fid:
+        for offset in block_offsets:
+            fid.seek(offset)
+            x = _block_header.unpack(fid.read(_block_header.size))
+            n, sizes = x[1], x[2:]
+            lengths, samples, numbers, ids, packed, x_pos, x_bases, pluses, quals = [fid.read(size) for size in sizes]
+            lengths = np.frombuffer(lengths, dtype=np.int32).astype(np.int64)
+            samples = np.frombuffer(samples, dtype=np.int32)
+            numbers = np.frombuffer(numbers, dtype=np.int32)
+            text_ids = iter(ids.split('\n'))
+            ids = [next(text_ids) if s < 0 else None for s in samples.tolist()]
+            bases = unpack_bases(packed, x_pos, x_bases, int(lengths.sum()))
+            quals = np.frombuffer(quals, dtype=np.uint8) if fastq else None
+            pluses = pluses.split('\n') if sizes[7] else None
+            yield PackBlock(sample_names, samples, numbers, ids, lengths, bases, quals, pluses)
+
+
+def iter_records(fn, fastq=True):
+    # generator that iterates through the records of a read pack as lists, like util.iter_fsq (or util.iter_fst if fastq is False)
+    for block in iter_blocks(fn):
+        for record in block:
+            if not fastq and len(record) > 2:
+                record = ['>' + record[0][1:], record[1]]
+            yield record
+
+
+def unpack((pack_in, fastx_out)):
+    # Writes a read pack as a text FASTQ (or FASTA) file, e.g. for usearch.  Takes a single tuple argument for use with multiprocessing.
+    with open(fastx_out, 'w') as out:
+        for block in iter_blocks(pack_in):
+            out.write(''.join(['\n'.join(record) + '\n' for record in block]))
+
+
+def truncate_quality(block, quality, ascii_encoding=33):
+    # Truncates every read at its first base with quality score <= quality (as usearch -fastq_truncqual); empty reads are discarded
+    q = block.quals.astype(np.int16) - ascii_encoding
+    bad = np.flatnonzero(q <= quality)
+    lengths = block.lengths.copy()
+    if len(bad):
+        rec = np.searchsorted(block.starts, bad, side='right') - 1
+        rec, first = np.unique(rec, return_index=True)
+        lengths[rec] = bad[first] - block.starts[rec]
+    return block.subset(lengths > 0, lengths)
+
+
+def expected_errors(block, ascii_encoding=33):
+    # Expected number of errors of every read (sum of the error probabilities of its bases)
+    p = 10.0 ** (-(block.quals.astype(np.float64) - ascii_encoding) / 10.0)
+    c = np.concatenate([[0.0], np.cumsum(p)])
+    return c[block.starts + block.lengths] - c[block.starts]
+
+
+def filter_expected_errors(block, maxee, ascii_encoding=33):
+    # Discards reads with more than maxee expected errors (as usearch -fastq_maxee)
+    return block.subset(expected_errors(block, ascii_encoding) <= maxee)
+
+
+def truncate_length(block, length, discard_short=True):
+    # Truncates reads to length; shorter reads are discarded (as usearch -fastq_trunclen) or kept unchanged (as usearch -fastx_truncate)
+    lengths = np.minimum(block.lengths, length)
+    if discard_short:
+        return block.subset(block.lengths >= length, lengths)
+    return block.subset(np.ones(len(block), dtype=bool), lengths)
+
+
+def filter_pack(pack_in, pack_out, block_filter):
+    # Applies block_filter (PackBlock -> PackBlock) to every block of a read pack and writes the result as a new read pack.
+    # Returns (number of input records, number of output records).
+    fastq = read_footer(pack_in)[0]
+    out = PackWriter(pack_out, fastq=fastq)
+    n_in = 0
+    for block in iter_blocks(pack_in):
+        n_in += len(block)
+        out.write_block(block_filter(block))
+    out.close()
+    return n_in, out.n_records
@@ -0,0 +1,325 @@
+"""
+
+OVERVIEW:
+
+Python module for removing primers from the beginning of reads.  Library code of 1.remove_primers.py; pool workers
+call remove_primers() in-process.
+
+find_best_match searches one read letter by letter (primer.MatchPrefix).  find_best_matches searches a batch of reads
+at once with numpy: reads and IUPAC primers are encoded as bitmasks (A=1, C=2, G=4, T=8, so a primer letter is the OR
+of the bases it stands for, e.g. R=A|G=5), a read base matches a primer letter if their masks share a bit, and the
+mismatches of every primer at every offset of the search window are counted for all reads of the batch together.
+Bases past the end of a read are encoded as matching anything, since MatchPrefix only compares the letters the read
+has.  It returns the same [index, edit distance, primer] as find_best_match for every read.
+
+Both take a MatchCache (see matchcache.py) that memoises the match of every read prefix, so the search is only run for
+prefixes that were not seen recently.
+
+Both count substitutions only, so a read with an inserted or deleted base in its primer is discarded or mis-trimmed.
+find_best_match_indels (remove_primers(..., indels=True), 1.remove_primers.py --indels) allows indels: the edit
+distance of every primer to the best matching substring of the search window (the first w + len(primer) - 1 + max_dist
+bases of the read) is found with Myers' bit-parallel algorithm, which handles all primer positions of a read base with
+a few integer operations, in time linear in the window length.  The match ends where the primer occurrence ends, so
+the read is trimmed after it as before (index + len(primer) is the end of the match, the index can be off by the indels).
+Of the ends with the lowest edit distance, one where the primer aligns with substitutions only is preferred (then the
+first), so reads without indels are trimmed as by find_best_match.
+
+cache = matchcache.MatchCache(remove_primers.search_width(primers, 35))
+[i,d,p] = remove_primers.find_best_match(seq, primers, 35, 1, cache=cache)
+matches = remove_primers.find_best_matches([record[1] for record in records], primers, 35, 1, cache=cache)
+[i,d,p] = remove_primers.find_best_match_indels(seq, primers, 35, 1)
+
+"""
+
+import numpy as np
+import die
+import primer, readpack, util
+import matchcache
+
+# Bitmasks of the IUPAC letters of primers
+IUPAC_MASKS = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12, 'M': 3,
+               'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15, 'X': 15}
+
+# Bitmasks of read bases (anything but A, C, G and T matches no primer letter); PAD marks positions past the end of a read
+PAD = '\x00'
+BASE_MASKS = np.zeros(256, dtype=np.uint8)
+for base in 'ACGT':
+    BASE_MASKS[ord(base)] = IUPAC_MASKS[base]
+BASE_MASKS[ord(PAD)] = 15
+
+# Reads matched at once by remove_primers
+BATCH_READS = 4096
+
+
+def mismatches(seq, p, w):
+    # Calculate the number of mismatches between a sequence and a primer
+    # Searches in a sliding window from 0:w
+    best_i = 0 # index of best match
+    best_d = len(seq) # edit distance of best match
+    # for every start position
+    for i in range(w):
+        # calculate edit distance to the given primer
+        d = primer.MatchPrefix(seq[i:], p)
+        # keep track of the best match
+        if d < best_d:
+            best_i = i
+            best_d = d
+    # Return the index and edit distance of the best match
+    return [best_i, best_d]
+
+
+def find_best_match(seq, primers, w, max_dist, cache=None):
+    # For a given sequence, find the best matching primer
+    # If edit distance > max_dist, return empty match
+    # cache (a MatchCache of width search_width(primers, w)) memoises the result by the prefix of seq
+    if w < 1:
+        # no offsets to search (and a cache key too short to tell reads apart)
+        return ['', '', '']
+    if cache is not None:
+        key = cache.key(seq)
+        x = cache.get(key)
+        if x is None:
+            x = find_best_match(seq, primers, w, max_dist)
+            cache.put(key, x)
+        return x
+    best_i = '' # index of best match
+    best_p = '' # best matching primer
+    best_d = len(seq) # edit distance of best match
+    # Calculate edit distance to every primer
+    for p in primers:
+        [i,d] = mismatches(seq, p, w) # get index and edit distance
+        if d < best_d:
+            best_i = i
+            best_p = p
+            best_d = d
+    # Return [index, edit distance, primer] of best match
+    if best_d <= max_dist:
+        return [best_i, best_d, best_p]
+    else:
+        return ['', '', '']
+
+
+def search_width(primers, w, max_dist=0, indels=False):
+    # Number of bases at the start of a read that its primer match depends on (with indels, up to max_dist insertions
+    # in the primer occurrence)
+    width = w + max([len(p) for p in primers] + [1]) - 1
+    if indels:
+        width += max_dist
+    return width
+
+
+def encode_primers(primers):
+    # Bitmasks of the letters of every primer
+    masks = []
+    for p in primers:
+        for letter in p:
+            if letter not in IUPAC_MASKS:
+                die.Die("Bad letter in primer '%c'" % letter)
+        masks.append(np.array([IUPAC_MASKS[letter] for letter in p], dtype=np.uint8))
+    return masks
+
+
+def encode_reads(seqs, width):
+    # Bitmasks of the first width bases of every read (a reads x width array), padded past the end of each read
+    x = ''.join([seq[:width].ljust(width, PAD) for seq in seqs])
+    return BASE_MASKS[np.frombuffer(x, dtype=np.uint8)].reshape(len(seqs), width)
+
+
+def find_best_matches(seqs, primers, w, max_dist, primer_masks=None, cache=None):
+    # find_best_match for a batch of sequences.  primer_masks (from encode_primers) saves encoding the primers again.
+    # With a cache, only the sequences whose prefix is not cached (one per prefix) are searched.
+    # Returns a list of [index, edit distance, primer] (or the empty match) per sequence.
+    if w < 1:
+        # no offsets to search (and a cache key too short to tell reads apart)
+        return [['', '', ''] for seq in seqs]
+    if cache is not None:
+        keys = [cache.key(seq) for seq in seqs]
+        matches = []
+        missing = {} # prefix -> sequence to search for it
+        for key, seq in zip(keys, seqs):
+            x = None
+            if key in missing:
+                # searched once for the whole batch
+                cache.hits += 1
+            else:
+                x = cache.get(key)
+                if x is None:
+                    missing[key] = seq
+            matches.append(x)
+        if missing:
+            missing_keys = list(missing)
+            for key, x in zip(missing_keys, find_best_matches([missing[key] for key in missing_keys], primers, w, max_dist, primer_masks)):
+                cache.put(key, x)
+                missing[key] = x
+            matches = [missing[key] if x is None else x for key, x in zip(keys, matches)]
+        return matches
+    if primer_masks is None:
+        primer_masks = encode_primers(primers)
+    n = len(seqs)
+    if n == 0:
+        return []
+    lengths = np.array([len(seq) for seq in seqs])
+    best_d = lengths.copy() # edit distance of best match (a match must have fewer mismatches than the read has bases)
+    best_i = np.zeros(n, dtype=int) # index of best match
+    best_k = np.full(n, -1, dtype=int) # primer of best match
+    width = w + max([len(m) for m in primer_masks] + [1]) - 1
+    reads = encode_reads(seqs, width)
+    for k, masks in enumerate(primer_masks):
+        # mismatches of primer k at every offset 0:w of every read
+        d = np.zeros((n, w), dtype=np.int32)
+        for j, mask in enumerate(masks):
+            d += (reads[:, j:j+w] & mask) == 0
+        i = d.argmin(axis=1)
+        d = d[np.arange(n), i]
+        # first primer with the fewest mismatches (ties keep the earlier primer and offset)
+        better = d < best_d
+        best_d[better] = d[better]
+        best_i[better] = i[better]
+        best_k[better] = k
+    matches = []
+    for i, d, k, length in zip(best_i.tolist(), best_d.tolist(), best_k.tolist(), lengths.tolist()):
+        if d > max_dist:
+            matches.append(['', '', ''])
+        elif k < 0:
+            # no primer matched better than the length of the read
+            matches.append(['', d, ''])
+        else:
+            matches.append([i, d, primers[k]])
+    return matches
+
+
+def primer_peq(p):
+    # Bitmask of the primer letters that match each read base (bit j for letter j), for myers_search
+    peq = {}
+    for base in 'ACGT':
+        peq[base] = sum(1 << j for j, letter in enumerate(p) if IUPAC_MASKS[letter] & IUPAC_MASKS[base])
+    return peq
+
+
+def myers_search(text, peq, m):
+    # Lowest edit distance (substitutions, insertions and deletions) between a primer of length m (with match bitmasks
+    # peq) and any substring of text, by Myers' bit-parallel algorithm: the column of the edit distance matrix at every
+    # text position is kept as bit vectors of its vertical differences (+1 in Pv, -1 in Mv), and the distance of the
+    # whole primer is tracked in the last row.
+    # Where several ends have the best edit distance, an end where the primer aligns without indels (substitutions only,
+    # as find_best_match) is preferred, so a mismatch in the last primer base is not taken for its deletion.
+    # Returns [end position in text of the first best match, edit distance], or [-1, m] if no base of text matches.
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    Pv = full
+    Mv = 0
+    d = m
+    best_end = -1
+    best_d = m
+    best_ungapped = False
+    for j, c in enumerate(text):
+        Eq = peq.get(c, 0)
+        Xv = Eq | Mv
+        Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+        Ph = Mv | (~(Xh | Pv) & full)
+        Mh = Pv & Xh
+        if Ph & last:
+            d += 1
+        elif Mh & last:
+            d -= 1
+        # a match can start anywhere in text, so the first row stays 0 (nothing shifted in)
+        Ph = (Ph << 1) & full
+        Mh = (Mh << 1) & full
+        Pv = Mh | (~(Xv | Ph) & full)
+        Mv = Ph & Xv
+        if d < best_d or (d == best_d and not best_ungapped):
+            ungapped = j >= m - 1 and ungapped_distance(text, j, peq, m) == d
+            if d < best_d or ungapped:
+                best_end = j
+                best_d = d
+                best_ungapped = ungapped
+    return [best_end, best_d]
+
+
+def ungapped_distance(text, end, peq, m):
+    # Mismatches of a primer of length m (with match bitmasks peq) to the m bases of text that end at end
+    start = end - m + 1
+    return sum([1 for k in range(m) if not (peq.get(text[start + k], 0) >> k) & 1])
+
+
+def find_best_match_indels(seq, primers, w, max_dist, peqs=None, cache=None):
+    # For a given sequence, find the best matching primer allowing insertions and deletions (see myers_search).
+    # peqs (primer_peq of every primer) saves computing them again, and cache (a MatchCache of width
+    # search_width(primers, w, max_dist, True)) memoises the result by the prefix of seq.
+    # Returns [index, edit distance, primer] of the best match, where index + len(primer) is the position after the last
+    # read base aligned to the primer (where the read is trimmed; index itself is off by the net indels), or the empty
+    # match if edit distance > max_dist
+    if w < 1:
+        # no offsets to search (and a cache key too short to tell reads apart)
+        return ['', '', '']
+    if cache is not None:
+        key = cache.key(seq)
+        x = cache.get(key)
+        if x is None:
+            x = find_best_match_indels(seq, primers, w, max_dist, peqs)
+            cache.put(key, x)
+        return x
+    if peqs is None:
+        encode_primers(primers)
+        peqs = [primer_peq(p) for p in primers]
+    text = seq[:search_width(primers, w, max_dist, True)]
+    best = ['', '', '']
+    best_d = max_dist + 1
+    for p, peq in zip(primers, peqs):
+        if not p:
+            [i,d] = [0, 0]
+        else:
+            [end, d] = myers_search(text, peq, len(p))
+            if end < 0:
+                continue
+            i = end + 1 - len(p)
+        # first primer with the lowest edit distance
+        if d < best_d:
+            best = [i, d, p]
+            best_d = d
+    return best
+
+
+def read_primers(primers_file):
+    # Primer sequences from a primer list file (one per line)
+    return [line.rstrip() for line in open(primers_file)]
+
+
+def remove_primers(fn, fastx_out, primers, file_type='FASTQ', max_diff=1, window=35, start=0, end=None, pack=False, cache=None, indels=False):
+    # Removes the best matching primer from every sequence of a FASTA/FASTQ file (or the [start, end) chunk of it, see chunking.py)
+    # and writes the sequences with a primer match to fastx_out (a read pack if pack is True, see readpack.py).
+    # With indels, primers are matched allowing insertions and deletions (see find_best_match_indels).
+    # Matches are memoised by read prefix in cache (a new MatchCache if not given).
+    # Returns [number of sequences kept, total number of sequences]
+    if file_type == 'FASTQ':
+        iter_fst = util.iter_fsq
+    else:
+        iter_fst = util.iter_fst
+
+    n_seqs = 0
+    n_keep = 0
+    if pack:
+        out = readpack.PackWriter(fastx_out, fastq=(file_type == 'FASTQ'))
+        write = out.write_record
+    else:
+        out = open(fastx_out, 'w')
+        write = lambda record: out.write('\n'.join(record) + '\n')
+    primer_masks = encode_primers(primers)
+    peqs = [primer_peq(p) for p in primers]
+    if cache is None:
+        cache = matchcache.MatchCache(search_width(primers, window, max_diff, indels))
+    for records in util.iter_lists(iter_fst(fn, start=start, end=end), BATCH_READS):
+        n_seqs += len(records)
+        if indels:
+            matches = [find_best_match_indels(record[1], primers, window, max_diff, peqs, cache) for record in records]
+        else:
+            matches = find_best_matches([record[1] for record in records], primers, window, max_diff, primer_masks, cache)
+        for record, [i,d,p] in zip(records, matches):
+            if i != '':
+                n_keep += 1
+                record[1] = record[1][i+len(p):]
+                if len(record) > 2 and record[3]:
+                    record[3] = record[3][i+len(p):]
+                write(record)
+    out.close()
+    return [n_keep, n_seqs]
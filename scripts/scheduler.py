@@ -0,0 +1,212 @@
+"""
+
+OVERVIEW:
+
+Python module for processing many datasets concurrently under a shared CPU and memory budget (Master.py scheduler mode).
+
+The dataset directories are scanned for summary files, and every 16S or ITS section with PROCESSED False becomes a
+job that runs raw2otu.py on it.  Jobs are sized by their raw data (compressed files are counted at their estimated
+uncompressed size) and started largest first.  Each job reserves a number of cores (passed on to raw2otu.py with
+--cpus), its share of the budget weighted by its raw data size among the jobs still to finish, and an estimate of its
+peak memory.  A job is only started when both fit in what is left of the budget, with smaller jobs filling in while a
+larger one waits.  A job that does not fit in the whole budget is run on its own.
+When the 16S and ITS sections of a dataset share one raw file, they are one combined job (raw2otu.py --combined True)
+that trims both in a single pass over the raw data.
+
+jobs = scheduler.scan_datasets(['/home/ubuntu/data/dataset1', '/home/ubuntu/data/dataset2'])
+scheduler.Scheduler(jobs, cpus=32, mem_gb=120).run()
+
+"""
+
+import os
+import sys
+import time
+import subprocess
+import math
+import multiprocessing as mp
+from SummaryParser import *
+import util
+
+RAW2OTU = os.path.join(os.path.expanduser('~'), 'scripts', 'raw2otu.py')
+
+# Estimated peak memory of a raw2otu.py run (mostly dereplication) per GB of uncompressed raw data, and at least MIN_MEM_GB
+MEM_PER_RAW_GB = 1.0
+MIN_MEM_GB = 1.0
+
+# Estimated size of gzip/zstd compressed raw data after decompression, relative to the compressed size
+COMPRESSION_RATIO = 4.0
+
+
+class Job():
+    # One raw2otu.py run (a dataset directory and an amplicon type)
+    def __init__(self, datadir, amplicon_type, flags, raw_bytes, combined=False):
+        self.datadir = datadir
+        self.amplicon_type = amplicon_type
+        self.flags = flags
+        self.raw_bytes = raw_bytes
+        self.combined = combined
+        # a combined job runs the downstream steps of both amplicon types at the same time
+        self.mem_gb = max(MIN_MEM_GB, MEM_PER_RAW_GB * raw_bytes / 1e9) * (2 if combined else 1)
+        self.cpus = 1
+        self.process = None
+        self.start_time = None
+
+    def name(self):
+        return os.path.basename(os.path.normpath(self.datadir)) + ' ' + (self.amplicon_type + '+ITS' if self.combined else self.amplicon_type)
+
+    def command(self):
+        # run under the interpreter of the scheduler
+        cmd = [sys.executable, RAW2OTU, '-i', self.datadir, '-t', self.amplicon_type, '--cpus', str(self.cpus)] + self.flags
+        if self.combined:
+            cmd += ['--combined', 'True']
+        return cmd
+
+
+def raw2otu_flags(attributes):
+    # raw2otu.py flags (as in Master.py) from the 16S or ITS attributes of a summary file
+    flags = []
+    if 'RAW_FASTQ_FILES' in attributes or 'RAW_FASTA_FILES' in attributes:
+        flags += ['-m', 'True']
+    else:
+        flags += ['-m', 'False']
+    if attributes.get('PRIMERS_FILE') == 'None':
+        flags += ['-p', 'True']
+    if attributes.get('BARCODES_MAP') == 'None':
+        flags += ['-b', 'True']
+    return flags
+
+
+def raw_data_files(datadir, attributes):
+    # Raw data files of the 16S or ITS attributes of a summary file
+    for key in ['RAW_FASTQ_FILE', 'RAW_FASTA_FILE']:
+        if key in attributes:
+            return [os.path.join(datadir, attributes[key])]
+    for key in ['RAW_FASTQ_FILES', 'RAW_FASTA_FILES']:
+        if key in attributes:
+            with open(os.path.join(datadir, attributes[key])) as fid:
+                return [os.path.join(datadir, line.split('\t')[0]) for line in fid if len(line.rstrip('\n')) > 0]
+    return []
+
+
+def raw_data_size(filenames):
+    # Estimated uncompressed size of the raw data files in bytes
+    size = 0
+    for fn in filenames:
+        try:
+            file_size = os.path.getsize(fn)
+            if util.detect_compression(fn) is not None:
+                file_size = file_size * COMPRESSION_RATIO
+            size += file_size
+        except (IOError, OSError):
+            pass
+    return int(size)
+
+
+def combined_raw_file(summary_obj):
+    # The raw file shared by the 16S and ITS sections of a summary file if both are to be processed, otherwise None
+    x16S = summary_obj.attribute_value_16S
+    xITS = summary_obj.attribute_value_ITS
+    if x16S.get('PROCESSED') != 'False' or xITS.get('PROCESSED') != 'False':
+        return None
+    for key in ['RAW_FASTQ_FILE', 'RAW_FASTA_FILE']:
+        if key in x16S and x16S.get(key) == xITS.get(key):
+            return x16S[key]
+    return None
+
+
+def scan_datasets(datadirs):
+    # Jobs for all 16S and ITS sections with PROCESSED False in the summary files of the dataset directories
+    jobs = []
+    for datadir in datadirs:
+        summary_file = os.path.join(datadir, 'summary_file.txt')
+        if not os.path.isfile(summary_file):
+            continue
+        try:
+            summary_obj = SummaryParser(summary_file)
+            summary_obj.ReadSummaryFile()
+        except Exception as e:
+            print('[[ Scheduler ]] Skipping ' + datadir + ', unable to read its summary file: ' + str(e))
+            continue
+        if combined_raw_file(summary_obj) is not None:
+            attributes = summary_obj.attribute_value_16S
+            jobs.append(Job(datadir, '16S', raw2otu_flags(attributes), raw_data_size(raw_data_files(datadir, attributes)), combined=True))
+            continue
+        for amplicon_type, attributes in [('16S', summary_obj.attribute_value_16S), ('ITS', summary_obj.attribute_value_ITS)]:
+            if attributes.get('PROCESSED') == 'False':
+                raw_bytes = raw_data_size(raw_data_files(datadir, attributes))
+                jobs.append(Job(datadir, amplicon_type, raw2otu_flags(attributes), raw_bytes))
+    # Largest first
+    jobs.sort(key=lambda job: -job.raw_bytes)
+    return jobs
+
+
+def total_memory_gb():
+    # Physical memory of the machine in GB
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9
+
+
+class Scheduler():
+    # Runs jobs concurrently while the cores and memory they reserve fit in the budget
+    def __init__(self, jobs, cpus=None, mem_gb=None, cpus_per_job=None, poll_interval=10):
+        self.queue = list(jobs)
+        self.running = []
+        self.finished = []
+        self.cpus = cpus or mp.cpu_count()
+        self.mem_gb = mem_gb or 0.8 * total_memory_gb()
+        self.cpus_per_job = cpus_per_job or self.cpus # most cores for one job
+        self.poll_interval = poll_interval
+
+    def free(self):
+        # (cores, memory in GB) not reserved by running jobs
+        return (self.cpus - sum(job.cpus for job in self.running), self.mem_gb - sum(job.mem_gb for job in self.running))
+
+    def cpu_share(self, job):
+        # Cores for a job: the budget split among the queued and running jobs in proportion to their raw data size,
+        # between 1 and cpus_per_job
+        total = sum(x.raw_bytes for x in self.queue + self.running)
+        if total <= 0:
+            share = self.cpus // max(1, len(self.queue) + len(self.running))
+        else:
+            share = int(math.floor(float(self.cpus) * job.raw_bytes / total))
+        return max(1, min(self.cpus_per_job, self.cpus, share))
+
+    def next_job(self):
+        # Largest queued job that fits in what is left of the budget (any job if nothing is running)
+        free_cpus, free_mem = self.free()
+        for job in self.queue:
+            job.cpus = self.cpu_share(job)
+            if not self.running:
+                return job
+            if job.cpus <= free_cpus and job.mem_gb <= free_mem:
+                return job
+        return None
+
+    def start(self, job):
+        print('[[ Scheduler ]] Starting ' + job.name() + ' (' + str(job.cpus) + ' cores, ' + '%.1f' % job.mem_gb + ' GB estimated): ' + ' '.join(job.command()))
+        sys.stdout.flush()
+        job.process = subprocess.Popen(job.command())
+        job.start_time = time.time()
+        self.queue.remove(job)
+        self.running.append(job)
+
+    def poll(self):
+        # Moves finished jobs from running to finished
+        for job in list(self.running):
+            if job.process.poll() is not None:
+                self.running.remove(job)
+                self.finished.append(job)
+                status = 'done' if job.process.returncode == 0 else 'FAILED (exit code ' + str(job.process.returncode) + ')'
+                print('[[ Scheduler ]] ' + job.name() + ' ' + status + ' after ' + '%.0f' % (time.time() - job.start_time) + ' s.')
+                sys.stdout.flush()
+
+    def run(self):
+        # Runs all jobs and returns the ones that failed
+        while self.queue or self.running:
+            self.poll()
+            job = self.next_job()
+            while job is not None:
+                self.start(job)
+                job = self.next_job()
+            if self.queue or self.running:
+                time.sleep(self.poll_interval)
+        return [job for job in self.finished if job.process.returncode != 0]
@@ -0,0 +1,106 @@
+"""
+
+OVERVIEW:
+
+Python module for passing batches of raw reads between processes through shared memory instead of pickling them.
+
+A BatchRing is a fixed number of slots in shared memory (multiprocessing.RawArray), created before the processes that
+use it are started.  Every slot holds the packed bytes of a batch of whole FASTQ/FASTA records and the offsets of
+their fields (id, sequence, quality), as in util.RecordBatch.  The process that reads the raw data copies each batch
+into a free slot and passes only the slot index on; the process that takes the index reads the batch in place (the
+fields of a record are sliced straight out of shared memory) and releases the slot when done.  A writer waits for a
+free slot when all slots are in use, which bounds the memory used by batches in flight.  A batch larger than a slot
+is split over several slots.
+
+ring = shmring.BatchRing(n_slots=16)
+# reader process
+for slot in ring.fill(batch):
+    queue.put(slot)
+# worker process
+slot = queue.get()
+for record in ring.get(slot):
+    ...
+ring.release(slot)
+
+"""
+
+import ctypes
+import multiprocessing as mp
+import numpy as np
+import util
+
+# Offset arrays of a slot (FASTA batches use the first four, then the wrapped flags)
+FASTQ_FIELDS = ['sid_start', 'sid_end', 'seq_start', 'seq_end', 'plus_start', 'plus_end', 'qual_start', 'qual_end']
+FASTA_FIELDS = ['sid_start', 'sid_end', 'seq_start', 'seq_end', 'wrapped']
+
+# Smallest average record size a slot has room for (records beyond slot_bytes / MIN_RECORD_BYTES go to the next slot)
+MIN_RECORD_BYTES = 32
+
+
+class BatchRing():
+
+    def __init__(self, n_slots, slot_bytes=4*util.BLOCK_SIZE, max_records=None):
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        self.max_records = max_records or max(1, slot_bytes // MIN_RECORD_BYTES)
+        self.data = mp.RawArray(ctypes.c_char, n_slots * slot_bytes)
+        self.offsets = mp.RawArray(ctypes.c_int32, n_slots * len(FASTQ_FIELDS) * self.max_records)
+        self.sizes = mp.RawArray(ctypes.c_int32, n_slots * 3) # bytes, records, FASTQ (1) or FASTA (0)
+        self.free_slots = mp.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self._views = None
+
+    def views(self):
+        # numpy views of the shared arrays: data (bytes), offsets [slot, field, record], sizes [slot, 3]
+        if self._views is None:
+            self._views = (np.frombuffer(self.data, dtype=np.uint8),
+                           np.frombuffer(self.offsets, dtype=np.int32).reshape(self.n_slots, len(FASTQ_FIELDS), self.max_records),
+                           np.frombuffer(self.sizes, dtype=np.int32).reshape(self.n_slots, 3))
+        return self._views
+
+    def fill(self, batch):
+        # Generator that copies a RecordBatch into free slots (waiting for one to be released if none is free) and
+        # yields their indices
+        n = len(batch)
+        starts = batch.sid_start
+        # records are contiguous, each one ending where the next one starts
+        ends = np.append(starts[1:], len(batch.buf))
+        k = 0
+        while k < n:
+            j = min(n, k + self.max_records, int(np.searchsorted(ends, starts[k] + self.slot_bytes, 'right')))
+            if j == k:
+                raise ValueError("A record of " + str(ends[k] - starts[k]) + " bytes does not fit in a shared memory slot of " + str(self.slot_bytes) + " bytes.")
+            slot = self.free_slots.get()
+            self.write(slot, batch, k, j, int(starts[k]), int(ends[j-1]))
+            yield slot
+            k = j
+
+    def write(self, slot, batch, k, j, a, b):
+        # Copies records k to j of batch (bytes a to b of its buffer) into slot
+        data, offsets, sizes = self.views()
+        base = slot * self.slot_bytes
+        data[base:base + b - a] = np.frombuffer(batch.buf, dtype=np.uint8, count=b - a, offset=a)
+        fastq = batch.is_fastq()
+        fields = FASTQ_FIELDS if fastq else FASTA_FIELDS
+        for f, name in enumerate(fields):
+            x = getattr(batch, name)[k:j]
+            if name == 'wrapped':
+                offsets[slot, f, :j - k] = x
+            else:
+                offsets[slot, f, :j - k] = x - a
+        sizes[slot] = (b - a, j - k, int(fastq))
+
+    def get(self, slot):
+        # RecordBatch of the records in slot, read in place: valid until the slot is released
+        data, offsets, sizes = self.views()
+        nbytes, n, fastq = sizes[slot].tolist()
+        buf = buffer(self.data, slot * self.slot_bytes, nbytes)
+        x = offsets[slot, :, :n]
+        if fastq:
+            return util.RecordBatch(buf, *[x[f] for f in range(len(FASTQ_FIELDS))])
+        return util.RecordBatch(buf, x[0], x[1], x[2], x[3], wrapped=x[4].astype(bool))
+
+    def release(self, slot):
+        # Returns slot to the free slots
+        self.free_slots.put(slot)
@@ -0,0 +1,454 @@
+"""
+
+OVERVIEW:
+
+Python module for demultiplexing reads by barcode.  Library code of 2.split_by_barcodes.py; pool workers call
+split_by_barcodes() in-process.
+
+Barcode matches are memoised by the prefix of the searched sequence (see matchcache.py).
+
+Instead of comparing every barcode at every offset of the search window, a BarcodeIndex maps every sequence within
+max_diff substitutions of a barcode (its mismatch neighbourhood, built once when the barcodes are loaded) to the
+closest barcode, so a read costs one dict lookup per offset (and barcode length).  Where the neighbourhoods of two
+barcodes overlap at the same distance (a collision: the barcodes are at most 2 * max_diff apart), the variant goes to
+the barcode that comes first in b2s, as in find_best_match, and the collisions are reported when the index is built.
+A read base other than A, C, G or T mismatches every barcode letter, as in primer.MatchLetter.  The index returns the
+same [index, edit distance, barcode, sample] as find_best_match.
+
+Dual-index barcodes (a barcodes file line with a sample, its i7 barcode and its i5 barcode, keyed 'i7+i5' in b2s) are
+read from the sequence ids or the index file as 'i7+i5' (as the Illumina 1.8+ headers of dual-index runs).  A
+DualIndex matches them in two levels: the i7 barcode among all i7 barcodes, then the i5 barcode among the i5 barcodes
+paired with that i7, so combinatorial designs (every i7 with every i5) cost two lookups rather than one per pair.
+
+Golay-12 barcodes (12 bases, the error-correcting barcodes of the Earth Microbiome Project) are decoded with the
+syndrome table of the extended binary Golay (24,12) code instead (golay=True): the syndrome of a barcode is a lookup
+per base, and the table gives the bit errors to correct (up to 3 of its 24 bits, whatever max_diff), so a read is
+assigned to the corrected barcode if it is in the barcodes file.  A read base other than A, C, G or T is decoded as T.
+
+cache = matchcache.MatchCache(split_by_barcodes.search_width(b2s, 5))
+index = split_by_barcodes.barcode_index(b2s, 1, golay=False)
+[i,d,b,s] = split_by_barcodes.find_best_match(seq, b2s, 5, 1, cache=cache, index=index)
+
+"""
+
+from __future__ import print_function
+import sys
+from itertools import combinations, product
+import die
+import primer, readpack, util
+import matchcache
+from string import maketrans
+
+# Read letters of the barcode variants (read letters other than A, C, G and T are looked up as N)
+READ_LETTERS = 'ACGTN'
+to_read_letters = maketrans(''.join(chr(c) for c in range(256)), ''.join(chr(c) if chr(c) in 'ACGT' else 'N' for c in range(256)))
+
+# Read bases matched by each barcode letter (see primer.MatchLetter)
+IUPAC_BASES = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+               'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT', 'X': 'ACGT'}
+
+# Extended binary Golay (24,12) code of Golay-12 barcodes: every base is two bits, and the 24 bits of a barcode are a
+# codeword of the code with generator matrix [I | GOLAY_PARITY] (and parity check matrix [GOLAY_PARITY transposed | I])
+GOLAY_LENGTH = 12
+GOLAY_NT_TO_BITS = {'A': 2, 'C': 1, 'G': 3, 'T': 0, 'N': 0}
+GOLAY_BITS_TO_NT = 'TCAG'
+GOLAY_PARITY = ['100011101101', '000111011011', '001110110101', '011101101001', '111011010001', '110110100011',
+                '101101000111', '011010001111', '110100011101', '101000111011', '010001110111', '111111111110']
+
+# Largest number of barcode variants indexed.  With more (long barcodes and a large max_diff), barcodes are compared one by one.
+MAX_INDEX_VARIANTS = 1 << 22
+
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+
+rctab = maketrans('ACGTacgt','TGCAtgca')
+def reverse_complement(x):
+    # Reverse complement a sequence
+    return x[::-1].translate(rctab)
+
+
+def parse_barcodes_file(map_fn, format='fasta', rc=False):
+    # Map barcodes to samples (dual-index barcodes to samples as 'i7+i5')
+    b2s = {} # maps barcodes to samples
+    # Case 1: barcodes file is FASTA format
+    if format == 'fasta':
+        for [s,b] in util.iter_fst(map_fn):
+            if rc == True:
+                b = reverse_complement(b)
+            b2s[b] = s
+    # Case 2: barcodes file is tab-delimited
+    elif format == 'tab':
+        for line in open(map_fn):
+            # sample and barcode, or sample, i7 and i5 barcodes
+            x = line.rstrip().split()
+            s = x[0]
+            b = x[1:]
+            if rc == True:
+                b = [reverse_complement(y) for y in b]
+            b2s['+'.join(b)] = s
+    # Return map of barcodes to samples
+    return b2s
+
+
+def parse_index_file(index_fn, format='fasta'):
+    # Map FASTQ sequences to their barcodes
+    s2b = {} # maps sequences to barcodes
+    # Case 1: index file is FASTA format
+    if format=='fasta':
+        for [s,b] in util.iter_fst(index_fn):
+            s2b[s] = b
+    # Case 2: index file is tab-delimited
+    elif format=='tab':
+        for line in open(index_fn):
+            [s,b] = line.rstrip().split()
+            s2b[s] = b
+    return s2b
+
+
+def extract_barcode_from_id(line):
+    # for this type of fasta line:
+    # @MISEQ:1:1101:14187:1716#ATAGGTGG/1
+    # or Illumina 1.8+ lines (with the i7 and i5 barcodes of dual-index runs):
+    # @MISEQ:1:1101:14187:1716 1:N:0:ATAGGTGG+CTCTCTAT
+    if '#' not in line and ' ' in line:
+        return line.split(' ')[-1].split(':')[-1]
+    bcode = line.split('#')[-1].split('/')[0]
+    return bcode
+
+
+def mismatches(seq, subseq, w):
+    # Calculate the number of mismatches between a sequence and a given subsequence
+    # Searches in a sliding window that starts at position 1 and ends at position w
+    best_i = 0 # index (start position)
+    best_d = len(seq) # edit distance
+    # for every start position
+    for i in range(w):
+        # calculate edit distance to the given subsequence
+        if len(seq[i:]) < len(subseq):
+            continue
+        d = primer.MatchPrefix(seq[i:], subseq)
+        # keep track of the best index and edit distance
+        if d < best_d:
+            best_i = i
+            best_d = d
+    return [best_i, best_d]
+
+
+def search_width(b2s, w):
+    # Number of bases at the start of a sequence that its barcode match depends on
+    return w + max([len(b) for b in b2s] + [1]) - 1
+
+
+def find_best_match(seq, b2s, w, max_diff, cache=None, index=None):
+    # Find the sample with the best matching barcode
+    # cache (a MatchCache of width search_width(b2s, w)) memoises the result by the prefix of seq, and index (a
+    # BarcodeIndex of b2s and max_diff) looks it up instead of comparing every barcode
+    if w < 1:
+        # no offsets to search (and a cache key too short to tell reads apart)
+        return ['', '', '', '']
+    if cache is not None:
+        key = cache.key(seq)
+        x = cache.get(key)
+        if x is None:
+            x = find_best_match(seq, b2s, w, max_diff, index=index)
+            cache.put(key, x)
+        return x
+    if index is not None:
+        return index.find_best_match(seq, w)
+    best_i = ''
+    best_b = '' # barcode
+    best_d = len(seq) # edit distance
+    # Calculate edit distance to every barcode
+    for b in b2s:
+        [i,d] = mismatches(seq, b, w) # index, edit distance
+        if d < best_d:
+            best_i = i
+            best_b = b
+            best_d = d
+    # Return [index, edit distance, barcode, sample id] of best match
+    if best_d <= max_diff:
+        return [best_i, best_d, best_b, b2s[best_b]]
+    else:
+        return ['', '', '', '']
+
+
+def barcode_variants(b, max_diff):
+    # Generator of every read sequence within max_diff mismatches of barcode b, with its number of mismatches
+    for letter in b:
+        if letter not in IUPAC_BASES:
+            die.Die("Bad letter in barcode '%c'" % letter)
+    matching = [IUPAC_BASES[letter] for letter in b]
+    mismatching = [''.join([x for x in READ_LETTERS if x not in m]) for m in matching]
+    for k in range(min(max_diff, len(b)) + 1):
+        for positions in combinations(range(len(b)), k):
+            choices = list(matching)
+            for j in positions:
+                choices[j] = mismatching[j]
+            for letters in product(*choices):
+                yield ''.join(letters), k
+
+
+def count_variants(b2s, max_diff):
+    # Number of sequences in the mismatch neighbourhoods of all barcodes (counting overlaps once per barcode)
+    n = 0
+    for b in b2s:
+        sizes = [len(IUPAC_BASES.get(letter, 'ACGT')) for letter in b]
+        for k in range(min(max_diff, len(b)) + 1):
+            for positions in combinations(range(len(b)), k):
+                x = 1
+                for j, size in enumerate(sizes):
+                    x *= (len(READ_LETTERS) - size) if j in positions else size
+                n += x
+            if n > MAX_INDEX_VARIANTS:
+                return n
+    return n
+
+
+class BarcodeIndex():
+    # Mismatch-neighbourhood index of the barcodes of b2s: variant -> (mismatches, position of the barcode in b2s, barcode)
+
+    def __init__(self, b2s, max_diff):
+        self.b2s = b2s
+        self.max_diff = max_diff
+        self.lengths = sorted(set(len(b) for b in b2s))
+        self.width = max(self.lengths + [0])
+        self.variants = {}
+        self.collisions = 0
+        for order, b in enumerate(b2s):
+            for variant, d in barcode_variants(b, max_diff):
+                x = self.variants.get(variant)
+                if x is not None and x[0] == d:
+                    # equally close to an earlier barcode, which keeps it
+                    self.collisions += 1
+                if x is None or d < x[0]:
+                    self.variants[variant] = (d, order, b)
+
+    def find_best_match(self, seq, w):
+        # find_best_match(seq, b2s, w, max_diff) by looking up the subsequence at every offset of the window
+        n = len(seq)
+        seq = seq[:w + self.width - 1].translate(to_read_letters)
+        variants = self.variants
+        best = None
+        best_i = ''
+        for i in range(w):
+            for length in self.lengths:
+                if n - i < length:
+                    break
+                x = variants.get(seq[i:i+length])
+                # the closest barcode, then the first one in b2s, then the first offset
+                if x is not None and (best is None or x[:2] < best[:2]):
+                    best = x
+                    best_i = i
+        if best is None or best[0] >= n:
+            return ['', '', '', '']
+        return [best_i, best[0], best[2], self.b2s[best[2]]]
+
+
+def golay_columns():
+    # Syndrome of every bit of a 24-bit word (the columns of the parity check matrix)
+    return [int(row, 2) for row in GOLAY_PARITY] + [1 << (GOLAY_LENGTH - 1 - k) for k in range(GOLAY_LENGTH)]
+
+
+def golay_syndromes():
+    # Syndrome of every base at every position of a barcode: x[position][base]
+    columns = golay_columns()
+    x = []
+    for j in range(GOLAY_LENGTH):
+        x.append({})
+        for base, bits in GOLAY_NT_TO_BITS.items():
+            x[j][base] = (columns[2*j] if bits & 2 else 0) ^ (columns[2*j+1] if bits & 1 else 0)
+    return x
+
+
+def golay_errors():
+    # Bit errors (a 24-bit word) of every syndrome of at most 3 bit errors, indexed by syndrome (None for more errors)
+    columns = golay_columns()
+    x = [None] * (1 << GOLAY_LENGTH)
+    for k in range(4):
+        for bits in combinations(range(2 * GOLAY_LENGTH), k):
+            syndrome = 0
+            errors = 0
+            for bit in bits:
+                syndrome ^= columns[bit]
+                errors |= 1 << (2 * GOLAY_LENGTH - 1 - bit)
+            x[syndrome] = errors
+    return x
+
+
+GOLAY_SYNDROMES = golay_syndromes()
+GOLAY_ERRORS = golay_errors()
+
+
+def golay_decode(seq):
+    # [corrected barcode, number of bit errors] of a Golay-12 barcode (12 bases of A, C, G, T or N), or None if it has
+    # more than 3 bit errors
+    word = 0
+    syndrome = 0
+    for j in range(GOLAY_LENGTH):
+        word = (word << 2) | GOLAY_NT_TO_BITS[seq[j]]
+        syndrome ^= GOLAY_SYNDROMES[j][seq[j]]
+    errors = GOLAY_ERRORS[syndrome]
+    if errors is None:
+        return None
+    word ^= errors
+    return [''.join([GOLAY_BITS_TO_NT[(word >> (2 * (GOLAY_LENGTH - 1 - j))) & 3] for j in range(GOLAY_LENGTH)]), bin(errors).count('1')]
+
+
+class GolayIndex():
+    # Golay-12 barcodes of b2s, decoded with the syndrome table
+
+    def __init__(self, b2s):
+        self.b2s = b2s
+        for b in b2s:
+            if len(b) != GOLAY_LENGTH or golay_decode(b.translate(to_read_letters)) != [b, 0]:
+                die.Die("Barcode %s is not a Golay-12 barcode" % b)
+
+    def find_best_match(self, seq, w):
+        # Barcode at the offset of the window with the fewest bit errors (then the first offset), as [index, number of
+        # mismatches, barcode, sample]
+        seq = seq[:w + GOLAY_LENGTH - 1].translate(to_read_letters)
+        best = None
+        best_i = ''
+        for i in range(min(w, len(seq) - GOLAY_LENGTH + 1)):
+            x = golay_decode(seq[i:i+GOLAY_LENGTH])
+            if x is not None and x[0] in self.b2s and (best is None or x[1] < best[1]):
+                best = x
+                best_i = i
+        if best is None:
+            return ['', '', '', '']
+        b = best[0]
+        d = sum([1 for j in range(GOLAY_LENGTH) if seq[best_i + j] != b[j]])
+        return [best_i, d, b, self.b2s[b]]
+
+
+def is_dual(b2s):
+    # Whether the barcodes of b2s are dual-index barcodes ('i7+i5')
+    return any('+' in b for b in b2s)
+
+
+def check_mode(b2s, mode):
+    # Dual-index barcodes are not searched for in the sequences
+    if mode == 2 and is_dual(b2s):
+        die.Die("Dual-index barcodes are read from the sequence ids (mode 1) or the index file (mode 3)")
+
+
+class DualIndex():
+    # Two-level index of the dual-index barcodes of b2s: i7 barcode -> {i5 barcode: sample}
+
+    def __init__(self, b2s, max_diff, golay=False):
+        self.b2s = b2s
+        self.max_diff = max_diff
+        self.pairs = {}
+        for b, s in b2s.items():
+            x = b.split('+')
+            if len(x) != 2:
+                die.Die("Barcode %s is not an i7 and an i5 barcode (the barcodes file mixes single and dual-index barcodes)" % b)
+            self.pairs.setdefault(x[0], {})[x[1]] = s
+        self.i7s = dict((i7, i7) for i7 in self.pairs)
+        self.i7_index = barcode_index(self.i7s, max_diff, golay)
+        self.i5_index = dict((i7, barcode_index(i5s, max_diff, golay)) for i7, i5s in self.pairs.items())
+
+    def find_best_match(self, seq, w):
+        # [index, mismatches of both barcodes, 'i7+i5', sample] of a read barcode 'i7+i5'
+        x = seq.split('+')
+        if len(x) != 2:
+            return ['', '', '', '']
+        [i, d7, i7, s] = find_best_match(x[0], self.i7s, w, self.max_diff, index=self.i7_index)
+        if i7 == '':
+            return ['', '', '', '']
+        [j, d5, i5, s] = find_best_match(x[1], self.pairs[i7], w, self.max_diff, index=self.i5_index[i7])
+        if i5 == '':
+            return ['', '', '', '']
+        return [i, d7 + d5, i7 + '+' + i5, s]
+
+
+def barcode_index(b2s, max_diff, golay=False):
+    # Index of b2s: a DualIndex of dual-index barcodes, a GolayIndex of Golay-12 barcodes (golay=True), else a
+    # BarcodeIndex, or None if its mismatch neighbourhoods are too large to index (see MAX_INDEX_VARIANTS)
+    if is_dual(b2s):
+        return DualIndex(b2s, max_diff, golay)
+    if golay:
+        return GolayIndex(b2s)
+    n_variants = count_variants(b2s, max_diff)
+    if n_variants > MAX_INDEX_VARIANTS:
+        warning("The barcodes have more than " + str(MAX_INDEX_VARIANTS) + " variants within " + str(max_diff) + " mismatches.  Comparing barcodes one by one.")
+        return None
+    index = BarcodeIndex(b2s, max_diff)
+    if index.collisions > 0:
+        warning(str(index.collisions) + " sequences are equally close to two or more barcodes (within " + str(max_diff) + " mismatches).  They are assigned to the same barcode as when comparing barcodes one by one.")
+    return index
+
+
+def split_by_barcodes(fn, fastx_out, barcodes_map, mode, file_type='FASTQ', barcodes_format='tab', index_file='', index_format='',
+                      max_diff=0, window=5, rc=False, start=0, end=None, pack=False, cache=None, golay=False):
+    # Maps FASTA/FASTQ sequences (of the [start, end) chunk of fn, see chunking.py) to samples by finding the best matching barcodes
+    # Create new sequence ids of the form: sample_count, for compatibility with QIIME etc.
+    # Barcodes are in [1] seqids, [2] seqs, [3] index file.  Writes a read pack if pack is True (see readpack.py).
+    # Matches are memoised by barcode/read prefix in cache (a new MatchCache if not given).  Golay-12 barcodes are
+    # error-corrected if golay is True.
+    # Returns the number of sequences assigned to each sample
+    
+    # Initialize variables
+    mode = int(mode)
+    b2s = parse_barcodes_file(barcodes_map, format=barcodes_format, rc=rc) # barcodes to samples
+    if cache is None:
+        cache = matchcache.MatchCache(search_width(b2s, window))
+    check_mode(b2s, mode)
+    index = barcode_index(b2s, max_diff, golay)
+    s2b = parse_index_file(index_file, format=index_format) # samples to barcodes
+    s2c = {} # count number for a given sample
+    if pack:
+        out = readpack.PackWriter(fastx_out, fastq=(file_type == 'FASTQ'))
+        write = out.write_record
+    else:
+        out = open(fastx_out, 'w')
+        write = lambda record: out.write('\n'.join(record) + '\n')
+    
+    # Get FASTA, FASTQ iterators
+    if file_type == 'FASTQ':
+        iter_fst = util.iter_fsq
+    else:
+        iter_fst = util.iter_fst
+    
+    # For every record in FASTA/FASTQ file...
+    for record in iter_fst(fn, start=start, end=end):
+        sid = record[0][1:] # id
+        seq = record[1] # sequence
+        qual = ''
+        if len(record) > 2:
+            qual = record[3]
+        
+        # Case 1: barcodes are in the sample IDs
+        if mode == 1:
+            # Extract barcode from sequence id
+            barcode = extract_barcode_from_id(record[0])
+            # Find best matching sample
+            [i,d,b,s] = find_best_match(barcode, b2s, window, max_diff, cache, index)
+        
+        # Case 2: barcodes are in the sequences
+        elif mode == 2:
+            # Search sequence for best barcode
+            [i,d,b,s] = find_best_match(seq, b2s, window, max_diff, cache, index)
+            # Trim barcode from sequence
+            if i != '':
+                record[1] = seq[i+len(b):]
+                if qual != '':
+                    record[3] = qual[i+len(b):]
+        
+        # Case 3: barcodes are in index file
+        elif mode == 3:
+            # Get barcode from index file
+            b = s2b[sid]
+            # Find best matching sample
+            [i,d,b,s] = find_best_match(b, b2s, window, max_diff, cache, index)
+        
+        # If sample found, replace seqid with new seqid
+        if s:
+            s2c[s] = s2c.get(s, 0) + 1 # Increment sample count
+            new_sid = '@%s_%d' %(s, s2c[s])
+            record[0] = new_sid
+            write(record)
+    out.close()
+    return s2c
@@ -0,0 +1,133 @@
+"""
+
+OVERVIEW:
+
+Python module for a content-addressed cache of stage outputs, shared by all raw2otu.py runs on a machine.
+
+An entry holds the output files of one stage (e.g. the dereplicated FASTA and map) and is keyed by the stage name, the
+MD5 hashes of the contents of its input files and its parameters, so a run on the same data with the same parameters
+reuses it whatever the dataset directory or file names.  When a summary file changes only e.g. RDP_CUTOFF, every
+stage before the RDP assignments is found in the cache; when it changes OTU_SIMILARITY, the trimmed and dereplicated
+sequences are.
+
+Entries are directories <cache dir>/<key[:2]>/<key> holding the files in the order they were stored.  Their
+modification time is updated on every use, and the least recently used entries are removed when the cache grows
+beyond its size budget.  Files are placed in and out of the cache by hardlink where possible, else by copy-on-write
+reflink or copy (see packaging.py), so a cached stage costs no extra data written on the same filesystem.  A file
+shared with an entry must never be written through: placing a file replaces the one at its destination, and a fetch
+that misses removes the outputs of the stage, so the stage writes new files rather than rewriting linked ones.
+
+cache = stagecache.StageCache('/home/ubuntu/stage_cache', max_gb=100)
+key = cache.key('derep', [ckpt.file_hash(fasta_trimmed)], {'min_count': min_count})
+if not cache.fetch(key, [fasta_dereplicated, dereplication_map]):
+    OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', processing_summary_file, min_count)
+    cache.store(key, [fasta_dereplicated, dereplication_map])
+
+"""
+
+import os
+import shutil
+import hashlib
+import checkpoint
+import packaging
+
+
+class StageCache():
+
+    def __init__(self, cache_dir, max_gb=100):
+        # cache_dir None (or 'None') disables the cache
+        if cache_dir == 'None':
+            cache_dir = None
+        self.cache_dir = cache_dir
+        self.max_bytes = int(float(max_gb) * 1e9)
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    print('Unable to create stage cache directory ' + self.cache_dir + '.  Stage outputs will not be cached.')
+                    self.cache_dir = None
+
+    def key(self, stage, input_hashes, params):
+        # Key of the outputs of stage from inputs with the given content hashes (in a fixed order) and parameters
+        x = '\t'.join([stage, checkpoint.params_md5(params)] + [str(h) for h in input_hashes])
+        return hashlib.sha1(x).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, outputs):
+        # Places the cached files of key at the filenames in outputs.  Returns False if the cache has no such entry, after
+        # removing the outputs (which the stage is then run to write).
+        if self.cache_dir is None:
+            self.release(outputs)
+            return False
+        entry = self.entry_path(key)
+        cached = [os.path.join(entry, str(i)) for i in range(len(outputs))]
+        if not all(os.path.isfile(fn) for fn in cached):
+            self.release(outputs)
+            return False
+        try:
+            for fn, out in zip(cached, outputs):
+                packaging.place_file(fn, out)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # entry was evicted by another run while placing it
+            self.release(outputs)
+            return False
+        print('Stage cache: reused cached outputs ' + ', '.join(os.path.basename(out) for out in outputs) + '.')
+        return True
+
+    def store(self, key, outputs):
+        # Places the files in outputs in the cache entry of key (unless one of them is missing), then evicts old entries
+        if self.cache_dir is None or not all(os.path.isfile(out) for out in outputs):
+            return False
+        entry = self.entry_path(key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return True
+        tmp = entry + '.tmp.%d' % os.getpid()
+        try:
+            os.makedirs(tmp)
+            for i, out in enumerate(outputs):
+                packaging.place_file(out, os.path.join(tmp, str(i)))
+            os.rename(tmp, entry)
+        except (IOError, OSError):
+            # no space left, or another run stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def release(self, outputs):
+        # Removes output files that are about to be written, so files shared with cache entries are not written through
+        for out in outputs:
+            packaging.remove_existing(out)
+
+    def entries(self):
+        # [(last use, size in bytes, path)] of all entries, oldest first
+        x = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if '.tmp.' in key or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+                    x.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    pass
+        return sorted(x)
+
+    def evict(self):
+        # Removes the least recently used entries until the cache fits in its size budget
+        x = self.entries()
+        total = sum(size for t, size, entry in x)
+        for t, size, entry in x:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
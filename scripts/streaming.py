@@ -0,0 +1,171 @@
+"""
+
+OVERVIEW:
+
+Python module for trimming raw data in streaming mode: a reader, a set of transform workers and a writer run at the
+same time and pass record batches to each other over bounded in-memory queues, instead of every step writing its
+output to disk before the next one starts.
+
+    reader        one process, parses the raw data chunks in order into batches of records (see util.py)
+    workers       n processes, pass every record through the read engine steps (see readengine.py)
+    writer        the calling process, renumbers the reads of each sample, writes the trimmed FASTA and counts the
+                  reads of every unique sequence in every sample for dereplication (as dereplicate.dereplicate)
+
+Raw batches go from the reader to the workers through a ring of shared memory slots (see shmring.py): the reader
+copies each batch into a free slot and only the slot index is queued, so batches are not pickled on the way in.  The
+ring and the output queue hold at most a few batches per worker, so the reader blocks when the workers fall behind and
+the workers block when the writer does.  The reader also waits while as many batches as the ring has slots are read
+but not yet written, so batches that finish out of order and wait for an earlier one in the writer are bounded too.  Memory use is bounded by the queue sizes (plus the dereplication counts),
+while reading, matching and writing overlap.  Batches are written in the order they were read, so the trimmed FASTA is the same as
+the one of the single-pass chunk processing after renumbering and recombining.
+
+[step_counts, attrition, derep_counts, match_stats] = streaming.run_streaming(raw_chunks, settings, fasta_trimmed, separator, n_workers=7)
+OTU.dereplicate_and_sort(fasta_trimmed, fasta_dereplicated, dereplication_map, '_', processing_summary_file, min_count, counts=derep_counts)
+
+"""
+
+import Queue
+import multiprocessing as mp
+import util
+import fqindex
+import readengine
+import matchcache
+import shmring
+import tracing
+
+# Batches per worker that fit in each queue
+QUEUE_BATCHES_PER_WORKER = 4
+
+# Seconds between checks that all processes are still alive while waiting for a batch
+POLL_INTERVAL = 5
+
+
+def read_batches(chunks, file_type, ring, in_queue, n_workers, block_size=util.BLOCK_SIZE, index_file=None, window=None):
+    # Reader process: copies the batches of the raw data chunks (path, start, end) into the slots of ring and puts
+    # (batch number, slot) on in_queue, in order, then one None per worker.  window (a semaphore) is acquired for every
+    # batch and released by the writer once the batch is written.  With index_file (the raw file all chunks are
+    # ranges of), its record index is built from the batches read and written next to it (see fqindex.py).
+    i = 0
+    chunk_indexes = []
+    for path, start, end in chunks:
+        indexer = fqindex.ChunkIndexer() if index_file is not None else None
+        for batch in fqindex.iter_batches(path, file_type, start, end, indexer, block_size):
+            for slot in ring.fill(batch):
+                if window is not None:
+                    window.acquire()
+                in_queue.put((i, slot))
+                i += 1
+        if indexer is not None:
+            chunk_indexes.append(indexer.result())
+    for w in range(n_workers):
+        in_queue.put(None)
+    if index_file is not None:
+        fqindex.merge_index(index_file, file_type, chunks, chunk_indexes)
+
+
+def transform_batches(settings, ring, in_queue, out_queue):
+    # Worker process: passes the records of every batch (read in place from its slot of ring) through the read engine
+    # steps and puts (batch number, [(id, sequence)]) on out_queue, and ('counts', [read counts after every step,
+    # attrition table, match cache statistics]) at the end
+    tracing.process_name('streaming worker')
+    engine = readengine.build_engine(settings)
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        i, slot = item
+        with tracing.span('batch %d' % i, 'batch'):
+            records = [(record[0], record[1]) for record in engine.process(ring.get(slot))]
+        ring.release(slot)
+        out_queue.put((i, records))
+    out_queue.put(('counts', [engine.counts(), engine.attrition, engine.cache_stats()]))
+
+
+class StreamWriter():
+    # Writes trimmed reads to a FASTA file, renumbering the reads of each sample across batches (as
+    # preprocessing_16S.renumber_sequences), and counts the reads of every sequence in every sample (x[seq][sampleID])
+    def __init__(self, fasta_out, separator, derep_separator='_'):
+        self.out = open(fasta_out, 'w')
+        self.separator = separator
+        self.derep_separator = derep_separator
+        self.sample_counts = {}
+        self.x = {}
+
+    def write(self, records):
+        sample_counts = self.sample_counts
+        x = self.x
+        lines = []
+        for sid, seq in records:
+            sid = sid[1:].split(self.separator)
+            sampleID = ''.join(sid[:len(sid)-1])
+            sample_counts[sampleID] = sample_counts.get(sampleID, 0) + 1
+            new_sid = '%s_%d' %(sampleID, sample_counts[sampleID])
+            lines.append('>' + new_sid + '\n' + seq + '\n')
+            sa = new_sid.split(self.derep_separator)
+            sa = self.derep_separator.join(sa[:len(sa)-1])
+            if seq not in x:
+                x[seq] = {}
+            x[seq][sa] = x[seq].get(sa, 0) + 1
+        self.out.write(''.join(lines))
+
+    def close(self):
+        self.out.close()
+        return self.x
+
+
+def run_streaming(chunks, settings, fasta_out, separator, n_workers=1, queue_size=None, block_size=util.BLOCK_SIZE, derep_separator='_', index_file=None):
+    # Trims the raw data chunks (path, start, end) with the read engine settings (see trimsettings.engine_settings)
+    # into fasta_out.  Returns [read counts after every step, attrition table (see readengine.py), dereplication
+    # counts x[seq][sampleID], match cache statistics (see matchcache.py)].  With index_file, the record index of that
+    # raw file is built by the reader (see read_batches).
+    n_workers = max(1, int(n_workers))
+    if queue_size is None:
+        queue_size = QUEUE_BATCHES_PER_WORKER * n_workers
+    # slots of the ring limit the number of batches waiting for (or held by) a worker, and the window the number of
+    # batches read but not yet written (which bounds the batches the writer holds until an earlier one arrives)
+    ring = shmring.BatchRing(queue_size + n_workers, slot_bytes=4*block_size)
+    window = mp.Semaphore(queue_size + n_workers)
+    in_queue = mp.Queue()
+    out_queue = mp.Queue(maxsize=queue_size)
+    reader = mp.Process(target=read_batches, args=(chunks, settings['file_type'], ring, in_queue, n_workers, block_size, index_file, window))
+    workers = [mp.Process(target=transform_batches, args=(settings, ring, in_queue, out_queue)) for w in range(n_workers)]
+    processes = [reader] + workers
+    for p in processes:
+        p.daemon = True
+        p.start()
+
+    print "[[ Streaming ]] Trimming with 1 reader and " + str(n_workers) + " workers ..."
+    writer = StreamWriter(fasta_out, separator, derep_separator)
+    pending = {} # batches that arrived before an earlier one (at most the size of the window)
+    next_batch = 0
+    worker_counts = []
+    try:
+        while len(worker_counts) < n_workers:
+            try:
+                i, records = out_queue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                if any(p.exitcode not in [None, 0] for p in processes):
+                    raise RuntimeError("A streaming process exited with an error.")
+                continue
+            if i == 'counts':
+                worker_counts.append(records)
+                continue
+            pending[i] = records
+            while next_batch in pending:
+                writer.write(pending.pop(next_batch))
+                window.release()
+                next_batch += 1
+    except:
+        for p in processes:
+            p.terminate()
+        writer.close()
+        raise
+    for p in processes:
+        p.join()
+    if pending:
+        raise RuntimeError("Streaming batches " + str(sorted(pending)) + " were received out of order.")
+    x = writer.close()
+    print "[[ Streaming ]] Complete (" + str(next_batch) + " batches)."
+    return [readengine.sum_counts([counts for counts, attrition, stats in worker_counts]),
+            readengine.sum_attrition([attrition for counts, attrition, stats in worker_counts]), x,
+            matchcache.sum_stats([stats for counts, attrition, stats in worker_counts])]
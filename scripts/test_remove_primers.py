@@ -0,0 +1,54 @@
+"""
+
+OVERVIEW:
+
+Tests of the indel-tolerant primer search of remove_primers.py (find_best_match_indels).
+
+python -m unittest test_remove_primers
+
+"""
+
+import unittest
+import remove_primers as RP
+
+PRIMER = 'GTGCCAGCAGCCGCGGTAA'
+REST = 'TACGTAGGGTGCAAGCGTTAATCGGAATTACTGGGCGTAAAGCGCACG'
+
+
+class FindBestMatchIndelsTest(unittest.TestCase):
+
+    def trimmed(self, seq):
+        # Read after the primer match, or None if no primer matches
+        [i,d,p] = RP.find_best_match_indels(seq, [PRIMER], 35, 1)
+        if i == '':
+            return None
+        return seq[i+len(p):]
+
+    def test_exact(self):
+        self.assertEqual(RP.find_best_match_indels('AC' + PRIMER + REST, [PRIMER], 35, 1), [2, 0, PRIMER])
+        self.assertEqual(self.trimmed('AC' + PRIMER + REST), REST)
+
+    def test_last_base_mismatch(self):
+        # a substitution in the last primer base is not taken for its deletion
+        seq = 'AC' + PRIMER[:-1] + 'T' + REST
+        self.assertEqual(RP.find_best_match_indels(seq, [PRIMER], 35, 1), [2, 1, PRIMER])
+        self.assertEqual(RP.find_best_match_indels(seq, [PRIMER], 35, 1)[0], RP.find_best_match(seq, [PRIMER], 35, 1)[0])
+        self.assertEqual(self.trimmed(seq), REST)
+
+    def test_deletion(self):
+        seq = 'AC' + PRIMER[:8] + PRIMER[9:] + REST
+        self.assertEqual(RP.find_best_match_indels(seq, [PRIMER], 35, 1)[1], 1)
+        self.assertEqual(self.trimmed(seq), REST)
+
+    def test_insertion(self):
+        seq = 'AC' + PRIMER[:8] + 'T' + PRIMER[8:] + REST
+        self.assertEqual(RP.find_best_match_indels(seq, [PRIMER], 35, 1)[1], 1)
+        self.assertEqual(self.trimmed(seq), REST)
+
+    def test_too_many_differences(self):
+        seq = 'AC' + PRIMER[:4] + PRIMER[6:12] + 'T' + PRIMER[12:] + REST
+        self.assertEqual(RP.find_best_match_indels(seq, [PRIMER], 35, 1), ['', '', ''])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+
+OVERVIEW:
+
+Python module for recording a timeline of a raw2otu.py run and exporting it as a Chrome trace (trace.json), which
+opens in chrome://tracing, Perfetto or any other trace viewer.
+
+Tracing is enabled by setting the trace directory in the environment (TRACE_DIR_ENV) before the worker pool and any
+other processes of the run are started, so that every process of the run (the main process, pool workers and
+streaming workers) records its events.  Each process appends begin (B) and end
+(E) events, one JSON object per line, to its own file in the trace directory, so no events are lost or interleaved
+when processes run at the same time, and the events of a process that crashes are kept.  merge() collects them into
+one trace file, with one row per process.
+
+Events are recorded for the stages of the run (see profiler.py), every chunk task in the pool workers, and every
+external tool call made through util.run_cmd (usearch8, RDP classifier, biom, fastq_to_fasta).  When tracing is not
+enabled, span() does nothing.
+
+tracing.enable(os.path.join(working_directory, 'trace'))
+with tracing.span('chunk0001', 'chunk'):
+    ...
+tracing.merge(os.path.join(working_directory, 'trace'), os.path.join(QCpath, 'trace.json'))
+
+"""
+
+import os
+import json
+import time
+from contextlib import contextmanager
+
+TRACE_DIR_ENV = 'RAW2OTU_TRACE_DIR'
+
+
+def trace_dir():
+    # Trace directory of the run, or None if tracing is not enabled
+    return os.environ.get(TRACE_DIR_ENV) or None
+
+
+def enable(directory):
+    # Enables tracing into directory for this process and the processes it starts from now on
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.environ[TRACE_DIR_ENV] = directory
+
+
+def write_event(event):
+    # Appends an event to the trace file of this process
+    directory = trace_dir()
+    if directory is None:
+        return
+    event['pid'] = os.getpid()
+    event['tid'] = os.getpid()
+    with open(os.path.join(directory, 'events.%d.jsonl' % os.getpid()), 'a') as fid:
+        fid.write(json.dumps(event) + '\n')
+
+
+def begin(name, cat, args=None):
+    write_event({'name': name, 'cat': cat, 'ph': 'B', 'ts': time.time() * 1e6, 'args': args or {}})
+
+
+def end(name, cat, args=None):
+    write_event({'name': name, 'cat': cat, 'ph': 'E', 'ts': time.time() * 1e6, 'args': args or {}})
+
+
+@contextmanager
+def span(name, cat, args=None):
+    # Records the begin and end of the enclosed block
+    if trace_dir() is None:
+        yield
+        return
+    begin(name, cat, args)
+    try:
+        yield
+    finally:
+        end(name, cat)
+
+
+def process_name(name):
+    # Names the row of this process in the trace viewer
+    write_event({'name': 'process_name', 'ph': 'M', 'args': {'name': name}})
+
+
+def merge(directory, trace_file):
+    # Collects the events of all processes in directory into a Chrome trace file.  Timestamps are made relative to the
+    # first event, and processes without a name are named as workers.
+    events = []
+    for fn in sorted(os.listdir(directory)):
+        if not (fn.startswith('events.') and fn.endswith('.jsonl')):
+            continue
+        with open(os.path.join(directory, fn)) as fid:
+            for line in fid:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # last line of a process killed while writing it
+                    pass
+    named = set(event['pid'] for event in events if event['ph'] == 'M')
+    t0 = min([event['ts'] for event in events if 'ts' in event] or [0])
+    for event in events:
+        if 'ts' in event:
+            event['ts'] = round(event['ts'] - t0, 1)
+    for pid in sorted(set(event['pid'] for event in events) - named):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid, 'args': {'name': 'worker %d' % pid}})
+    with open(trace_file + '.tmp', 'w') as fid:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fid)
+    os.rename(trace_file + '.tmp', trace_file)
+    return len(events)
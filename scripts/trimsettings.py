@@ -0,0 +1,179 @@
+"""
+
+OVERVIEW:
+
+Python module for reading the raw data and trimming settings of one amplicon type (16S or ITS) from a summary file.
+
+raw2otu.py uses these for the amplicon it processes, and for the other amplicon when both are trimmed in one pass
+over the raw data (--combined True), so that both runs build the same read engine settings and the same trimming
+checkpoint (see readengine.py and checkpoint.py).
+
+s = trimsettings.amplicon_settings(summary_obj, '16S', input_dir)
+settings = trimsettings.engine_settings(s)
+[inputs, params] = trimsettings.trimming_checkpoint(s)
+
+"""
+
+from __future__ import print_function
+import os, sys
+
+
+def warning(*objs):
+    print("WARNING: ", *objs, file=sys.stderr)
+
+
+def attributes(summary_obj, amplicon_type):
+    # Summary file attributes of an amplicon type
+    if amplicon_type == '16S':
+        return summary_obj.attribute_value_16S
+    elif amplicon_type == 'ITS':
+        return summary_obj.attribute_value_ITS
+    raise NameError("Unknown amplicon type '" + str(amplicon_type) + "'.")
+
+
+def run_flags(summary_obj, amplicon_type):
+    # raw2otu.py flags (as set by Master.py) for an amplicon type: multiple raw files, primers removed, split by barcodes
+    x = attributes(summary_obj, amplicon_type)
+    flags = {'multiple_raw_files': 'False', 'primers_removed': 'False', 'split_by_barcodes': 'False'}
+    if 'RAW_FASTQ_FILES' in x or 'RAW_FASTA_FILES' in x:
+        flags['multiple_raw_files'] = 'True'
+    if x.get('PRIMERS_FILE') == 'None':
+        flags['primers_removed'] = 'True'
+    if x.get('BARCODES_MAP') == 'None':
+        flags['split_by_barcodes'] = 'True'
+    return flags
+
+
+def amplicon_settings(summary_obj, amplicon_type, input_dir, split_by_barcodes='False', primers_removed='False', multiple_raw_files='False', single_pass='True'):
+    # Raw data files, quality encoding and trimming settings of an amplicon type, as a dict:
+    #   primers_file, barcodes_map, raw_data_file or raw_data_summary_file, raw_file_type, ascii_encoding,
+    #   mode (barcodes mode, if reads need to be demultiplexed), trim_type and quality or maxee (FASTQ), length, separator,
+    #   primer_indels ('True' to match primers allowing insertions and deletions, see remove_primers.py),
+    #   barcodes_golay ('True' to error-correct Golay-12 barcodes, see split_by_barcodes.py),
+    # and the flags the run was started with
+    x = attributes(summary_obj, amplicon_type)
+    s = {'amplicon_type': amplicon_type, 'split_by_barcodes': split_by_barcodes, 'primers_removed': primers_removed,
+         'multiple_raw_files': multiple_raw_files, 'single_pass': single_pass,
+         'raw_data_file': None, 'raw_data_summary_file': None, 'mode': None, 'trim_type': None, 'quality': None, 'maxee': None}
+
+    # Extract file locations
+    s['primers_file'] = input_dir + '/' + x['PRIMERS_FILE']
+    s['barcodes_map'] = input_dir + '/' + x['BARCODES_MAP']
+    try:
+        s['raw_data_file'] = input_dir + '/' + x['RAW_FASTQ_FILE']
+        s['raw_file_type'] = 'FASTQ'
+    except:
+        print("No single raw FASTQ file found.  Checking for raw FASTA.")
+        try:
+            s['raw_data_file'] = input_dir + '/' + x['RAW_FASTA_FILE']
+            s['raw_file_type'] = 'FASTA'
+        except:
+            print("No single raw FASTA file found either.  Checking for multiple files.")
+            try:
+                s['raw_data_summary_file'] = os.path.join(input_dir, x['RAW_FASTQ_FILES'])
+                s['raw_file_type'] = 'FASTQ'
+            except:
+                print("No filename of multiple raw FASTQs map provided.  Check contents of your raw data and summary file.")
+                try:
+                    s['raw_data_summary_file'] = os.path.join(input_dir, x['RAW_FASTA_FILES'])
+                    s['raw_file_type'] = 'FASTA'
+                except:
+                    print("No filename of multiple raw FASTAs map provided.  Check contents of your raw data and summary file.")
+                    raise NameError("Unable to retrieve raw sequencing files.")
+
+    # Get ASCII encoding of FASTQ files
+    encoding = x.get('ASCII_ENCODING', '')
+    if(encoding == "ASCII_BASE_33"):
+        print("ASCII 33 encoding for quality scores specified.")
+        s['ascii_encoding'] = 33
+    elif(encoding == "ASCII_BASE_64"):
+        print ("ASCII 64 encoding for quality scores specified.")
+        s['ascii_encoding'] = 64
+    else:
+        print ("No ASCII encoding specified in the summary file for the quality scores in the FASTQ file.  Using ASCII 33 as default.")
+        warning("No ASCII encoding specified in the summary file for the quality scores in the FASTQ file.  Using ASCII 33 as default.")
+        s['ascii_encoding'] = 33
+
+    # Barcodes mode, quality filter (truncate at a quality score, or discard reads by max expected errors after length trimming) and trim length
+    if (split_by_barcodes == 'False' and multiple_raw_files == 'False'):
+        s['mode'] = x['BARCODES_MODE']
+    if (s['raw_file_type'] == "FASTQ"):
+        s['trim_type'] = 'truncqual'
+        try:
+            s['quality'] = x['QUALITY_TRIM']
+        except:
+            try:
+                # Note: if max errors is specified, quality filtering is performed
+                # after length trimming
+                s['maxee'] = x['MAX_ERRORS']
+                s['trim_type'] = 'maxee'
+            except:
+                s['quality'] = 25
+    try:
+        s['length'] = x['TRIM_LENGTH']
+    except:
+        s['length'] = 101
+
+    s['primer_indels'] = x.get('PRIMER_INDELS', 'False')
+    s['barcodes_golay'] = x.get('BARCODES_GOLAY', 'False')
+
+    try:
+        s['separator'] = summary_obj.attribute_value_16S['BARCODES_SEPARATOR']
+    except:
+        s['separator'] = '_'
+    return s
+
+
+def engine_settings(s, sample_id=None):
+    # Settings of the single-pass read engine (see readengine.build_steps)
+    settings = {'file_type': s['raw_file_type'], 'ascii_encoding': s['ascii_encoding'], 'length': s['length'],
+                'separator': s['separator']}
+    if (s['raw_file_type'] == "FASTQ"):
+        settings['trim_type'] = s['trim_type']
+        if s['trim_type'] == 'maxee':
+            settings['maxee'] = s['maxee']
+        else:
+            settings['quality'] = s['quality']
+    if (s['split_by_barcodes'] == 'False' and s['multiple_raw_files'] == 'False'):
+        settings['barcodes_map'] = s['barcodes_map']
+        settings['barcodes_mode'] = s['mode']
+        if s['barcodes_golay'] == 'True':
+            settings['barcodes_golay'] = True
+    if (s['primers_removed'] == 'False'):
+        settings['primers_file'] = s['primers_file']
+        if s['primer_indels'] == 'True':
+            settings['primer_indels'] = True
+    if sample_id is not None:
+        settings['sample_id'] = sample_id
+    return settings
+
+
+def trimming_checkpoint(s, raw_filenames_orig=None, sampleID_map=None):
+    # [input files, parameters] of the trimming stage (see checkpoint.py), from the raw data to the trimmed FASTA
+    if s['multiple_raw_files'] == 'False':
+        inputs = [s['raw_data_file']]
+    else:
+        inputs = list(raw_filenames_orig)
+    params = {'file_type': s['raw_file_type'], 'ascii_encoding': s['ascii_encoding'], 'length': s['length'], 'separator': s['separator'],
+              'split_by_barcodes': s['split_by_barcodes'], 'primers_removed': s['primers_removed'],
+              'multiple_raw_files': s['multiple_raw_files'], 'single_pass': s['single_pass']}
+    if (s['split_by_barcodes'] == 'False' and s['multiple_raw_files'] == 'False'):
+        inputs.append(s['barcodes_map'])
+        params['barcodes_mode'] = s['mode']
+        # only recorded when set, so the checkpoints of earlier runs still match
+        if s['barcodes_golay'] == 'True':
+            params['barcodes_golay'] = 'True'
+    elif (s['multiple_raw_files'] == 'True'):
+        params['sample_ids'] = ','.join(sampleID_map)
+    if (s['primers_removed'] == 'False'):
+        inputs.append(s['primers_file'])
+        # only recorded when set, so the checkpoints of earlier runs still match
+        if s['primer_indels'] == 'True':
+            params['primer_indels'] = 'True'
+    if (s['raw_file_type'] == "FASTQ"):
+        params['trim_type'] = s['trim_type']
+        if s['trim_type'] == 'maxee':
+            params['maxee'] = s['maxee']
+        else:
+            params['quality'] = s['quality']
+    return [inputs, params]
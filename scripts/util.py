@@ -1,4 +1,8 @@
-import re, string, sys, time
+import os, re, string, subprocess, sys, time, zlib
+import numpy as np
+import bgzf
+import readpack
+import tracing
 
 rctab = string.maketrans('ACGTacgt','TGCAtgca')
 
@@ -17,6 +21,18 @@ def error(text, indent=2):
     quit()
 
 
+def run_cmd(cmd, name=None):
+    # run a shell command (as os.system) and return its exit status
+    # with tracing enabled (see tracing.py) the call is recorded under name, by default the program (or script) name
+    if name is None:
+        words = cmd.split()
+        name = os.path.basename(words[0]) if words else 'cmd'
+        if name in ['python', 'java'] and len(words) > 1:
+            name = os.path.basename(words[1])
+    with tracing.span(name, 'tool', {'cmd': cmd}):
+        return os.system(cmd)
+
+
 def read_list(fn, dtype=str):
     # read file as list
     x = [dtype(line.rstrip()) for line in open(fn)]
@@ -38,33 +54,382 @@ def read_tseries(fn):
     return read_dataframe(fn, index_dtype=float, columns_dtype=str)
 
 
-def iter_fst(fn):
-    # generator that iterates through [sid, seq] pairs in a fasta file
-    seq = ''
-    for line in open(fn):
-        line = line.rstrip()
-        if line.startswith('>'):
-            if seq != '':
-                yield [sid, seq]
-            sid = line
-            seq = ''
+# Size of the blocks read from disk by the batched record readers (small enough to stay in cache)
+BLOCK_SIZE = 1 << 16
+
+
+class RecordBatch():
+    # A batch of FASTA/FASTQ records parsed from one block of the input file.
+    # Records are not copied out of the block: the batch keeps the raw buffer and
+    # numpy arrays of [start, end) offsets for the id, sequence and quality fields.
+    def __init__(self, buf, sid_start, sid_end, seq_start, seq_end, plus_start=None, plus_end=None, qual_start=None, qual_end=None, wrapped=None):
+        self.buf = buf
+        self.sid_start = sid_start
+        self.sid_end = sid_end
+        self.seq_start = seq_start
+        self.seq_end = seq_end
+        self.plus_start = plus_start
+        self.plus_end = plus_end
+        self.qual_start = qual_start
+        self.qual_end = qual_end
+        self.wrapped = wrapped # FASTA only: True where the sequence spans several lines
+        self.offset = 0 # position of buf in the (decompressed) stream, relative to the start of the range read
+    def __len__(self):
+        return len(self.sid_start)
+    def __iter__(self):
+        # iterate through records as lists (offsets converted to python ints once per batch)
+        buf = self.buf
+        if self.qual_start is None:
+            wrapped = self.wrapped.tolist()
+            for a, b, c, d, w in zip(self.sid_start.tolist(), self.sid_end.tolist(), self.seq_start.tolist(), self.seq_end.tolist(), wrapped):
+                seq = buf[c:d]
+                if w:
+                    seq = ''.join(seq.split())
+                yield [buf[a:b], seq]
         else:
-            seq += line
-    yield [sid, seq]
+            for a, b, c, d, e, f, g, h in zip(self.sid_start.tolist(), self.sid_end.tolist(), self.seq_start.tolist(), self.seq_end.tolist(),
+                                              self.plus_start.tolist(), self.plus_end.tolist(), self.qual_start.tolist(), self.qual_end.tolist()):
+                yield [buf[a:b], buf[c:d], buf[e:f], buf[g:h]]
+    def is_fastq(self):
+        return self.qual_start is not None
+    def sid(self, i):
+        return self.buf[self.sid_start[i]:self.sid_end[i]]
+    def seq(self, i):
+        seq = self.buf[self.seq_start[i]:self.seq_end[i]]
+        if self.wrapped is not None and self.wrapped[i]:
+            seq = ''.join(seq.split())
+        return seq
+    def qual(self, i):
+        return self.buf[self.qual_start[i]:self.qual_end[i]]
+    def seq_lengths(self):
+        # sequence lengths of all records
+        lengths = self.seq_end - self.seq_start
+        if self.wrapped is not None and self.wrapped.any():
+            for i in np.flatnonzero(self.wrapped):
+                lengths[i] = len(self.seq(i))
+        return lengths
+    def raw(self):
+        # the records of the batch as they appear in the file
+        if len(self) == 0:
+            return ''
+        return self.buf[self.sid_start[0]:]
+    def record(self, i):
+        # [sid, seq] for FASTA, [sid, seq, '+', qual] for FASTQ (same layout as iter_fst/iter_fsq)
+        buf = self.buf
+        if self.qual_start is None:
+            return [buf[self.sid_start[i]:self.sid_end[i]], self.seq(i)]
+        return [buf[self.sid_start[i]:self.sid_end[i]], buf[self.seq_start[i]:self.seq_end[i]], buf[self.plus_start[i]:self.plus_end[i]], buf[self.qual_start[i]:self.qual_end[i]]]
+
+
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+
+
+def _rstrip_ends(x, starts, ends):
+    # move the [start, end) line ends back over trailing whitespace, like str.rstrip()
+    while True:
+        strip = (ends > starts) & WHITESPACE[x[np.maximum(ends - 1, 0)]]
+        if not strip.any():
+            return ends
+        ends = ends - strip
+
+
+def _line_offsets(buf, nl):
+    # [start, end) offsets of the lines terminated by the newlines at positions nl (trailing whitespace excluded)
+    starts = np.empty(len(nl), dtype=np.int64)
+    starts[0:1] = 0
+    starts[1:] = nl[:-1] + 1
+    ends = nl.astype(np.int64)
+    x = np.frombuffer(buf, dtype=np.uint8)
+    return starts, _rstrip_ends(x, starts, ends)
+
+
+def _fastq_batch(buf, nl):
+    # Build a RecordBatch from a buffer holding a whole number of FASTQ records
+    starts, ends = _line_offsets(buf, nl)
+    return RecordBatch(buf, starts[0::4], ends[0::4], starts[1::4], ends[1::4], starts[2::4], ends[2::4], starts[3::4], ends[3::4])
+
+
+def _fasta_batch(buf, nl, heads):
+    # Build a RecordBatch from a buffer holding a whole number of FASTA records
+    # heads = offsets of the '>' characters that start each record
+    k = np.searchsorted(nl, heads)
+    sid_end = nl[k].astype(np.int64)
+    seq_start = sid_end + 1
+    seq_end = np.empty(len(heads), dtype=np.int64)
+    seq_end[:-1] = heads[1:]
+    seq_end[-1:] = len(buf)
+    # number of newlines inside each sequence; more than one means the sequence is wrapped
+    n_lines = np.searchsorted(nl, seq_end) - k - 1
+    seq_end = np.maximum(seq_end - (n_lines > 0), seq_start)
+    wrapped = n_lines > 1
+    x = np.frombuffer(buf, dtype=np.uint8)
+    sid_end = _rstrip_ends(x, heads, sid_end)
+    # trailing whitespace is removed together with the line breaks of wrapped sequences
+    wrapped |= (seq_end > seq_start) & WHITESPACE[x[np.maximum(seq_end - 1, 0)]]
+    return RecordBatch(buf, heads.astype(np.int64), sid_end, seq_start, seq_end, wrapped=wrapped)
+
+
+def detect_compression(fn):
+    # Returns 'bgzf', 'gzip', 'zstd' or None, based on the magic bytes at the start of the file
+    with open(fn, 'rb') as fid:
+        header = fid.read(18)
+    if header[:2] == '\x1f\x8b':
+        if len(header) == 18 and header[3] == '\x04' and header[12:14] == 'BC':
+            return 'bgzf'
+        return 'gzip'
+    if header[:4] == '\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+
+def decompress_command(fn):
+    # Shell command that writes the (decompressed) contents of a file to stdout
+    compression = detect_compression(fn)
+    if compression in ['gzip', 'bgzf']:
+        return 'gzip -dc ' + fn
+    elif compression == 'zstd':
+        return 'zstd -dcq ' + fn
+    return 'cat ' + fn
+
+
+def _iter_gzip(fid, block_size):
+    # generator that decompresses a (possibly multi-member) gzip stream
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = fid.read(block_size)
+        if not data:
+            break
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                # start of the next gzip member
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.flush()
+    if out:
+        yield out
 
 
-def iter_fsq(fn):
-    # generator that iterates through records in a fastq file
-    record = []
-    i = 0
-    for line in open(fn):
-        i += 1
-        if i % 4 == 1:
-            if len(record) > 0:
-                yield record
-            record = []
-        record.append(line.rstrip())
-    yield record
+def _iter_zstd(fn, block_size):
+    # generator that decompresses a zstd file, with the zstandard module if present or the zstd binary otherwise
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    if zstandard is not None:
+        with open(fn, 'rb') as fid:
+            for out in zstandard.ZstdDecompressor().read_to_iter(fid, read_size=block_size, write_size=block_size):
+                yield out
+    else:
+        proc = subprocess.Popen(['zstd', '-dcq', fn], stdout=subprocess.PIPE)
+        while True:
+            out = proc.stdout.read(block_size)
+            if not out:
+                break
+            yield out
+        if proc.wait() != 0:
+            raise IOError('zstd failed to decompress ' + fn)
+
+
+def iter_raw(fn, block_size=BLOCK_SIZE, start=0, end=None):
+    # generator that reads [start, end) of a file in blocks of block_size bytes
+    # gzip and zstd files are decompressed on the fly; for BGZF files start/end are virtual offsets
+    compression = detect_compression(fn)
+    if compression == 'bgzf':
+        for data in bgzf.iter_range(fn, start, end):
+            yield data
+        return
+    elif compression is not None:
+        if start or end is not None:
+            raise ValueError('Byte ranges are not supported for ' + compression + ' files: ' + fn)
+        if compression == 'gzip':
+            with open(fn, 'rb') as fid:
+                for data in _iter_gzip(fid, block_size):
+                    yield data
+        else:
+            for data in _iter_zstd(fn, block_size):
+                yield data
+        return
+    fh = open(fn, 'rb')
+    if start:
+        fh.seek(start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        n = block_size if remaining is None else min(block_size, remaining)
+        data = fh.read(n)
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        yield data
+    fh.close()
+
+
+def count_lines(fn, start=0, end=None):
+    # number of lines in [start, end) of a (possibly compressed) file
+    n = 0
+    for data in iter_raw(fn, start=start, end=end):
+        n += data.count('\n')
+    return n
+
+
+def count_headers(fn, start=0, end=None, marker='>'):
+    # number of lines starting with marker in [start, end) of a (possibly compressed) file, e.g. the records of a FASTA file
+    n = 0
+    last = '\n'
+    for data in iter_raw(fn, start=start, end=end):
+        if not data:
+            continue
+        n += data.count('\n' + marker)
+        if last == '\n' and data[0] == marker:
+            n += 1
+        last = data[-1]
+    return n
+
+
+def next_record_start(buf, pos=0, fastq=True):
+    # Offset of the first FASTA/FASTQ record that starts at the beginning of a line at or after pos,
+    # or -1 if buf does not contain one completely.  pos itself only counts if it follows a newline.
+    if pos > 0 and buf[pos-1] == '\n':
+        i = pos
+    else:
+        i = buf.find('\n', pos) + 1
+        if i == 0:
+            return -1
+    if not fastq:
+        if buf[i:i+1] == '>':
+            return i
+        i = buf.find('\n>', i)
+        return -1 if i < 0 else i + 1
+    # A FASTQ header is a line starting with '@' whose second next line starts with '+'.  (A quality line
+    # starting with '@' is followed by a header and a sequence line, so it cannot match.)
+    while True:
+        j1 = buf.find('\n', i)
+        if j1 < 0:
+            return -1
+        j2 = buf.find('\n', j1 + 1)
+        if j2 < 0 or j2 + 1 >= len(buf):
+            return -1
+        if buf[i] == '@' and buf[j2+1] == '+':
+            return i
+        i = j1 + 1
+
+
+def iter_fsq_batches(fn, block_size=BLOCK_SIZE, start=0, end=None):
+    # generator that parses a fastq file in large blocks and yields RecordBatch objects
+    # start/end restrict parsing to a byte range whose boundaries fall on record starts
+    parts = [] # blocks holding the incomplete record at the end of the data read so far
+    n_nl = 0 # number of newlines in parts
+    pos = 0 # stream position of parts[0]
+    for data in iter_raw(fn, block_size, start, end):
+        parts.append(data)
+        n_nl += data.count('\n')
+        if n_nl < 4:
+            # no complete record yet: keep the blocks without joining or rescanning them
+            continue
+        buf = ''.join(parts) if len(parts) > 1 else data
+        nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+        n = len(nl) - len(nl) % 4
+        cut = nl[n-1] + 1
+        batch = _fastq_batch(buf[:cut], nl[:n])
+        batch.offset = pos
+        yield batch
+        tail = buf[cut:]
+        parts = [tail] if tail else []
+        n_nl = len(nl) - n
+        pos += cut
+    # last record (no trailing newline, or truncated file)
+    tail = ''.join(parts)
+    if tail.strip():
+        if not tail.endswith('\n'):
+            tail += '\n'
+        nl = np.flatnonzero(np.frombuffer(tail, dtype=np.uint8) == 10)
+        missing = (4 - len(nl) % 4) % 4
+        if missing:
+            tail += '\n' * missing
+            nl = np.flatnonzero(np.frombuffer(tail, dtype=np.uint8) == 10)
+        batch = _fastq_batch(tail, nl)
+        batch.offset = pos
+        yield batch
+
+
+def _fasta_heads(data, prev):
+    # offsets of the '>' characters at the beginning of a line in data (prev = the character before data)
+    x = np.frombuffer(data, dtype=np.uint8)
+    heads = np.flatnonzero(x == 62)
+    if len(heads) > 0:
+        before = x[np.maximum(heads - 1, 0)]
+        before[heads == 0] = ord(prev)
+        heads = heads[before == 10]
+    return heads.astype(np.int64)
+
+
+def iter_fst_batches(fn, block_size=BLOCK_SIZE, start=0, end=None):
+    # generator that parses a fasta file in large blocks and yields RecordBatch objects
+    # start/end restrict parsing to a byte range whose boundaries fall on record starts
+    parts = [] # blocks holding the incomplete record at the end of the data read so far
+    size = 0 # total length of parts
+    heads = np.zeros(0, dtype=np.int64) # record starts in parts
+    pos = 0 # stream position of parts[0]
+    for data in iter_raw(fn, block_size, start, end):
+        # only the new block is scanned for record starts
+        heads = np.concatenate([heads, _fasta_heads(data, parts[-1][-1] if parts else '\n') + size])
+        parts.append(data)
+        size += len(data)
+        if len(heads) < 2:
+            continue
+        # the last record may continue into the next block
+        buf = ''.join(parts) if len(parts) > 1 else data
+        x = np.frombuffer(buf, dtype=np.uint8)
+        first, cut = heads[0], heads[-1]
+        nl = np.flatnonzero(x[first:cut] == 10)
+        batch = _fasta_batch(buf[first:cut], nl, heads[:-1] - first)
+        batch.offset = pos + first
+        yield batch
+        parts = [buf[cut:]]
+        size = len(parts[0])
+        heads = np.zeros(1, dtype=np.int64)
+        pos += cut
+    tail = ''.join(parts)
+    if tail.strip():
+        if not tail.endswith('\n'):
+            tail += '\n'
+        x = np.frombuffer(tail, dtype=np.uint8)
+        heads = np.flatnonzero(x == 62)
+        heads = heads[(heads == 0) | (x[np.maximum(heads - 1, 0)] == 10)]
+        if len(heads) > 0:
+            pos += heads[0]
+            tail = tail[heads[0]:]
+            heads = heads - heads[0]
+            nl = np.flatnonzero(np.frombuffer(tail, dtype=np.uint8) == 10)
+            batch = _fasta_batch(tail, nl, heads)
+            batch.offset = pos
+            yield batch
+
+
+def iter_fst(fn, start=0, end=None):
+    # generator that iterates through [sid, seq] pairs in a fasta file (or a read pack, see readpack.py)
+    if readpack.is_readpack(fn):
+        for record in readpack.iter_records(fn, fastq=False):
+            yield record
+        return
+    for batch in iter_fst_batches(fn, start=start, end=end):
+        for record in batch:
+            yield record
+
+
+def iter_fsq(fn, start=0, end=None):
+    # generator that iterates through records in a fastq file (or a read pack, see readpack.py)
+    if readpack.is_readpack(fn):
+        for record in readpack.iter_records(fn):
+            yield record
+        return
+    for batch in iter_fsq_batches(fn, start=start, end=end):
+        for record in batch:
+            yield record
 
 
 def read_fst(fn, reverse=False):
@@ -78,6 +443,18 @@ def read_fst(fn, reverse=False):
     return fst
 
 
+def iter_lists(x, n):
+    # generator that groups the items of an iterable into lists of up to n items
+    items = []
+    for item in x:
+        items.append(item)
+        if len(items) == n:
+            yield items
+            items = []
+    if items:
+        yield items
+
+
 def cycle(x):
     # an efficient way to cycle through a list (similar to itertools.cycle)
     while True: